@@ -2,48 +2,105 @@ import os
 import sys
 import platform
 import subprocess
-import requests
-import zipfile
-import tarfile
 import stat
 import re
 import shutil
 import ctypes
-import colorama
 import json
 import time
 import threading
+import queue
+import argparse
+import struct
+import hashlib
+import tempfile
+import io
+import codecs
+import atexit
+import abc
+from contextlib import contextmanager, redirect_stdout
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from packaging import version
 from typing import Optional, List, Dict
-# Initialize colorama for Windows console colors
-colorama.init()
 
 class Flash:
-    def __init__(self):
+    # Exit codes the headless entry point reports to station scripts
+    EXIT_FAILED = 1
+    EXIT_USAGE = 2
+    EXIT_NO_DEVICE = 3
+    EXIT_WRONG_DEVICE = 4
+    EXIT_MISSING_IMAGES = 5
+    EXIT_BAD_IMAGE = 6
+    EXIT_INTERRUPTED = 130
+    # Keys a device's "super" block must set; guessing them writes a partition table the bootloader may reject
+    SUPER_LAYOUT_KEYS = ("group", "metadata_slots", "virtual_ab")
+
+    def __init__(self, serial=None, devices=None, backend="fastboot"):
         self.system = platform.system().lower()
         self.arch = platform.machine().lower()
         self.fastboot_path = None
         self.adb_path = None
         self.platform_tools_url = self.get_platform_tools_url()
         self.work_dir = os.getcwd()
-        self.min_version = version.parse("34.0.0")
-        self.log_file = f"flash_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        self.min_version = "34.0.0"
+        self.serial = serial
+        self.tag = f"[{serial}] " if serial else ""
+        log_suffix = f"_{re.sub(r'[^A-Za-z0-9_.-]', '_', serial)}" if serial else ""
+        self.log_file = f"flash_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}{log_suffix}.jsonl"
+        self.report_file = self.log_file.replace("flash_log_", "flash_report_", 1)[:-len(".jsonl")] + ".json"
+        self.phase = None
+        self.spawns = 0
+        self.trace_file = None
+        self.report = FlashReport()
         self.install_path = r"C:\adb" if sys.platform == "win32" else None
+        self.tools_sha256 = None
+        self.state_dir = os.path.join(os.path.expanduser("~"), ".universal-flasher")
+        self.tool_versions = ToolVersionCache(os.path.join(self.state_dir, "tool_versions.json"))
         self.slot = "a"
+        self.active_slot = "a"
+        self.device_serial = serial
+        self.delta = False
+        self.force_flash = False
+        self.manifest = None
+        self.journal = None
+        self.resume = False
+        self.verifier = None
+        self.digests = {}
+        self.sparse = True
+        self.build_super = False
+        self.max_download_size = None
+        self.sparse_limit = None
+        self.tuner = TransferTuner(os.path.join(self.state_dir, "tuning.json"))
+        self.device_vars = None
+        self.prepared = {}
+        self.rom = DirectorySource()
+        self.rom_path = self.work_dir
         self.spinner_running = False
+        self.spinner_enabled = True
+        self.answers = {}
+        self.profile = None
+        self.headless = False
+        self.backend = backend
+        self.native = NativeFastboot(serial) if backend in ("auto", "native") else None
+        self.watcher = DeviceWatcher(self)
+        self.progress = TransferProgress(on_complete=self.report_transfer)
+        if self.native:
+            self.native.on_progress = self.progress.handle
         self.current_device = None
         # Color setup using colorama
+        import colorama
         self.color_red = colorama.Fore.RED
         self.color_green = colorama.Fore.GREEN
         self.color_yellow = colorama.Fore.YELLOW
         self.color_reset = colorama.Style.RESET_ALL
 
         # Load device configurations
-        self.devices = self.load_device_config()
+        self.devices = devices if devices is not None else self.load_device_config()
         if not self.devices:
             print(f"{self.color_red}No supported devices found. Exiting.{self.color_reset}")
             sys.exit(1)
+        self.device_index = DeviceCatalog.index(self.devices)
         self.current_device = None
         self.boot_partitions = []
         self.vbmeta_partitions = []
@@ -51,7 +108,7 @@ class Flash:
         self.logical_partitions = []
         self.firmware_partitions = []
         self.disable_avb = False
-    def set_current_device(self, device):
+    def set_current_device(self, device, verify=True):
         self.current_device = device
         self.boot_partitions = device['partitions'].get('boot', [])
         self.firmware_partitions = device['partitions'].get('firmware', [])
@@ -60,16 +117,23 @@ class Flash:
         self.slot_specific_partitions = device.get('slot_specific', [])
         
         # New board verification
-        self.verify_board_compatibility()
+        if verify:
+            self.verify_board_compatibility()
+        if self.delta:
+            board = device.get("board", device.get("codename", device["model"]))
+            name = re.sub(r'[^A-Za-z0-9_.-]', '_', f"{self.device_serial or 'unknown'}_{board}")
+            self.manifest = FlashManifest(os.path.join(self.state_dir, "manifests", f"{name}.json"))
 
     def verify_board_compatibility(self):
         if "board" not in self.current_device:
             return
 
         try:
-            result = self.run_command([self.fastboot_path, "getvar", "product"])
-            product_line = [line for line in result.stdout.splitlines() if line.startswith("product:")][0]
-            current_board = product_line.split(":")[1].strip()
+            current_board = self.device_var("product")
+            if current_board is None:
+                result = self.run_command([self.fastboot_path, "getvar", "product"])
+                product_line = [line for line in result.stdout.splitlines() if line.startswith("product:")][0]
+                current_board = product_line.split(":")[1].strip()
         except Exception as e:
             print(f"{self.color_red}Failed to verify device board: {str(e)}{self.color_reset}")
             return
@@ -79,25 +143,28 @@ class Flash:
             print(f"\n{self.color_red}WARNING: BOARD MISMATCH DETECTED!{self.color_reset}")
             print(f"Expected board: {expected_board}")
             print(f"Current board: {current_board}")
-            if not self.prompt_yes_no("Continue flashing despite board mismatch?", default_yes=False):
+            if not self.prompt_yes_no("Continue flashing despite board mismatch?", default_yes=False, key="board_mismatch"):
                 print(f"{self.color_red}Aborting flash procedure{self.color_reset}")
-                sys.exit(1)
+                sys.exit(self.EXIT_WRONG_DEVICE)
 
     def load_device_config(self) -> List[Dict]:
         try:
-            url = "https://raw.githubusercontent.com/PHATWalrus/universal-flasher/refs/heads/main/devices.json"
-            response = requests.get(url)
-            response.raise_for_status()
-            return json.loads(response.text)["devices"]
+            return DeviceCatalog(os.path.join(self.state_dir, "catalog")).load()
         except Exception as e:
             print(f"{self.color_red}Failed to load device config: {str(e)}{self.color_reset}")
             print(f"{self.color_yellow}Please check your internet connection or the repository URL{self.color_reset}")
             sys.exit(1)
 
-    def select_device(self):
+    def find_device(self, name):
+        return self.device_index.get(name.lower())
+
+    def select_device(self, verify=True):
         if not self.devices:
             print(f"{self.color_red}No supported devices found. Exiting.{self.color_reset}")
             sys.exit(1)
+        if self.headless:
+            print(f"{self.color_red}{self.tag}Cannot pick a device without a prompt, set \"device\" in the profile{self.color_reset}")
+            sys.exit(self.EXIT_WRONG_DEVICE)
         
         print(f"\n{self.color_green}## SUPPORTED DEVICES ##{self.color_reset}")
         for i, device in enumerate(self.devices, 1):
@@ -109,7 +176,7 @@ class Flash:
                 if 1 <= choice <= len(self.devices):
                     self.current_device = self.devices[choice - 1]
                     print(f"{self.color_green}Selected device: {self.current_device['model']}{self.color_reset}")
-                    self.set_current_device(self.current_device)
+                    self.set_current_device(self.current_device, verify=verify)
                     break
                 else:
                     print(f"{self.color_red}Invalid choice. Please try again.{self.color_reset}")
@@ -117,8 +184,8 @@ class Flash:
                 print(f"{self.color_red}Invalid input. Please enter a number.{self.color_reset}")
 
 
-    def get_platform_tools_url(self):
-        base_url = "https://dl.google.com/android/repository/platform-tools-latest-"
+    def get_platform_tools_url(self, base_url=None):
+        base_url = (base_url or "https://dl.google.com/android/repository/").rstrip("/") + "/platform-tools-latest-"
         if self.system == "windows":
             return f"{base_url}windows.zip"
         elif self.system == "linux":
@@ -139,17 +206,24 @@ class Flash:
         self.validate_tools()
 
     def start_spinner(self):
+        if not self.spinner_enabled:
+            return
         if not self.spinner_running:
             self.spinner_running = True
             spinner_chars = ["⣾", "⣽", "⣻", "⢿", "⡿", "⣟", "⣯", "⣷"]
             def spin():
                 i = 0
                 while self.spinner_running:
-                    sys.stdout.write(f"\r{self.color_yellow}{spinner_chars[i % len(spinner_chars)]} Working...{self.color_reset}")
-                    sys.stdout.flush()
+                    # Live transfer status when fastboot is sending something, a plain spinner otherwise
+                    status = self.progress.status() or "Working..."
+                    line = f"{spinner_chars[i % len(spinner_chars)]} {status}"[:79]
+                    with self.progress.lock:
+                        sys.stdout.write(f"\r{self.color_yellow}{line.ljust(79)}{self.color_reset}")
+                        sys.stdout.flush()
                     time.sleep(0.1)
                     i += 1
-                sys.stdout.write("\r" + " " * 50 + "\r")
+                with self.progress.lock:
+                    sys.stdout.write("\r" + " " * 80 + "\r")
             self.spinner_thread = threading.Thread(target=spin, daemon=True)
             self.spinner_thread.start()
 
@@ -164,7 +238,7 @@ class Flash:
         try:
             if not self.is_admin() and not self.check_system_tools():
                 print(f"{self.color_yellow}Admin rights required for system modifications{self.color_reset}")
-                if self.prompt_yes_no("Restart with admin privileges?", default_yes=True):
+                if self.prompt_yes_no("Restart with admin privileges?", default_yes=True, key="admin_restart"):
                     self.run_as_admin()
                     exit(1)
             
@@ -187,49 +261,28 @@ class Flash:
             sys.exit(1)
 
     def setup_bundled_tools(self):
+        # Only needed when platform-tools have to be fetched, keep them off the startup path
+        import requests
+        import tarfile
+        import zipfile
         print(f"{self.color_yellow}Setting up bundled platform tools...{self.color_reset}")
-        if self.system == "windows":
-            tools_dir = self.install_path
-        else:
-            tools_dir = os.path.join(self.work_dir, "platform-tools")
-        
-        if not os.path.exists(tools_dir):
-            self.download_and_extract_tools(tools_dir)
-        
-        self.fastboot_path = os.path.join(tools_dir, "platform-tools", "fastboot")
-        if self.system == "windows":
-            self.fastboot_path += ".exe"
-
-    def download_and_extract_tools(self, extract_dir):
-        os.makedirs(extract_dir, exist_ok=True)
-        download_path = os.path.join(extract_dir, 
-                                   "platform-tools.zip" if self.system == "windows" 
-                                   else "platform-tools.zip")
-        
+        cache = ToolsCache(os.path.join(self.state_dir, "platform-tools"), self.platform_tools_url,
+                           sha256=self.tools_sha256)
         try:
-            with requests.get(self.platform_tools_url, stream=True) as r:
-                r.raise_for_status()
-                with open(download_path, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-
+            tools_dir = cache.ensure(self.min_version)
             if self.system == "windows":
-                with zipfile.ZipFile(download_path) as zip_ref:
-                    zip_ref.extractall(extract_dir)
-            else:
-                with zipfile.ZipFile(download_path) as zip_ref:
-                    zip_ref.extractall(extract_dir)
-            
-            if self.system != "windows":
-                bin_path = os.path.join(extract_dir, "platform-tools", "fastboot")
-                st = os.stat(bin_path)
-                os.chmod(bin_path, st.st_mode | stat.S_IEXEC)
-        except Exception as e:
-            print(f"{self.color_red}Extraction failed: {str(e)}{self.color_reset}")
+                # The system-wide install in C:\adb is what ends up on PATH
+                install_dir = os.path.join(self.install_path, "platform-tools")
+                if not os.path.exists(install_dir):
+                    shutil.copytree(tools_dir, install_dir)
+                tools_dir = install_dir
+        except (OSError, ValueError, requests.RequestException, zipfile.BadZipFile, tarfile.TarError) as e:
+            print(f"{self.color_red}Platform tools setup failed: {str(e)}{self.color_reset}")
             sys.exit(1)
-        finally:
-            if os.path.exists(download_path):
-                os.remove(download_path)
+
+        self.fastboot_path = os.path.join(tools_dir, "fastboot")
+        if self.system == "windows":
+            self.fastboot_path += ".exe"
 
     def add_to_system_path(self, path):
         try:
@@ -257,10 +310,13 @@ class Flash:
 
     def validate_tools(self):
         try:
-            result = self.run_command([self.fastboot_path, "--version"])
-            if result.returncode != 0:
+            # Answered from the version cache when check_system_tools already probed this binary
+            output = self.tool_versions.output(self.fastboot_path, ["--version"])
+            self.tool_versions.save()
+            if output is None:
                 raise Exception("Fastboot validation failed")
-            print(f"{self.color_green}Fastboot verified: {result.stdout.strip()}{self.color_reset}")
+            self.log_record("tool", path=self.fastboot_path, output=output.strip())
+            print(f"{self.color_green}Fastboot verified: {output.strip()}{self.color_reset}")
         except Exception as e:
             print(f"{self.color_red}Fastboot error: {str(e)}{self.color_reset}")
             sys.exit(1)
@@ -268,14 +324,19 @@ class Flash:
         """Check for existing system tools and validate versions"""
         #print(f"{self.color_green}Checking system tools...{self.color_reset}")
         
+        # Probe fastboot and adb side by side, repeat launches answer from the version cache
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            fastboot_path, adb_path = pool.map(self.check_tool_version, ["fastboot", "adb"])
+        self.tool_versions.save()
+
         # Check for fastboot
-        self.fastboot_path = self.check_tool_version("fastboot")
+        self.fastboot_path = fastboot_path
         if not self.fastboot_path:
             print(f"{self.color_yellow}System fastboot not found or outdated{self.color_reset}")
             return False
         
         # Check for adb
-        self.adb_path = self.check_tool_version("adb")
+        self.adb_path = adb_path
         if not self.adb_path:
             print(f"{self.color_yellow}System ADB not found or outdated{self.color_reset}")
             return False
@@ -289,17 +350,14 @@ class Flash:
         
         try:
             if tool=="fastboot":
-                result = subprocess.run([tool, "--version"], 
-                                    capture_output=True, 
-                                    text=True)
-                version_match = re.search(r"(\d+\.\d+\.\d+)", result.stdout)
+                output = self.tool_versions.output(path, ["--version"]) or ""
+                version_match = re.search(r"(\d+\.\d+\.\d+)", output)
             elif tool=="adb":
-                result = subprocess.run([tool, "version"], 
-                                    capture_output=True, 
-                                    text=True)
-                version_match = re.search(r"(\d+\.\d+\.\d+)-", result.stdout)
+                output = self.tool_versions.output(path, ["version"]) or ""
+                version_match = re.search(r"(\d+\.\d+\.\d+)-", output)
 
-            if version_match and version.parse(version_match.group(1)) >= self.min_version:
+            from packaging import version
+            if version_match and version.parse(version_match.group(1)) >= version.parse(self.min_version):
                 #print(f"{self.color_green}Using system {tool} v{version_match.group(1)}{self.color_reset}")
                 return path
         except Exception as e:
@@ -327,7 +385,7 @@ class Flash:
 
     def ask_slot_selection(self):
         print(f"\n{self.color_green}## SLOT SELECTION ##{self.color_reset}")
-        if self.prompt_yes_no("Flash partitions to both slots (A/B)?", default_yes=True):
+        if self.prompt_yes_no("Flash partitions to both slots (A/B)?", default_yes=True, key="slot_both"):
             self.slot = "both"
             print(f"{self.color_yellow}Selected: Flash to both slots{self.color_reset}")
         else:
@@ -336,24 +394,37 @@ class Flash:
 
     def check_prerequisites(self):
         checks = [
-            ("Is your device bootloader unlocked?", True),
-            ("Is your device in fastboot mode?", True),
-            ("Are USB drivers properly configured?", True)
+            ("Is your device bootloader unlocked?", True, "bootloader_unlocked"),
+            ("Is your device in fastboot mode?", True, "fastboot_mode"),
+            ("Are USB drivers properly configured?", True, "usb_drivers")
         ]
         
-        for question, required in checks:
-            if not self.prompt_yes_no(question):
+        for question, required, key in checks:
+            if not self.prompt_yes_no(question, key=key):
                 if required:
                     print(f"{self.color_red}Essential requirement not met{self.color_reset}")
                     print(f"{self.color_yellow}Visit: https://developer.android.com/tools/device")
                     sys.exit(1)
                 print(f"{self.color_yellow}Warning: This might cause issues{self.color_reset}")
 
+    def list_devices(self):
+        if self.native:
+            try:
+                devices = self.native.list_devices()
+                if devices or self.backend == "native":
+                    return devices
+            except FastbootError as e:
+                if self.backend == "native":
+                    raise
+                print(f"{self.color_yellow}Native backend unavailable ({str(e)}), using fastboot binary{self.color_reset}")
+                self.native = None
+        result = self.run_command([self.fastboot_path, "devices"])
+        return [line.split()[0] for line in result.stdout.splitlines()
+                if "fastboot" in line.lower()]
+
     def device_checks(self):
         try:
-            result = self.run_command([self.fastboot_path, "devices"])
-            devices = [line.split()[0] for line in result.stdout.splitlines() 
-                      if "fastboot" in line.lower()]
+            devices = self.list_devices()
             
             if not devices:
                 print(f"{self.color_red}No devices detected{self.color_reset}")
@@ -361,24 +432,64 @@ class Flash:
                 print("2. Check USB connection")
                 if self.system == "linux":
                     print("3. Verify udev rules")
-                sys.exit(1)
+                sys.exit(self.EXIT_NO_DEVICE)
             
-            print(f"{self.color_green}Connected device: {devices[0]}{self.color_reset}")
-            self.select_device()
+            if self.serial and self.serial not in devices:
+                print(f"{self.color_red}Device {self.serial} not found{self.color_reset}")
+                sys.exit(self.EXIT_NO_DEVICE)
+            self.device_serial = self.serial or devices[0]
+            print(f"{self.color_green}Connected device: {self.device_serial}{self.color_reset}")
+            userspace = self.device_var("is-userspace")
+            if userspace is None:
+                self.watcher.poll()
+            else:
+                self.watcher.observe(DeviceWatcher.FASTBOOTD if userspace == "yes" else DeviceWatcher.BOOTLOADER)
+            if self.profile and self.profile.device != "auto":
+                self.set_current_device(self.find_device(self.profile.device))
+                return
+            device = self.detect_device()
+            if device:
+                self.set_current_device(device, verify=False)
+            else:
+                self.select_device()
             
         except Exception as e:
             print(f"{self.color_red}Device check failed: {str(e)}{self.color_reset}")
             sys.exit(1)
     
-    def handle_super_partitions(self):
+    def load_device_vars(self):
+        """One getvar all per boot of the device; later phases read this map instead of asking again"""
+        if self.device_vars is None:
+            self.device_vars = {}
+            try:
+                result = self.run_command([self.fastboot_path, "getvar", "all"])
+            except subprocess.CalledProcessError:
+                return self.device_vars
+            self.device_vars = parse_getvar_all(result.stdout)
+        return self.device_vars
+
+    def device_var(self, name):
+        return self.load_device_vars().get(name)
+
+    def detect_device(self):
+        """Catalog entry matching the board the device reports, None when it has to be picked by hand"""
+        product = self.device_var("product")
+        device = self.find_device(product) if product else None
+        if device:
+            print(f"{self.color_green}Detected device: {device['model']} (board {product}){self.color_reset}")
+        elif product:
+            print(f"{self.color_yellow}Board {product} is not in the device list, select the device manually{self.color_reset}")
+        return device
+
+    def handle_super_partitions(self, build=False):
         print(f"\n{self.color_green}## HANDLING SUPER PARTITIONS ##{self.color_reset}")
-        exe_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
-        os.chdir(exe_dir)
+        if build:
+            return self.handle_built_super()
         
         super_files = []
-        if os.path.exists('super_empty.img'):
+        if self.rom.has('super_empty'):
             super_files.append('super_empty')
-        if os.path.exists('super.img'):
+        if self.rom.has('super'):
             super_files.append('super')
         
         # Prioritize super_empty first if both exist
@@ -387,6 +498,9 @@ class Flash:
         if not super_files:
             print(f"{self.color_yellow}No super partitions found{self.color_reset}")
             return False
+        if self.delta_unchanged(super_files):
+            print(f"{self.color_yellow}Super image unchanged since last flash, skipping{self.color_reset}")
+            return True
         
         try:
             self.start_spinner()
@@ -401,6 +515,79 @@ class Flash:
             print(f"{self.color_red}Error flashing super partitions: {str(e)}{self.color_reset}")
             sys.exit(1)
 
+    def super_layout(self):
+        """The device's super layout from the catalog, None (with a warning) when it is missing or incomplete"""
+        layout = self.current_device.get("super") or {}
+        missing = [key for key in self.SUPER_LAYOUT_KEYS if key not in layout]
+        if missing:
+            print(f"{self.color_yellow}{self.tag}Not building super: devices.json has no {', '.join(missing)} for "
+                  f"{self.current_device['model']}, flashing the logical images in fastbootd instead{self.color_reset}")
+            return None
+        return layout
+
+    def get_super_geometry(self):
+        layout = self.super_layout()
+        if layout is None:
+            return None
+        geometry = dict(layout)
+        try:
+            size = self.device_var("partition-size:super")
+            if size is None:
+                result = self.run_command([self.fastboot_path, "getvar", "partition-size:super"])
+                match = re.search(r"partition-size:super:\s*(\S+)", result.stdout)
+                size = match.group(1) if match else None
+            if size:
+                geometry["size"] = int(size, 0)
+        except (subprocess.CalledProcessError, ValueError):
+            pass
+        return geometry if geometry.get("size") else None
+
+    def handle_built_super(self):
+        """Build super locally from the logical images and flash it from the bootloader"""
+        if self.rom.has('super'):
+            return False
+        geometry = self.get_super_geometry()
+        if not geometry:
+            # The plan chose this step because the geometry was known; nothing else flashes the logical images now
+            print(f"{self.color_red}Super geometry unknown, cannot build super{self.color_reset}")
+            sys.exit(1)
+        logical_files = self.filter_existing(self.logical_partitions)
+        self.display_missing_report(self.get_missing_partitions(self.logical_partitions), "logical")
+        if not self.confirm_flash(logical_files, "logical"):
+            sys.exit(1)
+        if not logical_files:
+            return False
+
+        fd, metadata_path = tempfile.mkstemp(suffix=".img")
+        os.close(fd)
+        try:
+            builder = SuperImageBuilder(
+                geometry["size"],
+                [(part, self.rom.image(part) if part in logical_files else None) for part in self.logical_partitions],
+                group=geometry["group"],
+                slot_suffixes=["_a", "_b"] if self.slot_specific_partitions else [""],
+                metadata_size=geometry.get("metadata_size", 65536),
+                metadata_slots=geometry["metadata_slots"],
+                group_size=geometry.get("group_size"),
+                virtual_ab=geometry["virtual_ab"])
+            print(f"{self.color_yellow}Building super image from {len(logical_files)} logical images...{self.color_reset}")
+            image = builder.build(metadata_path)
+            if self.manifest:
+                self.manifest.forget_partitions(self.logical_partitions + ["super", "super_empty"])
+            if self.journal:
+                self.journal.forget_partitions(self.logical_partitions + ["super", "super_empty"])
+            self.start_spinner()
+            limit = self.transfer_limit() or image.size()
+            self.flash_sparse("super", "super.img (built)", image.split(limit))
+            self.stop_spinner()
+            return True
+        except ValueError as e:
+            self.stop_spinner()
+            print(f"{self.color_red}Cannot build super image: {str(e)}{self.color_reset}")
+            sys.exit(1)
+        finally:
+            os.remove(metadata_path)
+
     def flash_procedure(self):
         if self.spinner_running:
             self.spinner_running = False
@@ -408,40 +595,23 @@ class Flash:
                 self.spinner_thread.join(timeout=0.3)
             time.sleep(0.1)
         try:
-            self.ask_slot_selection()
-            self.run_command([self.fastboot_path, "--set-active=a"])
-            
-            if self.prompt_yes_no("Wipe user data? (Recommended for clean install)"):
-                if self.confirm_operation("WIPE ALL USER DATA", dangerous=True):
-                    self.start_spinner()
-                    print(f"{self.color_yellow}Erasing userdata...{self.color_reset}")
-                    try:
-                        self.run_command([self.fastboot_path, "erase", "userdata"])
-                    except subprocess.CalledProcessError as e:
-                        print(f"{self.color_red}Failed to erase userdata: {e}{self.color_reset}")
-                        self.write_to_log(f"Error erasing userdata: {e.stderr}")
-                    
-                    print(f"{self.color_yellow}Erasing metadata...{self.color_reset}")
-                    try:
-                        self.run_command([self.fastboot_path, "erase", "metadata"])
-                    except subprocess.CalledProcessError as e:
-                        print(f"{self.color_red}Failed to erase metadata: {e}{self.color_reset}")
-                        self.write_to_log(f"Error erasing metadata: {e.stderr}")
-                    self.stop_spinner()
-
-            self.handle_boot_partitions()
-            self.handle_vbmeta()
-            self.handle_fastbootd_reboot()
-            sup_stat=self.handle_super_partitions()
-            #print (f"sup_stat={sup_stat}")
-            if sup_stat==False:
-                self.handle_logical_partitions()
-            self.handle_firmware()
-
-            if self.prompt_yes_no("Reboot to system?"):
-                self.start_spinner()
-                self.run_command([self.fastboot_path, "reboot"])
-                self.stop_spinner()
+            if isinstance(self.rom, DirectorySource):
+                # Pick up images copied in since the last menu action; unchanged ones are not read again
+                self.rom.inventory.scan()
+            self.open_journal()
+            self.collect_answers()
+            self.apply_tuning()
+            self.verify_images()
+            plan = self.plan_flash()
+            self.preflight_check()
+            if self.resume:
+                self.skip_completed(plan)
+            else:
+                self.journal.start(self.device_serial, self.current_device["model"], self.rom_path, dict(self.answers))
+            self.display_plan(plan)
+            plan.run(self)
+            self.journal.finish()
+            self.report.status = "ok"
 
             print(f"{self.color_green}\nFlashing completed successfully{self.color_reset}")
             self.generate_summary_report()
@@ -450,6 +620,315 @@ class Flash:
             self.stop_spinner()
             print(f"{self.color_red}Flashing error: {str(e)}{self.color_reset}")
             sys.exit(1)
+        finally:
+            self.write_report()
+            LogWriter.shared().flush()
+
+    def open_journal(self):
+        """Load this device's journal; with --resume take the answers of the unfinished flash from it"""
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', self.device_serial or "unknown")
+        self.journal = FlashJournal(os.path.join(self.state_dir, "journals", f"{name}.jsonl"))
+        if not self.resume:
+            if self.journal.unfinished():
+                print(f"{self.color_yellow}{self.tag}The last flash of this device did not finish, starting over "
+                      f"(--resume continues it instead){self.color_reset}")
+            return
+        data = self.journal.data
+        if not self.journal.unfinished():
+            print(f"{self.color_red}{self.tag}No unfinished flash recorded for this device{self.color_reset}")
+            sys.exit(self.EXIT_USAGE)
+        if data["device"] != self.current_device["model"]:
+            print(f"{self.color_red}{self.tag}The unfinished flash was for a {data['device']}{self.color_reset}")
+            sys.exit(self.EXIT_WRONG_DEVICE)
+        if data["rom"] != self.rom_path:
+            print(f"{self.color_red}{self.tag}The unfinished flash was from {data['rom']}{self.color_reset}")
+            sys.exit(self.EXIT_USAGE)
+        self.answers.update(data["answers"])
+        print(f"{self.color_green}{self.tag}Resuming the flash started {data['started']} "
+              f"({len(data['steps'])} step(s), {len(data['flashed'])} image(s) done){self.color_reset}")
+
+    def skip_completed(self, plan):
+        """Drop the steps the journal has as done, unless their images changed or the device no longer reflects them"""
+        done = []
+        for step in plan.steps:
+            if step["name"] not in self.journal.data["steps"]:
+                continue
+            if step["name"] == "handle_set_active" and self.device_var("current-slot") not in (None, self.active_slot):
+                continue
+            if any(not self.journal_matches(entry["partition"], entry["digest"])
+                   for entry in self.journal.step_targets(step["name"])):
+                continue
+            done.append(step)
+        for step in done:
+            print(f"{self.color_yellow}{self.tag}Already done: {step['title']}{self.color_reset}")
+        plan.steps = [step for step in plan.steps if step not in done]
+
+    def journal_matches(self, part, recorded):
+        """Whether the image is still the one the journal recorded"""
+        if not recorded or not self.rom.has(part):
+            return False
+        if recorded == self.rom.identity(part):
+            return True
+        # A sha256 that was known then but is not cached any more: only --resume asks, so reading the image is fine
+        return ":" not in recorded and recorded == self.image_digest(part)
+
+    def collect_answers(self, unattended=False):
+        """Ask every question up front so the whole plan is known before the device is touched"""
+        self.ask_slot_selection()
+        if self.prompt_yes_no("Wipe user data? (Recommended for clean install)", key="wipe"):
+            self.confirm_operation("WIPE ALL USER DATA", dangerous=True, key="wipe_confirm")
+        self.prompt_yes_no("Disable Android Verified Boot (AVB)?", key="disable_avb")
+        if not self.confirm_flash(self.filter_existing(self.boot_partitions), "boot"):
+            if unattended:
+                self.answers["abort_boot"] = False
+            elif self.prompt_yes_no("Abort entire flashing process?", key="abort_boot"):
+                sys.exit(1)
+        categories = ["firmware"]
+        # A full super image replaces the logical images unless it is built from them
+        if not self.rom.has('super') and (self.build_super or not self.rom.has('super_empty')):
+            categories.insert(0, "logical")
+        for category in categories:
+            partitions = getattr(self, f"{category}_partitions")
+            self.display_missing_report(self.get_missing_partitions(partitions), category)
+            if not self.confirm_flash(self.filter_existing(partitions), category):
+                print(f"{self.color_red}Aborting flash procedure{self.color_reset}")
+                sys.exit(1)
+        self.prompt_yes_no("Reboot to system?", key="reboot")
+
+    def plan_flash(self, probe=True):
+        """Turn the answers and the ROM contents into an ordered plan with as few reboots as possible"""
+        start_mode = FlashPlan.BOOTLOADER
+        if probe and (self.watcher.state or self.watcher.poll()) == DeviceWatcher.FASTBOOTD:
+            start_mode = FlashPlan.FASTBOOTD
+        plan = FlashPlan(start_mode)
+        # Physical partitions can be written from either mode, only logical ones need fastbootd
+        plan.add(FlashPlan.ANY, "Set active slot a", self.handle_set_active)
+        if self.answers.get("wipe") and self.answers.get("wipe_confirm"):
+            plan.add(FlashPlan.ANY, "Erase userdata and metadata", self.handle_wipe, commands=2)
+        if self.answers.get("flash_boot"):
+            sizes = self.planned_sizes(self.boot_partitions)
+            if sizes:
+                plan.add(FlashPlan.ANY, f"Flash {len(sizes)} boot image(s)", self.handle_boot_partitions,
+                         sum(sizes), len(sizes))
+        vbmeta = self.filter_existing(self.vbmeta_partitions)
+        if vbmeta:
+            plan.add(FlashPlan.ANY, f"Flash {', '.join(vbmeta)}", self.handle_vbmeta,
+                     sum(self.rom.size(part) for part in vbmeta), len(vbmeta))
+        if self.answers.get("flash_firmware"):
+            sizes = self.planned_sizes(self.firmware_partitions)
+            if sizes:
+                plan.add(FlashPlan.ANY, f"Flash {len(sizes)} firmware image(s)", self.handle_firmware,
+                         sum(sizes), len(sizes))
+        self.plan_super(plan, probe)
+        if self.answers.get("reboot"):
+            plan.add(FlashPlan.ANY, "Reboot to system", self.handle_system_reboot, final=True)
+        return plan
+
+    def plan_super(self, plan, probe=True):
+        logical = self.filter_existing(self.logical_partitions)
+        resize_commands = 6 * len(self.logical_partitions)
+        if self.build_super and not self.rom.has('super') and logical and self.answers.get("flash_logical"):
+            # Without the device the size of super is unknown, assume it can be asked for later
+            if self.get_super_geometry() if probe else self.super_layout():
+                plan.add(FlashPlan.BOOTLOADER, f"Build super from {len(logical)} logical image(s) and flash it",
+                         lambda: self.handle_super_partitions(build=True),
+                         sum(self.rom.size(part) for part in logical), name="handle_super_partitions")
+                return
+        super_files = [part for part in ['super_empty', 'super'] if self.rom.has(part)]
+        if super_files:
+            if self.delta_unchanged(super_files):
+                print(f"{self.color_yellow}Super image unchanged since last flash, skipping{self.color_reset}")
+                return
+            plan.add(FlashPlan.FASTBOOTD, f"Resize logical partitions and flash {', '.join(super_files)}",
+                     self.handle_super_partitions,
+                     sum(self.rom.size(part) for part in super_files),
+                     len(super_files) + resize_commands)
+        elif logical and self.answers.get("flash_logical"):
+            if self.delta_unchanged(logical):
+                print(f"{self.color_yellow}Logical partitions unchanged since last flash, skipping{self.color_reset}")
+                return
+            sizes = self.planned_sizes(self.logical_partitions)
+            plan.add(FlashPlan.FASTBOOTD, f"Resize logical partitions and flash {len(sizes)} logical image(s)",
+                     self.handle_logical_partitions, sum(sizes), len(sizes) + resize_commands)
+
+    def preflight_check(self, probe=True):
+        """Parse the header of every image about to be flashed and reject the run before the first write"""
+        print(f"\n{self.color_green}## PRE-FLIGHT CHECK ##{self.color_reset}")
+        expected = {"boot": "boot", "recovery": "boot", "init_boot": "boot", "vendor_boot": "vendor_boot",
+                    "dtbo": "dtbo"}
+        # preloader_raw rides along with the vbmeta images on MediaTek but is not an AVB image
+        expected.update((part, "vbmeta") for part in self.vbmeta_partitions if part.startswith("vbmeta"))
+        parts = list(self.vbmeta_partitions)
+        for category in ["boot", "firmware", "logical"]:
+            if self.answers.get(f"flash_{category}", True):
+                parts += getattr(self, f"{category}_partitions")
+        parts = self.filter_existing(dict.fromkeys(parts + ["super"]))
+        sizes = {}
+        if probe:
+            for name, value in self.load_device_vars().items():
+                if name.startswith("partition-size:"):
+                    try:
+                        sizes[name[len("partition-size:"):]] = int(value, 0)
+                    except ValueError:
+                        pass
+
+        def inspect(part):
+            try:
+                return self.rom.header(part)
+            except (OSError, ValueError, struct.error) as e:
+                return {"error": str(e)}
+        problems, warnings = [], []
+        with self.report.span("preflight", "phase"), ThreadPoolExecutor(max_workers=min(8, len(parts) or 1)) as pool:
+            headers = dict(zip(parts, pool.map(inspect, parts)))
+            for part, info in headers.items():
+                if "error" in info:
+                    problems.append(f"{part}.img: {info['error']}")
+                    continue
+                if part in expected and info["kind"] not in (expected[part], "sparse"):
+                    problems.append(f"{part}.img is not a {expected[part]} image")
+                if info["content"] > self.rom.size(part):
+                    problems.append(f"{part}.img is truncated: its header describes {info['content']} bytes")
+                if part in self.logical_partitions or part == "super":
+                    continue
+                for target, slot in self.flash_targets(part):
+                    # Slotted partitions only report their _a/_b sizes, also when flashed without a suffix
+                    limit = sizes.get(target, sizes.get(f"{part}_{slot}", sizes.get(part)))
+                    if limit is not None and info["size"] > limit:
+                        problems.append(f"{part}.img ({info['size']} bytes) does not fit {target} ({limit} bytes)")
+            super_size = sizes.get("super") or (self.current_device.get("super") or {}).get("size")
+            if super_size:
+                logical = [part for part in headers if part in self.logical_partitions and "error" not in headers[part]]
+                if "super" in headers and "error" not in headers["super"]:
+                    logical = ["super"]
+                total = sum(headers[part]["size"] for part in logical)
+                if total > super_size:
+                    problems.append(f"{', '.join(logical)} need {total} bytes, super holds {super_size}")
+
+            # A vbmeta from another build lists digests that do not match the boot images next to it
+            jobs = []
+            for part in self.vbmeta_partitions:
+                if headers.get(part, {}).get("kind") != "vbmeta":
+                    continue
+                try:
+                    descriptors = ImageHeader.hash_descriptors(self.rom.image(part))
+                except (OSError, ValueError, struct.error) as e:
+                    problems.append(f"{part}.img: unreadable descriptors ({str(e)})")
+                    continue
+                for name, size, algorithm, salt, digest in descriptors:
+                    if name in headers and headers[name].get("kind") != "sparse":
+                        jobs.append((part, name, size, algorithm, salt, digest))
+            def verify(job):
+                part, name, size, algorithm, salt, digest = job
+                try:
+                    return ImageHeader.avb_digest(self.rom.image(name), size, algorithm, salt) == digest
+                except ValueError:
+                    return False
+            for (part, name, *_), matches in zip(jobs, pool.map(verify, jobs)):
+                if not matches:
+                    message = f"{name}.img does not match the digest in {part}.img"
+                    (warnings if self.answers.get("disable_avb") else problems).append(message)
+
+        print(f"Checked {len(headers)} image(s) against {len(sizes)} partition size(s) and {len(jobs)} AVB digest(s)")
+        for message in warnings:
+            print(f"{self.color_yellow}{self.tag}Warning: {message} (AVB verification is disabled){self.color_reset}")
+        for message in problems:
+            print(f"{self.color_red}{self.tag}{message}{self.color_reset}")
+        self.log_record("preflight", images=len(headers), partition_sizes=len(sizes), problems=problems,
+                        warnings=warnings)
+        if problems:
+            print(f"{self.color_red}{self.tag}Pre-flight check failed, nothing was written to the device{self.color_reset}")
+            sys.exit(self.EXIT_BAD_IMAGE)
+
+    def verify_images(self):
+        """Wait for the background check against the build's sha256 manifest; a corrupt image stops the flash"""
+        if not self.verifier:
+            return
+        parts = []
+        for names in self.current_device["partitions"].values():
+            parts += names
+        parts = list(dict.fromkeys(parts + ["super", "super_empty"]))
+        label = os.path.basename(self.verifier.label)
+        start = time.time()
+        shown = False
+        def progress(hashed, total):
+            nonlocal shown
+            shown = True
+            print(f"\r{self.tag}Verifying images against {label}: {FlashPlan.format_size(hashed)} of "
+                  f"{FlashPlan.format_size(total)}", end="", flush=True)
+        results = self.verifier.wait(parts, progress if self.spinner_enabled else None)
+        if shown:
+            print()
+        problems = []
+        for part, digest in results.items():
+            if isinstance(digest, OSError):
+                problems.append(f"{part}.img could not be read: {str(digest)}")
+            elif digest != self.verifier.expected[part]:
+                problems.append(f"{part}.img does not match its sha256 in {label}")
+            else:
+                self.digests.setdefault(image_label(self.rom.image(part)), digest)
+        unlisted = [part for part in self.filter_existing(parts) if part not in self.verifier.expected]
+        print(f"Verified {len(results) - len(problems)} of {len(results)} image(s) against {label} "
+              f"(waited {time.time() - start:.1f}s)")
+        if unlisted:
+            print(f"{self.color_yellow}{self.tag}Not listed in {label}, not verified: {', '.join(unlisted)}{self.color_reset}")
+        for message in problems:
+            print(f"{self.color_red}{self.tag}{message}{self.color_reset}")
+        self.log_record("verify", manifest=self.verifier.label, images=len(results), problems=problems,
+                        unlisted=unlisted)
+        if problems:
+            print(f"{self.color_red}{self.tag}Image verification failed, nothing was written to the device{self.color_reset}")
+            sys.exit(self.EXIT_BAD_IMAGE)
+
+    def planned_sizes(self, partitions):
+        """Size of every image a flash of these partitions would send, minus what delta mode skips"""
+        sizes = []
+        for part in self.filter_existing(partitions):
+            for target, slot in self.flash_targets(part):
+                if self.manifest and not self.force_flash and \
+                        self.manifest.matches(target, self.image_digest(part), slot):
+                    continue
+                sizes.append(self.rom.size(part))
+        return sizes
+
+    def display_plan(self, plan):
+        total, switches, seconds = plan.estimate()
+        print(f"\n{self.color_green}## FLASH PLAN: {self.current_device['model']} ##{self.color_reset}")
+        print(f"Starting in {plan.start_mode}")
+        for i, step in enumerate(plan.ordered(), 1):
+            color = self.color_yellow if step["switch"] else self.color_green
+            size = f" ({FlashPlan.format_size(step['size'])})" if step["size"] else ""
+            print(f"{color}{i:2}. [{step['mode']}] {step['title']}{size}{self.color_reset}")
+        minutes, secs = divmod(int(seconds), 60)
+        print(f"{self.color_yellow}Estimated: {FlashPlan.format_size(total)} to send, "
+              f"{switches} mode switch(es), about {minutes}m {secs:02d}s{self.color_reset}")
+
+    def handle_set_active(self):
+        self.run_command([self.fastboot_path, "--set-active=a"])
+        self.active_slot = "a"
+        if self.device_vars:
+            self.device_vars["current-slot"] = "a"
+
+    def handle_wipe(self):
+        self.start_spinner()
+        print(f"{self.color_yellow}Erasing userdata...{self.color_reset}")
+        try:
+            self.run_command([self.fastboot_path, "erase", "userdata"])
+        except subprocess.CalledProcessError as e:
+            print(f"{self.color_red}Failed to erase userdata: {e}{self.color_reset}")
+            self.write_to_log(f"Error erasing userdata: {e.stderr}")
+
+        print(f"{self.color_yellow}Erasing metadata...{self.color_reset}")
+        try:
+            self.run_command([self.fastboot_path, "erase", "metadata"])
+        except subprocess.CalledProcessError as e:
+            print(f"{self.color_red}Failed to erase metadata: {e}{self.color_reset}")
+            self.write_to_log(f"Error erasing metadata: {e.stderr}")
+        self.stop_spinner()
+
+    def handle_system_reboot(self):
+        self.start_spinner()
+        self.run_command([self.fastboot_path, "reboot"])
+        self.stop_spinner()
 
     def handle_boot_partitions(self):
         if self.spinner_running:
@@ -459,7 +938,7 @@ class Flash:
             time.sleep(0.1)
         boot_files = self.filter_existing(self.boot_partitions)
         if not self.confirm_flash(boot_files, "boot"):
-            if self.prompt_yes_no("Abort entire flashing process?"):
+            if self.prompt_yes_no("Abort entire flashing process?", key="abort_boot"):
                 sys.exit(1)
             return
         self.start_spinner()
@@ -472,16 +951,19 @@ class Flash:
             if self.spinner_thread.is_alive():
                 self.spinner_thread.join(timeout=0.3)
             time.sleep(0.1)
-        self.disable_avb = self.prompt_yes_no("Disable Android Verified Boot (AVB)?")
+        self.disable_avb = self.prompt_yes_no("Disable Android Verified Boot (AVB)?", key="disable_avb")
         avb_flags = ["--disable-verity", "--disable-verification"] if self.disable_avb else []
         
         self.start_spinner()
         for part in self.vbmeta_partitions:
-            img_file = f"{part}.img"
-            if part == "preloader_raw":
-                self.run_command([self.fastboot_path, "flash"] + ["preloader", img_file])
-            if os.path.exists(img_file):
+            if not self.rom.has(part):
+                continue
+            with self.materialize(self.rom.image(part)) as img_file:
+                if part == "preloader_raw":
+                    self.run_command([self.fastboot_path, "flash"] + ["preloader", img_file])
                 self.run_command([self.fastboot_path, "flash"] + avb_flags + [part, img_file])
+            if self.journal:
+                self.journal.record_flash(self.phase, part, part, self.rom.identity(part), self.active_slot)
         self.stop_spinner()
 
     def handle_fastbootd_reboot(self):
@@ -493,8 +975,40 @@ class Flash:
         print(f"\n{self.color_green}## REBOOTING TO FASTBOOTD ##{self.color_reset}")
         self.start_spinner()
         self.run_command([self.fastboot_path, "reboot", "fastboot"])
+        # fastbootd reports its own download buffer size and variables
+        self.max_download_size = None
+        self.device_vars = None
+        self.wait_for_state(DeviceWatcher.FASTBOOTD)
+        self.stop_spinner()
+
+    def handle_bootloader_reboot(self):
+        print(f"\n{self.color_green}## REBOOTING TO BOOTLOADER ##{self.color_reset}")
+        self.start_spinner()
+        self.run_command([self.fastboot_path, "reboot", "bootloader"])
+        self.max_download_size = None
+        self.device_vars = None
+        self.wait_for_state(DeviceWatcher.BOOTLOADER)
         self.stop_spinner()
 
+    def wait_for_state(self, state, timeout=None):
+        if not self.watcher.wait_for(state, timeout):
+            self.stop_spinner()
+            print(f"{self.color_red}{self.tag}Device did not reach {state} in time (last seen: {self.watcher.state}){self.color_reset}")
+            sys.exit(1)
+
+    def report_device_event(self, event):
+        if event["from"] is None:
+            change = f"found in {event['to']}"
+        elif event["to"] == DeviceWatcher.GONE:
+            change = f"gone (was {event['from']})"
+        elif event["from"] == DeviceWatcher.GONE:
+            change = f"back in {event['to']}"
+        else:
+            change = f"{event['from']} -> {event['to']}"
+        label = self.tag or (f"[{event['serial']}] " if event["serial"] else "")
+        print(f"{self.color_yellow}{label}Device {change}{self.color_reset}")
+        self.log_record("device", **{"from": event["from"], "to": event["to"]})
+
     def handle_logical_partitions(self):
         if self.spinner_running:
             self.spinner_running = False
@@ -507,6 +1021,9 @@ class Flash:
         self.display_missing_report(missing, "logical")
         if not self.confirm_flash(logical_files, "logical"):
             sys.exit(1)
+        if self.delta_unchanged(logical_files):
+            print(f"{self.color_yellow}Logical partitions unchanged since last flash, skipping resize{self.color_reset}")
+            return
         
         self.start_spinner()
         self.resize_partitions()
@@ -530,10 +1047,10 @@ class Flash:
         self.stop_spinner()
 
     def filter_existing(self, partitions):
-        return [p for p in partitions if os.path.exists(f"{p}.img")]
+        return [p for p in partitions if self.rom.has(p)]
 
     def get_missing_partitions(self, partitions):
-        return [p for p in partitions if not os.path.exists(f"{p}.img")]
+        return [p for p in partitions if not self.rom.has(p)]
 
     def display_missing_report(self, missing, category):
         if missing:
@@ -552,20 +1069,28 @@ class Flash:
             print(f"Missing {len(missing)} files:")
             for part in missing:
                 print(f" - {part}.img")
+            if self.profile and not self.profile.allows_missing(name):
+                print(f"{self.color_red}{self.tag}The profile does not allow missing {name} images{self.color_reset}")
+                sys.exit(self.EXIT_MISSING_IMAGES)
         
         if found_count == 0:
             print(f"No {name} files found in directory")
-            return self.prompt_yes_no(f"Continue without flashing {name} partitions?")
+            return self.prompt_yes_no(f"Continue without flashing {name} partitions?", key=f"flash_{name}")
             
-        return self.prompt_yes_no(f"Flash available {name} partitions?")
+        return self.prompt_yes_no(f"Flash available {name} partitions?", key=f"flash_{name}")
 
-    def confirm_operation(self, operation, dangerous=False):
+    def confirm_operation(self, operation, dangerous=False, key=None):
         color = self.color_red if dangerous else self.color_yellow
         print(f"\n{color}CONFIRM: {operation}?{self.color_reset}")
-        return self.prompt_yes_no("Type 'yes' to confirm", confirmation=True)
+        return self.prompt_yes_no("Type 'yes' to confirm", confirmation=True, key=key)
 
     def resize_partitions(self):
         print(f"{self.color_yellow}Resizing logical partitions...{self.color_reset}")
+        if self.manifest:
+            # Recreated partitions are empty, so nothing recorded for them (or super) holds anymore
+            self.manifest.forget_partitions(self.logical_partitions + ["super", "super_empty"])
+        if self.journal:
+            self.journal.forget_partitions(self.logical_partitions + ["super", "super_empty"])
         for part in self.logical_partitions:
             for slot in ["a", "b"]:
                 self.run_command([self.fastboot_path, "delete-logical-partition", f"{part}_{slot}-cow"])
@@ -577,64 +1102,401 @@ class Flash:
             print("No files to flash for this category")
             return
             
+        available = []
         for part in partitions:
-            img_file = f"{part}.img"
-            if not os.path.exists(img_file):
+            if not self.rom.has(part):
                 print(f"{self.color_yellow}Skipping {part} - file not found{self.color_reset}")
                 continue
-                
-            if self.slot == "both" and part in self.slot_specific_partitions:
-                for slot in ['a', 'b']:
-                    slot_part = f"{part}_{slot}"
-                    print(f"{self.color_green}Flashing {slot_part}...{self.color_reset}")
-                    self.run_command([self.fastboot_path, "flash", slot_part, img_file])
+            available.append(part)
+
+        # Ask the device up front: preparation runs on worker threads that must not touch the device
+        try:
+            self.get_max_download_size()
+        except subprocess.CalledProcessError:
+            self.max_download_size = 0
+        # Hash, re-chunk and decompress the next images while the current one uploads
+        def discard(prepared):
+            if prepared["path"]:
+                os.remove(prepared["path"])
+        for part, prepared in FlashPipeline(self.prepare_flash, discard=discard).run(available):
+            try:
+                for target, slot in self.flash_targets(part):
+                    self.flash_image(target, prepared, slot)
+            finally:
+                discard(prepared)
+
+    def prepare_flash(self, part):
+        """Everything flash_image needs for one partition that can be done without the device"""
+        image = self.rom.image(part)
+        prepared = {"partition": part, "image": image, "digest": None, "pieces": None, "path": None}
+        if self.manifest:
+            prepared["digest"] = self.image_digest(part)
+        sparse = self.sparse and part in self.logical_partitions + ["super", "super_empty"]
+        if not sparse and not isinstance(image, str):
+            # Archive images have no file to hand fastboot; only oversized ones need re-chunking
+            sparse = image.size() > (self.max_download_size or image.size())
+        if sparse:
+            prepared["pieces"] = self.prepare_image(image)
+        if not prepared["pieces"] and not isinstance(image, str) and not self.native:
+            fd, prepared["path"] = tempfile.mkstemp(suffix=".img")
+            with os.fdopen(fd, "wb") as f:
+                for chunk in image.stream():
+                    f.write(chunk)
+        return prepared
+
+    def flash_targets(self, part):
+        if self.slot == "both" and part in self.slot_specific_partitions:
+            return [(f"{part}_{slot}", slot) for slot in ['a', 'b']]
+        return [(part, self.active_slot)]
+
+    def flash_image(self, target, prepared, slot):
+        image = prepared["image"]
+        digest = prepared["digest"]
+        if self.manifest and not self.force_flash and self.manifest.matches(target, digest, slot):
+            print(f"{self.color_yellow}{self.tag}Skipping {target} - unchanged since last flash{self.color_reset}")
+            return
+        if self.journal and self.journal_matches(prepared["partition"],
+                                                 (self.journal.flashed(target, slot) or {}).get("digest")):
+            print(f"{self.color_yellow}{self.tag}Skipping {target} - already flashed before the interruption{self.color_reset}")
+            return
+        print(f"{self.color_green}{self.tag}Flashing {target}...{self.color_reset}")
+        if self.manifest:
+            self.manifest.forget([target])
+        if prepared["pieces"]:
+            self.flash_sparse(target, image_label(image), prepared["pieces"])
+        elif isinstance(image, str):
+            self.run_command([self.fastboot_path] + self.sparse_args() + ["flash", target, image])
+        elif prepared["path"]:
+            self.run_command([self.fastboot_path] + self.sparse_args() + ["flash", target, prepared["path"]])
+        elif not self.native or self.run_command([self.fastboot_path, "flash", target, image.label], stream=image) is None:
+            with self.materialize(image) as img_file:
+                self.run_command([self.fastboot_path, "flash", target, img_file])
+        if self.manifest:
+            self.manifest.record(target, digest, slot)
+        if self.journal:
+            self.journal.record_flash(self.phase, target, prepared["partition"],
+                                      self.rom.identity(prepared["partition"]), slot)
+
+    def transfer_limit(self):
+        """Largest single download: max-download-size, or less when tuning found smaller pieces faster"""
+        limit = self.get_max_download_size()
+        return min(limit, self.sparse_limit) if limit and self.sparse_limit else limit
+
+    def sparse_args(self):
+        return ["-S", str(self.sparse_limit)] if self.sparse_limit else []
+
+    def apply_tuning(self):
+        board = self.device_var("product")
+        try:
+            limit = self.get_max_download_size()
+        except subprocess.CalledProcessError:
+            return
+        profile = self.tuner.lookup(board, "native" if self.native else "fastboot", limit) if board and limit else None
+        if not profile:
+            return
+        self.sparse_limit = profile["sparse_limit"] if profile["sparse_limit"] < limit else None
+        if self.native and profile["chunk_size"]:
+            self.native.chunk_size = profile["chunk_size"]
+        chunk = f", {profile['chunk_size'] // 1024} KB writes" if self.native and profile["chunk_size"] else ""
+        print(f"{self.color_yellow}{self.tag}Using tuned transfers for {board}: "
+              f"{FlashPlan.format_size(self.sparse_limit or limit)} downloads{chunk}{self.color_reset}")
+        self.log_record("tuning", board=board, sparse_limit=self.sparse_limit, chunk_size=profile["chunk_size"])
+
+    def tune_transfers(self):
+        """Time throwaway uploads into the device's download buffer and keep the fastest sizes for its board"""
+        try:
+            limit = self.get_max_download_size()
+        except subprocess.CalledProcessError:
+            limit = 0
+        if not limit:
+            print(f"{self.color_red}Device does not report max-download-size, nothing to tune{self.color_reset}")
+            sys.exit(1)
+        board = self.device_var("product") or self.current_device.get("board", self.current_device["model"])
+        backend = "native" if self.native else "fastboot"
+        print(f"\n{self.color_green}## TRANSFER CALIBRATION: {board} ({backend}) ##{self.color_reset}")
+        if self.native:
+            protocol = self.native.connect()
+            def send(size, chunk_size):
+                block = bytes(chunk_size or NativeFastboot.CHUNK_SIZE)
+                def chunks():
+                    remaining = size
+                    while remaining:
+                        yield block if remaining >= len(block) else block[:remaining]
+                        remaining -= min(remaining, len(block))
+                start = time.perf_counter()
+                protocol.download(size, chunks())
+                return time.perf_counter() - start
+        else:
+            # `fastboot stage` uploads a file without flashing it; the binary picks its own chunking
+            def send(size, chunk_size):
+                fd, tmp_path = tempfile.mkstemp(suffix=".img")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        f.truncate(size)
+                    start = time.perf_counter()
+                    self.run_command([self.fastboot_path, "stage", tmp_path])
+                    return time.perf_counter() - start
+                finally:
+                    os.remove(tmp_path)
+        try:
+            profile = self.tuner.calibrate(send, limit, chunked=bool(self.native))
+        except (FastbootError, subprocess.CalledProcessError) as e:
+            print(f"{self.color_red}Calibration failed: {str(e)}{self.color_reset}")
+            sys.exit(1)
+        for size, rate in profile["chunks"]:
+            print(f"  {size // 1024:>6} KB writes: {rate:>8.2f} MB/s")
+        for size, rate in profile["downloads"]:
+            print(f"  {FlashPlan.format_size(size):>9} download: {rate:>8.2f} MB/s")
+        self.tuner.save(board, backend, profile)
+        chunk = f", {profile['chunk_size'] // 1024} KB writes" if profile["chunk_size"] else ""
+        print(f"{self.color_green}Saved for {board}: {FlashPlan.format_size(profile['sparse_limit'])} downloads"
+              f"{chunk} ({profile['mb_per_s']} MB/s){self.color_reset}")
+        self.log_record("tuning", board=board, **profile)
+
+    def get_max_download_size(self):
+        if self.max_download_size is None:
+            value = self.device_var("max-download-size")
+            if value is None:
+                result = self.run_command([self.fastboot_path, "getvar", "max-download-size"])
+                match = re.search(r"max-download-size:\s*(\S+)", result.stdout)
+                value = match.group(1) if match else "0"
+            self.max_download_size = int(value, 0)
+        return self.max_download_size
+
+    def prepare_image(self, image):
+        """Sparse pieces that each fit max-download-size, or None to send the image unchanged"""
+        try:
+            limit = self.transfer_limit()
+        except subprocess.CalledProcessError:
+            return None
+        if not limit:
+            return None
+        key = (image_label(image), limit)
+        if key not in self.prepared:
+            print(f"{self.color_yellow}{self.tag}Preparing {image_label(image)}...{self.color_reset}")
+            is_sparse = SparseImage.is_sparse(image)
+            sparse_image = SparseImage.load(image)
+            file_size = image_size(image)
+            if is_sparse and file_size <= limit:
+                pieces = None
+            elif not is_sparse and sparse_image.size() >= file_size and file_size <= limit:
+                # Nothing to drop, the raw image is cheaper to send as-is
+                pieces = None
             else:
-                print(f"{self.color_green}Flashing {part}...{self.color_reset}")
-                self.run_command([self.fastboot_path, "flash", part, img_file])
-
-    def run_command(self, cmd):
-        log_entry = f"[{datetime.now().isoformat()}] COMMAND: {' '.join(cmd)}\n"
-        try:
-            result = subprocess.run(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                check=True
-            )
-            log_entry += f"OUTPUT:\n{result.stdout.strip()}\n"
+                pieces = sparse_image.split(limit)
+            self.prepared[key] = pieces
+        return self.prepared[key]
+
+    def flash_sparse(self, target, img_file, pieces):
+        if self.native:
+            for i, piece in enumerate(pieces, 1):
+                print(f"{self.color_green}{self.tag}Sending sparse '{target}' {i}/{len(pieces)} ({piece.size() // 1024} KB){self.color_reset}")
+                if self.run_command([self.fastboot_path, "flash", target, f"{img_file}:{i}/{len(pieces)}"],
+                                    stream=piece) is None:
+                    break
+            else:
+                return
+        # The binary needs files: write the next piece while fastboot uploads the current one
+        def write_piece(piece):
+            fd, tmp_path = tempfile.mkstemp(suffix=".img")
+            with os.fdopen(fd, "wb") as f:
+                piece.write_to(f)
+            return tmp_path
+        pipeline = FlashPipeline(write_piece, workers=1, depth=1, discard=os.remove)
+        for i, (piece, tmp_path) in enumerate(pipeline.run(pieces), 1):
+            print(f"{self.color_green}{self.tag}Sending sparse '{target}' {i}/{len(pieces)} ({piece.size() // 1024} KB){self.color_reset}")
+            try:
+                self.run_command([self.fastboot_path, "flash", target, tmp_path])
+            finally:
+                os.remove(tmp_path)
+
+    def image_digest(self, part):
+        image = self.rom.image(part)
+        key = image_label(image)
+        if key not in self.digests:
+            # payload.bin carries the sha256 of every partition, a ROM directory's inventory keeps them between runs
+            digest = self.rom.digest(part)
+            if not digest:
+                sha = hashlib.sha256()
+                for chunk in iter_image(image):
+                    sha.update(chunk)
+                digest = sha.hexdigest()
+            self.digests[key] = digest
+        return self.digests[key]
+
+    @contextmanager
+    def materialize(self, image):
+        """Path for an image, extracting archive images to a temporary file while it is in use"""
+        if isinstance(image, str):
+            yield image
+            return
+        fd, tmp_path = tempfile.mkstemp(suffix=".img")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in image.stream():
+                    f.write(chunk)
+            yield tmp_path
+        finally:
+            os.remove(tmp_path)
+
+    def delta_unchanged(self, partitions):
+        """True when delta mode is on and every target of these partitions matches the manifest"""
+        if not self.manifest or self.force_flash or not partitions:
+            return False
+        return all(self.manifest.matches(target, self.image_digest(part), slot)
+                   for part in partitions for target, slot in self.flash_targets(part))
+
+    def run_command(self, cmd, stream=None):
+        name = " ".join(str(arg) for arg in cmd[1:]) if cmd and cmd[0] == self.fastboot_path else " ".join(cmd)
+        with self.report.span(name, "command", self.progress.transfers):
+            result = self.execute_command(cmd, stream)
+        if result is not None and self.journal and self.phase:
+            self.journal.record_command(self.phase, name, self.active_slot)
+        return result
+
+    def execute_command(self, cmd, stream=None):
+        native_args = cmd[1:] if self.native and cmd and cmd[0] == self.fastboot_path else None
+        if self.serial and cmd and cmd[0] == self.fastboot_path:
+            cmd = [cmd[0], "-s", self.serial] + cmd[1:]
+        record = {"argv": cmd, "backend": "native" if native_args is not None else "fastboot",
+                  "exit_code": None, "output": None}
+        start = time.time()
+        try:
+            result = self.run_native(native_args, stream) if native_args is not None else None
+            if result is None and stream is not None:
+                # Streams only exist for the native backend, the caller falls back to a file
+                record["output"] = "native backend unavailable"
+                return None
+            if result is None:
+                record["backend"] = "fastboot"
+                result = self.stream_command(cmd)
+            record.update(exit_code=result.returncode, output=result.stdout.strip())
             #print(f"\n{self.color_green}[CMD]{self.color_reset} {' '.join(cmd)}")
-            print(f"{self.color_green}[OUTPUT]{self.color_reset}\n{result.stdout.strip()}")
+            print(f"{self.color_green}{self.tag}[OUTPUT]{self.color_reset}\n{result.stdout.strip()}")
             return result
         except subprocess.CalledProcessError as e:
-            log_entry += f"ERROR: {e.stdout}\nEXIT CODE: {e.returncode}"
-            print(f"\n{self.color_red}[CMD FAILED]{self.color_reset} {' '.join(cmd)}")
-            print(f"{self.color_red}[ERROR]{self.color_reset}\n{e.stdout}")
+            record.update(exit_code=e.returncode, output=e.stdout)
+            print(f"\n{self.color_red}{self.tag}[CMD FAILED]{self.color_reset} {' '.join(cmd)}")
+            print(f"{self.color_red}{self.tag}[ERROR]{self.color_reset}\n{e.stdout}")
             raise
         finally:
-            self.write_to_log(log_entry)
+            self.progress.clear()
+            self.log_record("command", seconds=round(time.time() - start, 3), **record)
+
+    def stream_command(self, cmd):
+        """subprocess.run with check=True, feeding fastboot's output to the progress parser as it arrives"""
+        parser = FastbootOutputParser(self.progress.handle)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        output = []
+        self.spawns += 1
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        with process:
+            while True:
+                # fastboot leaves "Sending ..." open until OKAY, so read whatever is there, not whole lines
+                data = process.stdout.read1(65536)
+                text = decoder.decode(data, final=not data).replace("\r\n", "\n")
+                if text:
+                    output.append(text)
+                    parser.feed(text)
+                if not data:
+                    break
+        stdout = "".join(output)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd, output=stdout)
+        return subprocess.CompletedProcess(cmd, process.returncode, stdout=stdout)
+
+    def report_transfer(self, transfer):
+        rate = transfer["size"] / transfer["seconds"] / (1024 * 1024) if transfer["seconds"] else 0
+        message = (f"{self.tag}{transfer['label']}: {FlashPlan.format_size(transfer['size'])} "
+                   f"in {transfer['seconds']:.1f}s ({rate:.1f} MB/s)")
+        with self.progress.lock:
+            if self.spinner_running:
+                sys.stdout.write("\r" + " " * 80 + "\r")
+            print(f"{self.color_green}{message}{self.color_reset}")
+        self.log_record("transfer", label=transfer["label"], bytes=transfer["size"],
+                        seconds=round(transfer["seconds"], 3), mb_per_s=round(rate, 2))
+
+    def run_native(self, args, stream=None):
+        """Run a fastboot argv over the native protocol, None if the binary must handle it"""
+        try:
+            result = self.native.execute(args, stream=stream)
+            if result is None:
+                # The binary cannot claim a USB interface this process still holds
+                self.native.disconnect()
+            return result
+        except FastbootError as e:
+            if self.backend == "native" or self.native.connected:
+                raise subprocess.CalledProcessError(1, ["fastboot"] + args, output=str(e))
+            # auto backend: no usable transport, stay on the binary from now on
+            print(f"{self.color_yellow}Native backend unavailable ({str(e)}), using fastboot binary{self.color_reset}")
+            self.native = None
+            return None
 
     def write_to_log(self, content):
-        with open(self.log_file, "a") as f:
-            f.write(content + "\n")
+        self.log_record("message", message=content.strip())
+
+    def log_record(self, kind, **fields):
+        record = {"time": datetime.now().isoformat(), "serial": self.device_serial, "phase": self.phase, "kind": kind}
+        record.update(fields)
+        LogWriter.shared().write(self.log_file, record)
 
     def generate_summary_report(self):
         summary = "\n=== FLASHING SUMMARY ===\n"
         summary += f"Log file: {self.log_file}\n"
+        summary += f"Report: {self.report_file}\n"
         summary += f"Timestamp: {datetime.now().isoformat()}\n"
         self.write_to_log(summary)
 
-    def prompt_yes_no(self, question, confirmation=False, default_yes=False):
+    def write_report(self):
+        info = {
+            "device": self.current_device["model"] if self.current_device else None,
+            "serial": self.device_serial,
+            "backend": "native" if self.native else "fastboot",
+            "log_file": self.log_file,
+        }
+        try:
+            self.report.write(self.report_file, info)
+            if self.trace_file:
+                self.report.write_trace(self.trace_file, self.device_serial)
+        except OSError as e:
+            print(f"{self.color_red}{self.tag}Failed to write report: {str(e)}{self.color_reset}")
+
+    def prompt_yes_no(self, question, confirmation=False, default_yes=False, key=None):
+        # Pre-recorded answers let farm sessions run without a human per device
+        if key is not None and key in self.answers:
+            return self.answers[key]
+        if self.headless:
+            print(f"{self.color_red}{self.tag}The profile does not answer: {question}{self.color_reset}")
+            sys.exit(self.EXIT_USAGE)
         prompt_suffix = " [Y/n]" if default_yes else " [y/N]"
         while True:
             response = input(f"{self.color_yellow}{question}{prompt_suffix}: {self.color_reset}").lower()
             if response == "" and default_yes:
-                return True
-            if response in ["y", "yes"]:
-                return True
-            if response in ["n", "no"]:
-                return False
-            print(f"{self.color_red}Invalid input! Please enter y/n{self.color_reset}")
+                answer = True
+            elif response in ["y", "yes"]:
+                answer = True
+            elif response in ["n", "no"]:
+                answer = False
+            else:
+                print(f"{self.color_red}Invalid input! Please enter y/n{self.color_reset}")
+                continue
+            if key is not None:
+                self.answers[key] = answer
+            return answer
+
+    def apply_profile(self, profile):
+        """Take every answer from a profile; a question it leaves open fails instead of blocking"""
+        if profile.device != "auto" and not self.find_device(profile.device):
+            print(f"{self.color_red}Unknown device in profile: {profile.device}{self.color_reset}")
+            sys.exit(self.EXIT_USAGE)
+        self.profile = profile
+        self.headless = True
+        self.answers.update(profile.answers())
+
+    def run_headless(self):
+        self.check_prerequisites()
+        self.device_checks()
+        self.flash_procedure()
 
     def display_main_menu(self):
         ascii_art = """
@@ -662,24 +1524,3591 @@ class Flash:
                 sys.exit(0)
             else:
                 print(f"{self.color_red}Invalid choice. Please try again.{self.color_reset}")
-def main():
-    try:
-        flasher = Flash()
-        flasher.setup_environment()
-        flasher.display_main_menu()
-    except SystemExit as e:
-        print(f"\n{colorama.Fore.YELLOW}Process exited with code {e.code}{colorama.Style.RESET_ALL}")
-    except KeyboardInterrupt:
-        print(f"\n{colorama.Fore.RED}Operation cancelled by user{colorama.Style.RESET_ALL}")
-    except Exception as e:
-        print(f"\n{colorama.Fore.RED}Unexpected error: {str(e)}{colorama.Style.RESET_ALL}")
-    finally:
-        input("Press Enter to close the window...")
+def parse_getvar_all(output):
+    """Variables from `fastboot getvar all` output, keyed like getvar names (partition-size:super)"""
+    variables = {}
+    for line in output.splitlines():
+        line = line.strip()
+        if not line.startswith("(bootloader)"):
+            continue
+        key, sep, value = line[len("(bootloader)"):].rpartition(":")
+        if sep and key.strip():
+            variables[key.strip()] = value.strip()
+    return variables
+
+def open_image(image):
+    return open(image, "rb") if isinstance(image, str) else image.open()
+
+def image_size(image):
+    return os.path.getsize(image) if isinstance(image, str) else image.size()
+
+def image_label(image):
+    return os.path.abspath(image) if isinstance(image, str) else image.label
+
+def iter_image(image, chunk_size=1024 * 1024):
+    if not isinstance(image, str):
+        yield from image.stream()
+        return
+    with open(image, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            yield chunk
+
+def file_sha256(path, on_progress=None, block_size=8 * 1024 * 1024):
+    """sha256 of a file read through mmap; hashlib releases the GIL, so threads hash several files at once"""
+    import mmap
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for offset in range(0, size, block_size):
+                    with view[offset:offset + block_size] as block:
+                        sha.update(block)
+                    if on_progress:
+                        on_progress(min(block_size, size - offset))
+    return sha.hexdigest()
+
+def rechunk(chunks, size):
+    """Regroup a stream of byte chunks into pieces of exactly `size` bytes (the last one may be shorter)"""
+    pending = bytearray()
+    for chunk in chunks:
+        view = memoryview(chunk)
+        if pending:
+            take = size - len(pending)
+            pending += view[:take]
+            view = view[take:]
+            if len(pending) < size:
+                continue
+            yield bytes(pending)
+            pending = bytearray()
+        while len(view) >= size:
+            yield bytes(view[:size])
+            view = view[size:]
+        pending += view
+    if pending:
+        yield bytes(pending)
+
+class IterReader(io.RawIOBase):
+    """Read-only file object over a generator of byte chunks"""
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b""
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+class ArchiveImage(abc.ABC):
+    """An image that lives inside a ROM zip or payload.bin instead of on disk"""
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, label, size):
+        self.label = label
+        self.image_size = size
+
+    def size(self):
+        return self.image_size
+
+    @abc.abstractmethod
+    def open(self):
+        """Readable file object positioned at the start of the image"""
+
+    def stream(self):
+        with self.open() as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                yield chunk
+
+class ZipImage(ArchiveImage):
+    def __init__(self, archive, info):
+        super().__init__(f"{archive.filename}:{info.filename}", info.file_size)
+        self.archive = archive
+        self.info = info
+
+    def open(self):
+        return self.archive.open(self.info)
+
+class PayloadOperation:
+    """One REPLACE* install operation, decoded only when its data is read"""
+    REPLACE = 0
+    REPLACE_BZ = 1
+    ZERO = 6
+    DISCARD = 7
+    REPLACE_XZ = 8
+
+    def __init__(self, payload, op_type, data_offset, data_length, size):
+        self.payload = payload
+        self.op_type = op_type
+        self.data_offset = data_offset
+        self.data_length = data_length
+        self.size = size
+
+    @classmethod
+    def decode(cls, op_type, data):
+        if op_type == cls.REPLACE_BZ:
+            import bz2
+            return bz2.decompress(data)
+        if op_type == cls.REPLACE_XZ:
+            import lzma
+            return lzma.decompress(data)
+        return data
+
+    def open(self):
+        return io.BytesIO(self.decode(self.op_type, self.payload.read_blob(self.data_offset, self.data_length)))
+
+class PayloadImage(ArchiveImage):
+    def __init__(self, payload, name, size, digest, block_size):
+        super().__init__(f"{payload.path}:{name}", size)
+        self.digest = digest
+        self.block_size = block_size
+        # (start_block, blocks, operation, offset within the operation); operation None for ZERO extents
+        self.chunks = []
+
+    def sparse_image(self):
+        """Block map of the partition: REPLACE* data as RAW, ZERO as zero FILL, DISCARD and the rest as holes"""
+        image = SparseImage(self.block_size, (self.image_size + self.block_size - 1) // self.block_size)
+        image.chunks = [(start, SparseImage.CHUNK_RAW, blocks, op, offset) if op else
+                        (start, SparseImage.CHUNK_FILL, blocks, None, b"\0\0\0\0")
+                        for start, blocks, op, offset in sorted(self.chunks, key=lambda c: c[0])]
+        return image
+
+    def open(self):
+        return io.BufferedReader(IterReader(self.stream()), self.CHUNK_SIZE)
+
+    def stream(self):
+        remaining = self.image_size
+        for data in self.sparse_image().iter_raw():
+            yield data[:remaining]
+            remaining -= min(len(data), remaining)
+
+class ImageInventory:
+    """Size, mtime, format and (once asked for) sha256 of every *.img in a ROM directory
+
+    Listed with one os.scandir pass and kept in a sidecar file next to the images, so later runs only
+    read the headers of images whose size or mtime changed.
+    """
+    FILE = ".flasher-inventory.json"
+    VERSION = 1
+
+    def __init__(self, root=""):
+        self.root = root
+        self.directory = None
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def load(self, directory):
+        try:
+            with open(os.path.join(directory, self.FILE), encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                return data["entries"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}
+
+    def save(self):
+        """Best effort: a read-only ROM share just keeps the inventory in memory"""
+        path = os.path.join(self.directory, self.FILE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with self.lock:
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"version": self.VERSION, "entries": self.entries}, f)
+                os.replace(tmp_path, path)
+            except OSError:
+                pass
+
+    def scan(self):
+        """List the directory again; images with the same size and mtime keep their header and digest"""
+        directory = os.path.abspath(self.root or ".")
+        cached = self.entries if self.entries is not None and directory == self.directory else self.load(directory)
+        entries = {}
+        changed = False
+        with os.scandir(directory) as listing:
+            for entry in listing:
+                if not entry.name.endswith(".img"):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                name = entry.name[:-len(".img")]
+                old = cached.get(name)
+                if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime_ns:
+                    entries[name] = old
+                else:
+                    entries[name] = self.describe(entry.path, st)
+                    changed = True
+        with self.lock:
+            self.directory = directory
+            self.entries = entries
+        if changed or entries.keys() != cached.keys():
+            self.save()
+        return entries
+
+    @staticmethod
+    def describe(path, st):
+        entry = {"size": st.st_size, "mtime": st.st_mtime_ns}
+        try:
+            info = ImageHeader.inspect(path)
+            entry.update(format=info["kind"], version=info["version"], expanded=info["size"], content=info["content"])
+        except (OSError, ValueError, struct.error) as e:
+            entry.update(format="invalid", error=str(e))
+        return entry
+
+    def get(self, name):
+        # A relative root follows the working directory, like the image paths handed out
+        if self.entries is None or os.path.abspath(self.root or ".") != self.directory:
+            self.scan()
+        return self.entries.get(name)
+
+    def header(self, name):
+        """ImageHeader.inspect() result recorded by the scan"""
+        entry = self.get(name)
+        if entry is None:
+            raise OSError(f"{name}.img not found")
+        if "error" in entry:
+            raise ValueError(entry["error"])
+        return {"kind": entry["format"], "version": entry["version"], "size": entry["expanded"],
+                "content": entry["content"]}
+
+    def digest(self, name, on_progress=None):
+        """sha256 of an image, hashed on first use and reused while its size and mtime stay the same"""
+        entry = self.get(name)
+        if entry is None:
+            return None
+        if "digest" not in entry:
+            path = os.path.join(self.directory, f"{name}.img")
+            digest = file_sha256(path, on_progress)
+            st = os.stat(path)
+            if (st.st_size, st.st_mtime_ns) != (entry["size"], entry["mtime"]):
+                # Changed while it was hashed, the next scan describes it again
+                return digest
+            with self.lock:
+                entry["digest"] = digest
+            self.save()
+        elif on_progress:
+            on_progress(entry["size"])
+        return entry["digest"]
+
+class DirectorySource:
+    """Images stored as <partition>.img files in a directory, looked up in its inventory"""
+    def __init__(self, root=""):
+        self.root = root
+        self.inventory = ImageInventory(root)
+
+    def path(self, name):
+        return os.path.join(self.root, f"{name}.img")
+
+    def has(self, name):
+        return self.inventory.get(name) is not None
+
+    def image(self, name):
+        return self.path(name)
+
+    def names(self):
+        return sorted(self.inventory.scan())
+
+    def size(self, name):
+        return self.inventory.get(name)["size"]
+
+    def header(self, name):
+        return self.inventory.header(name)
+
+    def digest(self, name):
+        return self.inventory.digest(name)
+
+    def identity(self, name):
+        """The sha256 when the inventory has it, otherwise size and mtime; never reads the image"""
+        entry = self.inventory.get(name)
+        return entry.get("digest") or f"stat:{entry['size']}:{entry['mtime']}"
+
+class ZipSource:
+    """Images read straight out of a ROM zip, without extracting them"""
+    def __init__(self, path):
+        import zipfile
+        self.archive = zipfile.ZipFile(path)
+        self.images = {}
+        for info in self.archive.infolist():
+            name = os.path.basename(info.filename)
+            if name.endswith(".img") and not info.is_dir():
+                self.images.setdefault(name[:-4], ZipImage(self.archive, info))
+
+    def has(self, name):
+        return name in self.images
+
+    def image(self, name):
+        return self.images[name]
+
+    def names(self):
+        return sorted(self.images)
+
+    def size(self, name):
+        return self.images[name].size()
+
+    def header(self, name):
+        return ImageHeader.inspect(self.images[name])
+
+    def digest(self, name):
+        return None
+
+    def identity(self, name):
+        info = self.images[name].info
+        return f"crc32:{info.CRC:08x}:{info.file_size}"
+
+class PayloadSource:
+    """Full OTA payload.bin, read in place (optionally stored inside a zip at base_offset)"""
+    HEADER = struct.Struct(">4sQQI")
+
+    def __init__(self, path, base_offset=0):
+        self.path = path
+        self.base_offset = base_offset
+        self.images = {}
+        with open(path, "rb") as f:
+            f.seek(base_offset)
+            magic, version, manifest_size, signature_size = self.HEADER.unpack(f.read(self.HEADER.size))
+            if magic != b"CrAU" or version != 2:
+                raise ValueError(f"{path}: not a version 2 payload.bin")
+            manifest = self.decode_message(f.read(manifest_size))
+        self.data_offset = base_offset + self.HEADER.size + manifest_size + signature_size
+        block_size = manifest.get(3, [4096])[0]
+
+        for raw_partition in manifest.get(13, []):
+            partition = self.decode_message(raw_partition)
+            name = partition[1][0].decode()
+            info = self.decode_message(partition.get(7, [b""])[0])
+            image = PayloadImage(self, name, info.get(1, [0])[0],
+                                 info.get(2, [b""])[0].hex() or None, block_size)
+            for raw_op in partition.get(8, []):
+                op = self.decode_message(raw_op)
+                op_type = op.get(1, [0])[0]
+                extents = [self.decode_message(e) for e in op.get(6, [])]
+                extents = [(e.get(1, [0])[0], e.get(2, [0])[0]) for e in extents]
+                if op_type == PayloadOperation.ZERO:
+                    # Must reach the device as zeros, the partition may hold old data there
+                    image.chunks.extend((start, blocks, None, 0) for start, blocks in extents)
+                    continue
+                if op_type == PayloadOperation.DISCARD:
+                    continue
+                if op_type not in (PayloadOperation.REPLACE, PayloadOperation.REPLACE_BZ, PayloadOperation.REPLACE_XZ):
+                    raise ValueError(f"{path}: {name} uses operation type {op_type}, only full OTAs are supported")
+                operation = PayloadOperation(self, op_type, op.get(2, [0])[0], op.get(3, [0])[0],
+                                             sum(blocks for _, blocks in extents) * block_size)
+                offset = 0
+                for start, blocks in extents:
+                    image.chunks.append((start, blocks, operation, offset))
+                    offset += blocks * block_size
+            self.images[name] = image
+
+    @staticmethod
+    def read_varint(data, pos):
+        result = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return result, pos
+            shift += 7
+
+    @classmethod
+    def decode_message(cls, data):
+        """Minimal protobuf decoder: field number -> list of ints or bytes"""
+        fields = {}
+        pos = 0
+        while pos < len(data):
+            key, pos = cls.read_varint(data, pos)
+            wire_type = key & 7
+            if wire_type == 0:
+                value, pos = cls.read_varint(data, pos)
+            elif wire_type == 1:
+                value = struct.unpack_from("<Q", data, pos)[0]
+                pos += 8
+            elif wire_type == 2:
+                length, pos = cls.read_varint(data, pos)
+                value = data[pos:pos + length]
+                pos += length
+            elif wire_type == 5:
+                value = struct.unpack_from("<I", data, pos)[0]
+                pos += 4
+            else:
+                raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+            fields.setdefault(key >> 3, []).append(value)
+        return fields
+
+    def read_blob(self, offset, length):
+        with open(self.path, "rb") as f:
+            f.seek(self.data_offset + offset)
+            return f.read(length)
+
+    def has(self, name):
+        return name in self.images
+
+    def image(self, name):
+        return self.images[name]
+
+    def names(self):
+        return sorted(self.images)
+
+    def size(self, name):
+        return self.images[name].size()
+
+    def header(self, name):
+        return ImageHeader.inspect(self.images[name])
+
+    def digest(self, name):
+        return self.images[name].digest
+
+    def identity(self, name):
+        return self.images[name].digest
+
+class ImageVerifier:
+    """Hashes a ROM's images against its sha256 manifest on background threads, started before the device is found"""
+    NAMES = ("SHA256SUMS", "sha256sums.txt", "sha256sum.txt", "checksums.sha256", "sha256.txt")
+
+    def __init__(self, rom, expected, label, workers=None):
+        self.rom = rom
+        self.expected = expected
+        self.label = label
+        self.workers = workers or min(8, os.cpu_count() or 4)
+        self.results = {}
+        self.hashed = 0
+        self.total = 0
+        self.done = threading.Condition()
+
+    @classmethod
+    def find(cls, rom_path):
+        """Manifest shipped inside a ROM directory, if any"""
+        if not os.path.isdir(rom_path):
+            return None
+        for name in cls.NAMES:
+            path = os.path.join(rom_path, name)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    @staticmethod
+    def parse(path):
+        """{partition: sha256} from sha256sum output ("<digest>  boot.img", "*" marks binary mode)"""
+        expected = {}
+        with open(path, encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                match = re.fullmatch(r"([0-9A-Fa-f]{64})\s+\*?(.+)", line)
+                if not match:
+                    raise ValueError(f"line {number} is not '<sha256>  <file>'")
+                name = os.path.basename(match.group(2).replace("\\", "/"))
+                if name.endswith(".img"):
+                    expected[name[:-len(".img")]] = match.group(1).lower()
+        return expected
+
+    def start(self):
+        names = sorted((name for name in self.expected if self.rom.has(name)), key=self.rom.size, reverse=True)
+        self.total = sum(self.rom.size(name) for name in names)
+        work = queue.Queue()
+        for name in names:
+            work.put(name)
+        # Daemon threads rather than an executor, so quitting from the menu never waits for a hash to finish
+        for _ in range(min(self.workers, len(names))):
+            threading.Thread(target=self.worker, args=(work,), daemon=True).start()
+
+    def worker(self, work):
+        while True:
+            try:
+                name = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = self.digest(name)
+            except (OSError, ValueError) as e:
+                result = OSError(str(e))
+            with self.done:
+                self.results[name] = result
+                self.done.notify_all()
+
+    def advance(self, size):
+        with self.done:
+            self.hashed += size
+
+    def digest(self, name):
+        if isinstance(self.rom, DirectorySource):
+            return self.rom.inventory.digest(name, on_progress=self.advance)
+        sha = hashlib.sha256()
+        for chunk in iter_image(self.rom.image(name)):
+            sha.update(chunk)
+            self.advance(len(chunk))
+        return sha.hexdigest()
+
+    def wait(self, names, on_progress=None):
+        """{name: digest or OSError} for the listed names, calling on_progress(hashed, total) while waiting"""
+        names = [name for name in names if name in self.expected and self.rom.has(name)]
+        with self.done:
+            while not all(name in self.results for name in names):
+                if on_progress:
+                    on_progress(self.hashed, self.total)
+                self.done.wait(timeout=0.5)
+            return {name: self.results[name] for name in names}
+
+class RomSource:
+    @staticmethod
+    def open(path):
+        """Pick the image source for a ROM directory, ROM zip or payload.bin"""
+        import zipfile
+        if os.path.isdir(path):
+            return DirectorySource(path)
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                names = {os.path.basename(n): n for n in archive.namelist()}
+                if "payload.bin" in names:
+                    info = archive.getinfo(names["payload.bin"])
+                    if info.compress_type != zipfile.ZIP_STORED:
+                        raise ValueError("payload.bin inside the zip must be stored uncompressed")
+                    with open(path, "rb") as f:
+                        f.seek(info.header_offset)
+                        local_header = f.read(30)
+                    name_len, extra_len = struct.unpack("<HH", local_header[26:30])
+                    return PayloadSource(path, info.header_offset + 30 + name_len + extra_len)
+            return ZipSource(path)
+        return PayloadSource(path)
+
+class DeviceCatalog:
+    """devices.json from GitHub, served from a local copy and revalidated in the background"""
+    URL = "https://raw.githubusercontent.com/PHATWalrus/universal-flasher/refs/heads/main/devices.json"
+    TIMEOUT = 10
+
+    def __init__(self, cache_dir, url=None):
+        self.path = os.path.join(cache_dir, "devices.json")
+        self.url = url or self.URL
+        self.thread = None
+
+    @staticmethod
+    def bundled_path():
+        # PyInstaller unpacks --add-data files into _MEIPASS
+        return os.path.join(getattr(sys, "_MEIPASS", os.path.dirname(os.path.abspath(__file__))), "devices.json")
+
+    @staticmethod
+    def valid(catalog):
+        return (isinstance(catalog, dict) and isinstance(catalog.get("devices"), list) and
+                all(isinstance(device, dict) and "model" in device and "partitions" in device
+                    for device in catalog["devices"]))
+
+    @staticmethod
+    def index(devices):
+        """Lower-cased model, codename and board to device; the first device listed wins a clash"""
+        index = {}
+        for device in devices:
+            for key in ("model", "codename", "board"):
+                if device.get(key):
+                    index.setdefault(device[key].lower(), device)
+        return index
+
+    def read_cache(self):
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cache if isinstance(cache, dict) and self.valid(cache.get("catalog")) else None
+
+    def read_bundled(self):
+        try:
+            with open(self.bundled_path()) as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return catalog if self.valid(catalog) else None
+
+    @staticmethod
+    def merge(fetched, bundled):
+        """Fetched catalog, completed from the bundled one
+
+        Fetched values win, so upstream fixes to a device take effect; the bundled copy only fills in keys the
+        fetched entry lacks (an older upstream without "super", say) and devices it does not list.
+        """
+        bundled_devices = {device["model"].lower(): device for device in bundled["devices"]}
+        devices = []
+        for device in fetched["devices"]:
+            devices.append({**bundled_devices.pop(device["model"].lower(), {}), **device})
+        devices += bundled_devices.values()
+        return {**fetched, "devices": devices}
+
+    def fetch(self, cache=None):
+        import requests
+        headers = {}
+        if cache and cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache and cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
+        response = requests.get(self.url, headers=headers, timeout=self.TIMEOUT)
+        if response.status_code == 304 and cache:
+            return cache
+        response.raise_for_status()
+        catalog = json.loads(response.text)
+        if not self.valid(catalog):
+            raise ValueError("devices.json has no usable device list")
+        cache = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched": datetime.now().isoformat(),
+            "catalog": catalog,
+        }
+        self.save(cache)
+        return cache
+
+    def revalidate(self, cache):
+        try:
+            self.fetch(cache)
+        except Exception:
+            # Offline is normal on flashing stations; the next launch tries again
+            pass
+
+    def save(self, cache):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """Device list without waiting on the network whenever a cached or bundled copy exists"""
+        cache = self.read_cache()
+        bundled = self.read_bundled()
+        if cache and bundled:
+            catalog = self.merge(cache["catalog"], bundled)
+        else:
+            catalog = cache["catalog"] if cache else bundled
+        if catalog is None:
+            return self.fetch()["catalog"]["devices"]
+        # Whatever the revalidation brings in is used from the next launch on
+        self.thread = threading.Thread(target=self.revalidate, args=(cache,), daemon=True)
+        self.thread.start()
+        return catalog["devices"]
+
+class ToolVersionCache:
+    """Version output of tool binaries keyed by path, size and mtime, so relaunches skip the subprocess"""
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if path:
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def output(self, binary, args):
+        """stdout of `binary args`, None when it cannot be run or exits non-zero"""
+        try:
+            st = os.stat(binary)
+        except OSError:
+            return None
+        # An upgraded or replaced binary gets a new key, so stale versions are never served
+        key = f"{os.path.realpath(binary)}|{st.st_size}|{st.st_mtime_ns}|{' '.join(args)}"
+        with self.lock:
+            if key in self.entries:
+                return self.entries[key]
+        try:
+            result = subprocess.run([binary] + args, capture_output=True, text=True, timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        if result.returncode != 0:
+            return None
+        with self.lock:
+            self.entries[key] = result.stdout
+            self.dirty = True
+        return result.stdout
+
+    def save(self):
+        with self.lock:
+            if not self.path or not self.dirty:
+                return
+            entries = dict(self.entries)
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+class FileLock:
+    """Lock file shared between processes, holding the owner's pid
+
+    A lock whose owner has exited is abandoned. Without a readable pid, one older than `stale` seconds is.
+    """
+    def __init__(self, path, timeout=600, stale=900):
+        self.path = path
+        self.timeout = timeout
+        self.stale = stale
+
+    def __enter__(self):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                return self
+            except FileExistsError:
+                try:
+                    if self.abandoned():
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+            if time.time() >= deadline:
+                raise TimeoutError(f"Timed out waiting for {self.path}")
+            time.sleep(0.2)
+
+    def abandoned(self):
+        try:
+            with open(self.path) as f:
+                pid = int(f.read())
+        except ValueError:
+            # Just created, the pid is written right after
+            pid = None
+        if pid:
+            # A slow holder (a long download) keeps its lock however old the file gets
+            return not self.alive(pid)
+        return time.time() - os.path.getmtime(self.path) > self.stale
+
+    @staticmethod
+    def alive(pid):
+        if platform.system() == "Windows":
+            # os.kill(pid, 0) would send CTRL_C_EVENT on Windows
+            kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+            handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+            if not handle:
+                return ctypes.get_last_error() == 5  # ERROR_ACCESS_DENIED: exists, not ours
+            kernel32.CloseHandle(handle)
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def __exit__(self, *exc_info):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class ToolsCache:
+    """platform-tools downloaded once per machine: resumable, verified and extracted per version"""
+    CHUNK_SIZE = 1024 * 1024
+    TIMEOUT = 30
+
+    def __init__(self, root, url, sha256=None):
+        self.root = root
+        self.url = url
+        self.sha256 = sha256.lower() if sha256 else None
+        self.archive = os.path.basename(url.split("?")[0])
+        self.pointer = os.path.join(root, f"{self.archive}.current")
+
+    def current(self):
+        """(version, platform-tools dir) of the cached copy, None when nothing usable is cached"""
+        try:
+            with open(self.pointer) as f:
+                tools_version = f.read().strip()
+        except OSError:
+            return None
+        tools_dir = os.path.join(self.root, "versions", self.archive, tools_version, "platform-tools")
+        if not any(os.path.exists(os.path.join(tools_dir, name)) for name in ("fastboot", "fastboot.exe")):
+            return None
+        return tools_version, tools_dir
+
+    def usable(self, cached, min_version):
+        if not cached:
+            return False
+        from packaging import version
+        try:
+            return min_version is None or version.parse(cached[0]) >= version.parse(min_version)
+        except version.InvalidVersion:
+            return True
+
+    def ensure(self, min_version=None):
+        """platform-tools dir, downloading and extracting only when no recent enough copy is cached"""
+        cached = self.current()
+        if self.usable(cached, min_version):
+            return cached[1]
+        os.makedirs(self.root, exist_ok=True)
+        with FileLock(os.path.join(self.root, f"{self.archive}.lock")):
+            # Another session may have finished the download while we waited for the lock
+            cached = self.current()
+            if self.usable(cached, min_version):
+                return cached[1]
+            archive_path, digest = self.download()
+            tools_version = self.extract(archive_path, digest)
+            tmp_path = f"{self.pointer}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(tools_version)
+            os.replace(tmp_path, self.pointer)
+            os.remove(archive_path)
+            return self.current()[1]
+
+    def download(self):
+        """Fetch the archive into <archive>.part, resuming with a Range request; returns (path, sha256)"""
+        import requests
+        part_path = os.path.join(self.root, f"{self.archive}.part")
+        meta_path = f"{part_path}.json"
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            offset = os.path.getsize(part_path)
+        except (OSError, ValueError):
+            meta, offset = {}, 0
+        headers = {}
+        # Only resume if the archive on the server is provably still the one we started
+        validator = meta.get("etag") or meta.get("last_modified")
+        if offset and validator:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+        else:
+            offset = 0
+        with requests.get(self.url, headers=headers, stream=True, timeout=self.TIMEOUT) as r:
+            if not (offset and r.status_code == 416):
+                r.raise_for_status()
+                if r.status_code != 206:
+                    offset = 0
+                    with open(meta_path, "w") as f:
+                        json.dump({"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}, f)
+                expected = offset + int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+                print(f"Downloading {self.archive}" + (f" (resuming at {offset // 1024} KB)" if offset else ""))
+                with open(part_path, "ab" if offset else "wb") as f:
+                    for chunk in r.iter_content(chunk_size=self.CHUNK_SIZE):
+                        f.write(chunk)
+                if expected is not None and os.path.getsize(part_path) != expected:
+                    raise ValueError(f"Download of {self.archive} incomplete, it will resume on the next run")
+
+        sha = hashlib.sha256()
+        with open(part_path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        if self.sha256 and digest != self.sha256:
+            os.remove(part_path)
+            os.remove(meta_path)
+            raise ValueError(f"Checksum mismatch for {self.archive}: expected {self.sha256}, got {digest}")
+        archive_path = os.path.join(self.root, self.archive)
+        os.replace(part_path, archive_path)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        return archive_path, digest
+
+    def extract(self, archive_path, digest):
+        """Unpack into versions/<archive>/<Pkg.Revision> through a staging dir; returns the version"""
+        staging = tempfile.mkdtemp(prefix="extract-", dir=self.root)
+        try:
+            if self.archive.endswith(".zip"):
+                import zipfile
+                with zipfile.ZipFile(archive_path) as archive:
+                    for info in archive.infolist():
+                        path = archive.extract(info, staging)
+                        mode = info.external_attr >> 16
+                        if mode and not info.is_dir():
+                            os.chmod(path, mode & 0o777)
+            else:
+                # Stream mode reads the .tar.gz front to back, one member at a time
+                import tarfile
+                safe = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+                with tarfile.open(archive_path, "r|gz") as archive:
+                    for member in archive:
+                        if os.path.isabs(member.name) or ".." in member.name.split("/"):
+                            raise ValueError(f"Unsafe path in {self.archive}: {member.name}")
+                        archive.extract(member, staging, **safe)
+            tools_dir = os.path.join(staging, "platform-tools")
+            if not os.path.isdir(tools_dir):
+                raise ValueError(f"{self.archive} does not contain platform-tools")
+            for name in ("fastboot", "adb"):
+                path = os.path.join(tools_dir, name)
+                if os.path.exists(path):
+                    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+            tools_version = digest[:12]
+            try:
+                with open(os.path.join(tools_dir, "source.properties")) as f:
+                    match = re.search(r"Pkg\.Revision\s*=\s*(\S+)", f.read())
+                if match:
+                    tools_version = match.group(1)
+            except OSError:
+                pass
+            target = os.path.join(self.root, "versions", self.archive, tools_version)
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(staging, target)
+            return tools_version
+        finally:
+            if os.path.exists(staging):
+                shutil.rmtree(staging)
+
+class ImageStore:
+    """Content-addressed images shared by every imported ROM build
+
+    objects/<sha256[:2]>/<sha256>.img holds each distinct image once. A build is a record of its partitions'
+    digests plus a view directory of hard links to those objects (reflinks or copies where linking fails)
+    that can be flashed with --rom like any ROM directory.
+    """
+    FICLONE = 0x40049409
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        self.builds = os.path.join(root, "builds")
+        self.views = os.path.join(root, "views")
+
+    @staticmethod
+    def check_name(name):
+        if not re.fullmatch(r"[A-Za-z0-9_.-]+", name) or name in (".", ".."):
+            raise ValueError(f"invalid build name '{name}', use letters, digits, '.', '_' and '-'")
+
+    def lock(self):
+        os.makedirs(self.root, exist_ok=True)
+        return FileLock(os.path.join(self.root, "store.lock"))
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], f"{digest}.img")
+
+    def view_path(self, name):
+        return os.path.join(self.views, name)
+
+    def names(self):
+        try:
+            return sorted(name[:-len(".json")] for name in os.listdir(self.builds) if name.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def load(self, name):
+        with open(os.path.join(self.builds, f"{name}.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def clone(self, src, dst):
+        """Copy a file as a reflink where the filesystem supports it (btrfs, XFS), a full copy otherwise"""
+        if sys.platform.startswith("linux"):
+            import fcntl
+            with open(src, "rb") as source, open(dst, "wb") as target:
+                try:
+                    fcntl.ioctl(target.fileno(), self.FICLONE, source.fileno())
+                    return
+                except OSError:
+                    pass
+        shutil.copyfile(src, dst)
+
+    def add(self, image, digest=None):
+        """Store one image; returns (digest, False when the store already had that content)"""
+        if digest and os.path.exists(self.object_path(digest)):
+            return digest, False
+        os.makedirs(self.objects, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.objects)
+        os.close(fd)
+        try:
+            if isinstance(image, str) and digest:
+                self.clone(image, tmp_path)
+            else:
+                sha = hashlib.sha256()
+                with open(tmp_path, "wb") as f:
+                    for chunk in iter_image(image):
+                        sha.update(chunk)
+                        f.write(chunk)
+                if digest and sha.hexdigest() != digest:
+                    raise ValueError(f"{image_label(image)} does not match its sha256 {digest}")
+                digest = sha.hexdigest()
+            path = self.object_path(digest)
+            if os.path.exists(path):
+                return digest, False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if sys.platform != "win32":
+                # Every view links to this inode, an edit through one of them would change all builds
+                os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest, True
+
+    def import_build(self, name, source, label=""):
+        """Store every image of a ROM source as build `name`; returns (record, bytes that were already stored)"""
+        self.check_name(name)
+        with self.lock():
+            images = {}
+            reused = 0
+            for part in source.names():
+                digest, added = self.add(source.image(part), source.digest(part))
+                images[part] = {"digest": digest, "size": source.size(part)}
+                if not added:
+                    reused += images[part]["size"]
+            self.write_view(name, images)
+            record = {"name": name, "source": label, "imported": datetime.now().isoformat(), "images": images}
+            os.makedirs(self.builds, exist_ok=True)
+            path = os.path.join(self.builds, f"{name}.json")
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(record, f, indent=2)
+            os.replace(f"{path}.tmp", path)
+        return record, reused
+
+    def write_view(self, name, images):
+        """Directory of <partition>.img links, its inventory filled in so the images are never hashed again"""
+        view = self.view_path(name)
+        staging = f"{view}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        for part, entry in images.items():
+            target = os.path.join(staging, f"{part}.img")
+            try:
+                os.link(self.object_path(entry["digest"]), target)
+            except OSError:
+                self.clone(self.object_path(entry["digest"]), target)
+        inventory = ImageInventory(staging)
+        for part, entry in inventory.scan().items():
+            entry["digest"] = images[part]["digest"]
+        inventory.save()
+        shutil.rmtree(view, ignore_errors=True)
+        os.replace(staging, view)
+
+    def remove(self, name):
+        self.check_name(name)
+        with self.lock():
+            os.remove(os.path.join(self.builds, f"{name}.json"))
+            shutil.rmtree(self.view_path(name), ignore_errors=True)
+
+    def gc(self):
+        """Delete objects and views no build refers to; returns (files, bytes) freed"""
+        files = freed = 0
+        with self.lock():
+            names = self.names()
+            live = {entry["digest"] for name in names for entry in self.load(name)["images"].values()}
+            for dirpath, _, filenames in os.walk(self.objects):
+                for filename in filenames:
+                    if filename.endswith(".img") and filename[:-len(".img")] in live:
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    freed += os.path.getsize(path)
+                    files += 1
+                    os.remove(path)
+            if os.path.isdir(self.views):
+                for view in os.listdir(self.views):
+                    if view not in names:
+                        shutil.rmtree(os.path.join(self.views, view), ignore_errors=True)
+        return files, freed
+
+    def usage(self):
+        """(bytes all builds reference, bytes the objects take on disk)"""
+        referenced = sum(entry["size"] for name in self.names() for entry in self.load(name)["images"].values())
+        stored = 0
+        for dirpath, _, filenames in os.walk(self.objects):
+            stored += sum(os.path.getsize(os.path.join(dirpath, filename)) for filename in filenames)
+        return referenced, stored
+
+class LogWriter:
+    """JSONL log records for every session, written by one background thread in batches"""
+    BATCH_SIZE = 256
+    FLUSH_INTERVAL = 0.2
+    MAX_BYTES = 16 * 1024 * 1024
+    BACKUPS = 3
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.files = {}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        # Runs on normal exit, sys.exit and uncaught exceptions alike
+        atexit.register(self.close)
+
+    @classmethod
+    def shared(cls):
+        with cls.instance_lock:
+            if cls.instance is None:
+                cls.instance = cls()
+            return cls.instance
+
+    def write(self, path, record):
+        self.queue.put((path, json.dumps(record, default=str) + "\n"))
+
+    def flush(self):
+        """Block until everything queued so far is on disk"""
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.FLUSH_INTERVAL
+            while batch[-1] is not None and len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self.write_batch([item for item in batch if item is not None])
+            except OSError as e:
+                import colorama
+                print(f"{colorama.Fore.RED}Failed to write log: {str(e)}{colorama.Style.RESET_ALL}")
+            for _ in batch:
+                self.queue.task_done()
+            if batch[-1] is None:
+                for f in self.files.values():
+                    f.close()
+                self.files.clear()
+                return
+
+    def write_batch(self, batch):
+        lines = {}
+        for path, line in batch:
+            lines.setdefault(path, []).append(line)
+        for path, entries in lines.items():
+            data = "".join(entries).encode()
+            f = self.files.get(path)
+            if f is None:
+                f = self.files[path] = open(path, "ab")
+            if f.tell() and f.tell() + len(data) > self.MAX_BYTES:
+                f.close()
+                self.rotate(path)
+                f = self.files[path] = open(path, "ab")
+            f.write(data)
+            f.flush()
+
+    def rotate(self, path):
+        for i in range(self.BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}"):
+                os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+        os.replace(path, f"{path}.1")
+
+class FlashReport:
+    """Timing spans for flash phases and fastboot commands, written as JSON and as a Chrome trace"""
+    def __init__(self):
+        self.started = time.time()
+        self.status = "failed"
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category, transfers=None):
+        """Time a block; bytes are whatever uploads finished in `transfers` while it ran"""
+        before = len(transfers) if transfers is not None else 0
+        span = {"name": name, "category": category, "start": time.time(), "thread": threading.get_ident()}
+        try:
+            yield span
+        except BaseException as e:
+            span["error"] = type(e).__name__
+            raise
+        finally:
+            span["seconds"] = time.time() - span["start"]
+            span["bytes"] = sum(transfer["size"] for transfer in transfers[before:]) if transfers is not None else 0
+            if span["bytes"] and span["seconds"]:
+                span["mb_per_s"] = round(span["bytes"] / span["seconds"] / (1024 * 1024), 2)
+            with self.lock:
+                self.spans.append(span)
+
+    def write(self, path, info):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        phases = [span for span in spans if span["category"] == "phase"]
+        commands = [span for span in spans if span["category"] == "command"]
+        report = dict(info)
+        report.update({
+            "status": self.status,
+            "started": datetime.fromtimestamp(self.started).isoformat(),
+            "seconds": round(time.time() - self.started, 3),
+            "bytes": sum(span["bytes"] for span in commands),
+            "phases": phases,
+            "commands": commands,
+        })
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    def write_trace(self, path, process_name=None):
+        """chrome://tracing / Perfetto trace-event file, one complete event per span"""
+        with self.lock:
+            spans = list(self.spans)
+        events = [{"name": "process_name", "ph": "M", "pid": 1, "args": {"name": process_name or "flash"}}]
+        for span in spans:
+            args = {key: span[key] for key in ("bytes", "mb_per_s", "error") if span.get(key)}
+            events.append({"name": span["name"], "cat": span["category"], "ph": "X", "pid": 1,
+                           "tid": span["thread"], "ts": int((span["start"] - self.started) * 1e6),
+                           "dur": int(span["seconds"] * 1e6), "args": args})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+class FlashPlan:
+    """Ordered flash steps, grouped so the device switches between bootloader and fastbootd as rarely as possible"""
+    ANY = "any"
+    BOOTLOADER = "bootloader"
+    FASTBOOTD = "fastbootd"
+    # Rough figures for the estimate: USB 2.0 fastboot throughput and one bootloader<->fastbootd reboot
+    TRANSFER_RATE = 35 * 1024 * 1024
+    REBOOT_SECONDS = 30
+    COMMAND_SECONDS = 0.5
+
+    def __init__(self, start_mode=BOOTLOADER):
+        self.start_mode = start_mode
+        self.steps = []
+
+    def add(self, mode, title, action, size=0, commands=1, final=False, name=None):
+        self.steps.append({"mode": mode, "title": title, "action": action, "size": size,
+                           "commands": commands, "final": final, "switch": False,
+                           "name": name or getattr(action, "__name__", title)})
+
+    def ordered(self):
+        """Steps in run order: whatever the current mode allows first, then one switch, then the rest"""
+        def group(step):
+            if step["final"]:
+                return 2
+            return 0 if step["mode"] in (self.ANY, self.start_mode) else 1
+        mode = self.start_mode
+        ordered = []
+        for step in sorted(self.steps, key=group):
+            if step["mode"] not in (self.ANY, mode):
+                mode = step["mode"]
+                ordered.append({"mode": mode, "title": f"Reboot to {mode}", "action": None, "size": 0,
+                                "commands": 1, "final": False, "switch": True,
+                                "name": "handle_fastbootd_reboot" if mode == self.FASTBOOTD else "handle_bootloader_reboot"})
+            ordered.append(step)
+        return ordered
+
+    def estimate(self):
+        """(bytes to send, mode switches, seconds) for the whole plan"""
+        steps = self.ordered()
+        total = sum(step["size"] for step in steps)
+        switches = sum(1 for step in steps if step["switch"])
+        seconds = (total / self.TRANSFER_RATE + switches * self.REBOOT_SECONDS +
+                   sum(step["commands"] for step in steps) * self.COMMAND_SECONDS)
+        return total, switches, seconds
+
+    def run(self, flasher):
+        for step in self.ordered():
+            flasher.phase = step["name"]
+            with flasher.report.span(step["name"], "phase", flasher.progress.transfers):
+                if not step["switch"]:
+                    step["action"]()
+                elif step["mode"] == self.FASTBOOTD:
+                    flasher.handle_fastbootd_reboot()
+                else:
+                    flasher.handle_bootloader_reboot()
+            if flasher.journal and not step["switch"]:
+                flasher.journal.complete_step(step["name"])
+
+    @staticmethod
+    def format_size(size):
+        for unit in ["B", "KB", "MB"]:
+            if size < 1024:
+                return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+            size /= 1024
+        return f"{size:.2f} GB"
+
+class FlashPipeline:
+    """Runs prepare() for upcoming items on worker threads while the caller consumes earlier ones"""
+    def __init__(self, prepare, workers=2, depth=2, discard=None):
+        self.prepare = prepare
+        self.workers = workers
+        self.depth = depth  # prepared items waiting at most, this is what caps memory and scratch space
+        self.discard = discard  # cleanup for items prepared but never consumed
+
+    def run(self, items):
+        """Yield (item, prepared) in order"""
+        items = iter(items)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                for item in items:
+                    pending.append((item, pool.submit(self.prepare, item)))
+                    if len(pending) > self.depth:
+                        item, future = pending.popleft()
+                        yield item, future.result()
+                while pending:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            finally:
+                for _, future in pending:
+                    if not future.cancel() and self.discard:
+                        try:
+                            self.discard(future.result())
+                        except Exception:
+                            pass
+
+    @staticmethod
+    def read_ahead(chunks, depth=8):
+        """Pull chunks from a generator on a background thread, keeping at most depth of them buffered"""
+        buffer = queue.Queue(maxsize=depth)
+        done = object()
+        stop = threading.Event()
+
+        def offer(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for chunk in chunks:
+                    if not offer(chunk):
+                        return
+                offer(done)
+            except BaseException as e:
+                offer(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                chunk = buffer.get()
+                if chunk is done:
+                    return
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+        finally:
+            stop.set()
+
+class FlashManifest:
+    """Digests of the images last flashed successfully to one device"""
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        try:
+            with open(path) as f:
+                self.entries = json.load(f).get("entries", {})
+        except (OSError, ValueError):
+            pass
+
+    def matches(self, target, digest, slot):
+        entry = self.entries.get(target)
+        return bool(entry) and entry["digest"] == digest and entry["slot"] == slot
+
+    def record(self, target, digest, slot):
+        self.entries[target] = {"digest": digest, "slot": slot, "time": datetime.now().isoformat()}
+        self.save()
+
+    def forget(self, targets):
+        if any(self.entries.pop(target, None) for target in targets):
+            self.save()
+
+    def forget_partitions(self, partitions):
+        self.forget([target for target in list(self.entries)
+                     if target in partitions or (target[-2:] in ("_a", "_b") and target[:-2] in partitions)])
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"entries": self.entries}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+class FlashJournal:
+    """Progress of one device's flash as JSON lines, one record appended per completed command so it can be resumed
+
+    Replaying the records gives the state; start() truncates the file for the next flash.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.file = None
+        self.torn = False
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self.apply(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        # A record cut short by a crash; the ones before it still count
+                        pass
+                    self.torn = not line.endswith("\n")
+        except OSError:
+            pass
+
+    def apply(self, record):
+        record = dict(record)
+        kind = record.pop("record")
+        if kind == "start":
+            self.data = dict(record, finished=False, steps={}, flashed={}, commands=[])
+        elif self.data is None:
+            return
+        elif kind == "command":
+            self.data["commands"].append(record)
+        elif kind == "flash":
+            self.data["flashed"][record.pop("target")] = record
+        elif kind == "forget":
+            for target in record["targets"]:
+                self.data["flashed"].pop(target, None)
+        elif kind == "step":
+            self.data["steps"][record["step"]] = record["time"]
+        elif kind == "finish":
+            self.data["finished"] = True
+
+    def add(self, record, sync=True):
+        self.apply(record)
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, "a", encoding="utf-8")
+            if self.torn:
+                self.file.write("\n")
+                self.torn = False
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        if sync:
+            # Flashed images and finished steps have to survive a pulled cable, not just a killed process
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        self.file = None
+
+    def unfinished(self):
+        return bool(self.data) and not self.data.get("finished")
+
+    def start(self, serial, device, rom, answers):
+        self.close()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.torn = False
+        self.add({"record": "start", "serial": serial, "device": device, "rom": rom, "answers": answers,
+                  "started": datetime.now().isoformat()})
+
+    def record_command(self, step, command, slot):
+        # Informational only, resuming goes by the flash and step records
+        self.add({"record": "command", "step": step, "command": command, "slot": slot,
+                  "time": datetime.now().isoformat()}, sync=False)
+
+    def record_flash(self, step, target, partition, digest, slot):
+        self.add({"record": "flash", "target": target, "step": step, "partition": partition, "digest": digest,
+                  "slot": slot, "time": datetime.now().isoformat()})
+
+    def flashed(self, target, slot):
+        """The record of target flashed to this slot, if any"""
+        entry = self.data["flashed"].get(target) if self.data else None
+        return entry if entry and entry["slot"] == slot else None
+
+    def step_targets(self, step):
+        return [entry for entry in self.data["flashed"].values() if entry["step"] == step]
+
+    def forget_partitions(self, partitions):
+        flashed = self.data["flashed"] if self.data else {}
+        targets = [target for target, entry in flashed.items() if entry["partition"] in partitions]
+        if targets:
+            self.add({"record": "forget", "targets": targets})
+
+    def complete_step(self, step):
+        self.add({"record": "step", "step": step, "time": datetime.now().isoformat()})
+
+    def finish(self):
+        self.add({"record": "finish", "time": datetime.now().isoformat()})
+        self.close()
+
+class TransferTuner:
+    """Upload chunk and download sizes measured per board and backend, so later flashes start with the fastest"""
+    CHUNK_SIZES = [64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+    CHUNK_SAMPLE = 8 * 1024 * 1024
+    DOWNLOAD_SIZES = [1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024]
+    # Rates this close to the best count as a tie, the smaller chunk wins it
+    TOLERANCE = 0.05
+
+    def __init__(self, path):
+        self.path = path
+        self.profiles = {}
+        try:
+            with open(path) as f:
+                self.profiles = json.load(f).get("profiles", {})
+        except (OSError, ValueError):
+            pass
+
+    def lookup(self, board, backend, max_download_size):
+        profile = self.profiles.get(f"{board}:{backend}")
+        # A bootloader update can change the download buffer, which voids the old measurements
+        if profile and profile["max_download_size"] == max_download_size:
+            return profile
+        return None
+
+    def calibrate(self, send, max_download_size, chunked=True):
+        """send(size, chunk_size) uploads `size` throwaway bytes to the device and returns the seconds it took"""
+        chunk_rates = []
+        chunk_size = None
+        if chunked:
+            sample = min(self.CHUNK_SAMPLE, max_download_size)
+            for size in [size for size in self.CHUNK_SIZES if size <= sample]:
+                chunk_rates.append((size, sample / send(sample, size)))
+            best = max(rate for _, rate in chunk_rates)
+            chunk_size = min(size for size, rate in chunk_rates if rate >= best * (1 - self.TOLERANCE))
+        download_rates = []
+        for size in [size for size in self.DOWNLOAD_SIZES if size <= max_download_size] or [max_download_size]:
+            download_rates.append((size, size / send(size, chunk_size)))
+        best_size, best_rate = max(download_rates, key=lambda result: result[1])
+        # Still speeding up at the largest sample: the whole buffer is at least as fast
+        sparse_limit = max_download_size if best_size == download_rates[-1][0] else best_size
+        return {"max_download_size": max_download_size, "chunk_size": chunk_size, "sparse_limit": sparse_limit,
+                "mb_per_s": round(best_rate / (1024 * 1024), 2),
+                "chunks": [[size, round(rate / (1024 * 1024), 2)] for size, rate in chunk_rates],
+                "downloads": [[size, round(rate / (1024 * 1024), 2)] for size, rate in download_rates],
+                "time": datetime.now().isoformat()}
+
+    def save(self, board, backend, profile):
+        self.profiles[f"{board}:{backend}"] = profile
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"profiles": self.profiles}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+class ImageHeader:
+    """Format, header version and sizes an image declares, read from its first page"""
+    BOOT_MAGIC = b"ANDROID!"
+    VENDOR_BOOT_MAGIC = b"VNDRBOOT"
+    AVB_MAGIC = b"AVB0"
+    DTBO_MAGIC = 0xD7B7AB1E
+    AVB_HEADER = struct.Struct(">4sIIQQ")
+    AVB_HEADER_SIZE = 256
+    AVB_HASH_DESCRIPTOR = struct.Struct(">Q32sIII")
+    HEAD_SIZE = 4096
+
+    @staticmethod
+    def align(size, page):
+        return (size + page - 1) // page * page
+
+    @classmethod
+    def inspect(cls, image):
+        """{"kind", "version", "size": bytes written to the partition, "content": bytes the header says the file holds}"""
+        size = image_size(image)
+        with open_image(image) as f:
+            head = f.read(cls.HEAD_SIZE)
+        info = {"kind": "raw", "version": None, "size": size, "content": 0}
+        if len(head) >= SparseImage.HEADER.size and struct.unpack_from("<I", head)[0] == SparseImage.MAGIC:
+            _, major, _, _, _, block_size, total_blocks, _, _ = SparseImage.HEADER.unpack_from(head)
+            info.update(kind="sparse", version=major, size=block_size * total_blocks)
+        elif head.startswith(cls.BOOT_MAGIC):
+            info.update(kind="boot", **cls.boot_layout(head))
+        elif head.startswith(cls.VENDOR_BOOT_MAGIC):
+            info.update(kind="vendor_boot", **cls.vendor_boot_layout(head))
+        elif head.startswith(cls.AVB_MAGIC):
+            _, major, minor, auth_size, aux_size = cls.AVB_HEADER.unpack_from(head)
+            if major != 1:
+                raise ValueError(f"vbmeta needs libavb {major}.{minor}")
+            info.update(kind="vbmeta", version=f"{major}.{minor}",
+                        content=cls.AVB_HEADER_SIZE + auth_size + aux_size)
+        elif len(head) >= 4 and struct.unpack_from(">I", head)[0] == cls.DTBO_MAGIC:
+            total_size, = struct.unpack_from(">I", head, 4)
+            info.update(kind="dtbo", content=total_size)
+        return info
+
+    @classmethod
+    def boot_layout(cls, head):
+        if len(head) < 1660:
+            raise ValueError("boot header is cut short")
+        version, = struct.unpack_from("<I", head, 40)
+        if version >= 3:
+            if version > 4:
+                raise ValueError(f"unsupported boot header version {version}")
+            page = 4096
+            sections = list(struct.unpack_from("<II", head, 8))
+            if version == 4:
+                sections.append(struct.unpack_from("<I", head, 1580)[0])
+        else:
+            kernel, _, ramdisk, _, second, _, _, page = struct.unpack_from("<8I", head, 8)
+            if not page or page & (page - 1):
+                raise ValueError(f"invalid boot page size {page}")
+            sections = [kernel, ramdisk, second]
+            if version >= 1:
+                sections.append(struct.unpack_from("<I", head, 1632)[0])
+            if version == 2:
+                sections.append(struct.unpack_from("<I", head, 1648)[0])
+        return {"version": version, "content": page + sum(cls.align(size, page) for size in sections)}
+
+    @classmethod
+    def vendor_boot_layout(cls, head):
+        if len(head) < 2128:
+            raise ValueError("vendor_boot header is cut short")
+        version, page = struct.unpack_from("<II", head, 8)
+        if version not in (3, 4):
+            raise ValueError(f"unsupported vendor_boot header version {version}")
+        if not page or page & (page - 1):
+            raise ValueError(f"invalid vendor_boot page size {page}")
+        ramdisk, = struct.unpack_from("<I", head, 24)
+        header_size, dtb = struct.unpack_from("<II", head, 2096)
+        sections = [ramdisk, dtb]
+        if version == 4:
+            table, _, _, bootconfig = struct.unpack_from("<4I", head, 2112)
+            sections += [table, bootconfig]
+        return {"version": version,
+                "content": cls.align(header_size, page) + sum(cls.align(size, page) for size in sections)}
+
+    @classmethod
+    def hash_descriptors(cls, image):
+        """(partition, image size, hash algorithm, salt, digest) for every hash descriptor of a vbmeta image"""
+        with open_image(image) as f:
+            head = f.read(cls.AVB_HEADER_SIZE)
+            _, _, _, auth_size, aux_size = cls.AVB_HEADER.unpack_from(head)
+            f.read(auth_size)
+            aux = f.read(aux_size)
+        offset, length = struct.unpack_from(">QQ", head, 96)
+        end = min(offset + length, len(aux))
+        descriptors = []
+        while offset + 16 <= end:
+            tag, following = struct.unpack_from(">QQ", aux, offset)
+            if tag == 2:
+                size, algorithm, name_len, salt_len, digest_len = cls.AVB_HASH_DESCRIPTOR.unpack_from(aux, offset + 16)
+                data = offset + 16 + 116
+                name = aux[data:data + name_len].decode("utf-8", "replace")
+                salt = aux[data + name_len:data + name_len + salt_len]
+                digest = aux[data + name_len + salt_len:data + name_len + salt_len + digest_len]
+                descriptors.append((name, size, algorithm.rstrip(b"\0").decode(), salt, digest))
+            offset += 16 + following
+        return descriptors
+
+    @staticmethod
+    def avb_digest(image, size, algorithm, salt):
+        """Digest AVB computes over the first `size` bytes of an image, None when it is shorter"""
+        digest = hashlib.new(algorithm, salt)
+        remaining = size
+        for chunk in iter_image(image):
+            digest.update(chunk[:remaining])
+            remaining -= min(len(chunk), remaining)
+            if not remaining:
+                break
+        return digest.digest() if not remaining else None
+
+class SparseImage:
+    """Android sparse image kept as a block map; chunk data stays in the source file until streamed"""
+    MAGIC = 0xED26FF3A
+    HEADER = struct.Struct("<IHHHHIIII")
+    CHUNK = struct.Struct("<HHII")
+    CHUNK_RAW = 0xCAC1
+    CHUNK_FILL = 0xCAC2
+    CHUNK_DONT_CARE = 0xCAC3
+    CHUNK_CRC32 = 0xCAC4
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, block_size, total_blocks, chunks=None):
+        self.block_size = block_size
+        self.total_blocks = total_blocks
+        # (start_block, type, blocks, source, source offset for RAW / 4-byte pattern for FILL)
+        self.chunks = chunks or []
+
+    @classmethod
+    def is_sparse(cls, path):
+        with open_image(path) as f:
+            header = f.read(4)
+        return len(header) == 4 and struct.unpack("<I", header)[0] == cls.MAGIC
+
+    @classmethod
+    def unpacked_size(cls, path):
+        """Size a sparse image expands to, None for a raw image"""
+        with open_image(path) as f:
+            header = f.read(cls.HEADER.size)
+        if len(header) < cls.HEADER.size:
+            return None
+        fields = cls.HEADER.unpack(header)
+        return fields[5] * fields[6] if fields[0] == cls.MAGIC else None
+
+    @classmethod
+    def load(cls, path, block_size=4096):
+        if hasattr(path, "sparse_image"):
+            # payload.bin images already know which blocks hold data
+            return path.sparse_image()
+        return cls.from_sparse(path) if cls.is_sparse(path) else cls.from_raw(path, block_size)
+
+    @classmethod
+    def from_sparse(cls, path):
+        with open_image(path) as f:
+            (magic, major, _, file_hdr_sz, chunk_hdr_sz, block_size,
+             total_blocks, total_chunks, _) = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC or major != 1:
+                raise ValueError(f"{path}: not a version 1 sparse image")
+            image = cls(block_size, total_blocks)
+            offset = file_hdr_sz
+            block = 0
+            for _ in range(total_chunks):
+                f.seek(offset)
+                chunk_type, _, blocks, total_sz = cls.CHUNK.unpack(f.read(cls.CHUNK.size))
+                data_offset = offset + chunk_hdr_sz
+                if chunk_type == cls.CHUNK_RAW:
+                    image.chunks.append((block, chunk_type, blocks, path, data_offset))
+                elif chunk_type == cls.CHUNK_FILL:
+                    f.seek(data_offset)
+                    image.chunks.append((block, chunk_type, blocks, None, f.read(4)))
+                elif chunk_type not in (cls.CHUNK_DONT_CARE, cls.CHUNK_CRC32):
+                    raise ValueError(f"{path}: unknown chunk type {chunk_type:#x}")
+                block += blocks
+                offset += total_sz
+        return image
+
+    @classmethod
+    def from_raw(cls, path, block_size=4096):
+        """Scan a raw image, keeping uniform blocks (zeros included) as fills
+
+        Zeros are written as FILL, not DONT_CARE, like libsparse: a recreated logical partition still holds
+        whatever its extents held before, so skipping them would leave old data under the new filesystem.
+        """
+        size = image_size(path)
+        image = cls(block_size, (size + block_size - 1) // block_size)
+        zero_buffer = bytes(cls.BUFFER_SIZE)
+        run = None  # [start_block, type, blocks, source, value]
+
+        def emit(kind, block, value):
+            nonlocal run
+            if run and run[1] == kind and run[0] + run[2] == block and (kind != cls.CHUNK_FILL or run[4] == value):
+                run[2] += 1
+                return
+            if run:
+                image.chunks.append(tuple(run))
+            run = [block, kind, 1, path if kind == cls.CHUNK_RAW else None, value]
+
+        with open_image(path) as f:
+            block = 0
+            while True:
+                buf = f.read(cls.BUFFER_SIZE)
+                if not buf:
+                    break
+                if len(buf) % block_size:
+                    buf += bytes(block_size - len(buf) % block_size)
+                if buf == zero_buffer[:len(buf)]:
+                    for _ in range(len(buf) // block_size):
+                        emit(cls.CHUNK_FILL, block, b"\0\0\0\0")
+                        block += 1
+                    continue
+                for pos in range(0, len(buf), block_size):
+                    pattern = buf[pos:pos + 4]
+                    if pattern == buf[pos + 4:pos + 8] and buf[pos:pos + block_size] == pattern * (block_size // 4):
+                        emit(cls.CHUNK_FILL, block, pattern)
+                    else:
+                        emit(cls.CHUNK_RAW, block, block * block_size)
+                    block += 1
+        if run:
+            image.chunks.append(tuple(run))
+        return image
+
+    @property
+    def expanded_size(self):
+        return self.total_blocks * self.block_size
+
+    def chunk_data_size(self, kind, blocks):
+        return 4 if kind == self.CHUNK_FILL else blocks * self.block_size
+
+    def size(self):
+        size = self.HEADER.size
+        position = 0
+        for start, kind, blocks, _, _ in self.chunks:
+            if start > position:
+                size += self.CHUNK.size
+            size += self.CHUNK.size + self.chunk_data_size(kind, blocks)
+            position = start + blocks
+        if position < self.total_blocks:
+            size += self.CHUNK.size
+        return size
+
+    def split(self, max_size):
+        """Cut into sparse images of at most max_size bytes that together cover every block"""
+        base = self.HEADER.size
+        pieces = []
+        current = []
+        cost = base
+        for start, kind, blocks, source, value in self.chunks:
+            while blocks:
+                position = current[-1][0] + current[-1][2] if current else 0
+                gap = self.CHUNK.size if start > position else 0
+                room = max_size - cost - gap - self.CHUNK.size
+                # A piece that stops short of the last block ends with a hole chunk
+                if start + blocks < self.total_blocks or self.chunk_data_size(kind, blocks) > room:
+                    room -= self.CHUNK.size
+                if kind == self.CHUNK_FILL:
+                    take = blocks if room >= 4 else 0
+                else:
+                    take = min(blocks, max(room, 0) // self.block_size)
+                if not take:
+                    if not current:
+                        raise ValueError(f"max-download-size {max_size} is too small for one sparse chunk")
+                    pieces.append(SparseImage(self.block_size, self.total_blocks, current))
+                    current = []
+                    cost = base
+                    continue
+                current.append((start, kind, take, source, value))
+                cost += gap + self.CHUNK.size + self.chunk_data_size(kind, take)
+                if kind == self.CHUNK_RAW:
+                    value += take * self.block_size
+                start += take
+                blocks -= take
+        if current or not pieces:
+            pieces.append(SparseImage(self.block_size, self.total_blocks, current))
+        return pieces
+
+    def stream(self):
+        """Yield the serialized sparse image in bounded buffers"""
+        gaps = 0
+        position = 0
+        for start, _, blocks, _, _ in self.chunks:
+            gaps += start > position
+            position = start + blocks
+        gaps += position < self.total_blocks
+        yield self.HEADER.pack(self.MAGIC, 1, 0, self.HEADER.size, self.CHUNK.size, self.block_size,
+                               self.total_blocks, len(self.chunks) + gaps, 0)
+        position = 0
+        reader = SparseImage.ChunkReader()
+        try:
+            for start, kind, blocks, source, value in self.chunks:
+                if start > position:
+                    yield self.CHUNK.pack(self.CHUNK_DONT_CARE, 0, start - position, self.CHUNK.size)
+                data_size = self.chunk_data_size(kind, blocks)
+                yield self.CHUNK.pack(kind, 0, blocks, self.CHUNK.size + data_size)
+                if kind == self.CHUNK_FILL:
+                    yield value
+                else:
+                    yield from reader.read(source, value, data_size)
+                position = start + blocks
+            if position < self.total_blocks:
+                yield self.CHUNK.pack(self.CHUNK_DONT_CARE, 0, self.total_blocks - position, self.CHUNK.size)
+        finally:
+            reader.close()
+
+    def iter_raw(self):
+        """Yield the expanded image, holes included, in bounded buffers"""
+        def zeros(size):
+            while size:
+                data = bytes(min(size, self.BUFFER_SIZE))
+                size -= len(data)
+                yield data
+        position = 0
+        reader = SparseImage.ChunkReader()
+        try:
+            for start, kind, blocks, source, value in self.chunks:
+                yield from zeros((start - position) * self.block_size)
+                size = blocks * self.block_size
+                if kind == self.CHUNK_FILL:
+                    while size:
+                        data = value * (min(size, self.BUFFER_SIZE) // 4)
+                        size -= len(data)
+                        yield data
+                else:
+                    yield from reader.read(source, value, size)
+                position = start + blocks
+            yield from zeros((self.total_blocks - position) * self.block_size)
+        finally:
+            reader.close()
+
+    class ChunkReader:
+        """Reads RAW chunk data, keeping only the current source open"""
+        def __init__(self):
+            self.source = None
+            self.file = None
+
+        def read(self, source, offset, size):
+            if source is not self.source:
+                self.close()
+                self.source = source
+                self.file = open_image(source)
+            self.file.seek(offset)
+            while size:
+                data = self.file.read(min(size, SparseImage.BUFFER_SIZE))
+                if not data:
+                    # Raw images are padded up to the block size
+                    data = bytes(min(size, SparseImage.BUFFER_SIZE))
+                size -= len(data)
+                yield data
+
+        def close(self):
+            if self.file:
+                self.file.close()
+            self.source = None
+            self.file = None
+
+    def write_to(self, f):
+        for data in self.stream():
+            f.write(data)
+
+class SuperImageBuilder:
+    """lpmake equivalent: lays out LP metadata and extents for the logical images of one super partition"""
+    RESERVED_BYTES = 4096
+    GEOMETRY_SIZE = 4096
+    GEOMETRY_MAGIC = 0x616C4467
+    HEADER_MAGIC = 0x414C5030
+    SECTOR_SIZE = 512
+    BLOCK_SIZE = 4096
+    ATTR_READONLY = 0x1
+    HEADER_FLAG_VIRTUAL_AB = 0x1
+    GEOMETRY = struct.Struct("<II32sIII")
+    TABLE = struct.Struct("<III")
+    PARTITION = struct.Struct("<36sIIII")
+    EXTENT = struct.Struct("<QIQI")
+    GROUP = struct.Struct("<36sIQ")
+    BLOCK_DEVICE = struct.Struct("<QIIQ36sI")
+
+    def __init__(self, super_size, partitions, group="main", slot_suffixes=("_a", "_b"), metadata_size=65536,
+                 metadata_slots=2, alignment=1024 * 1024, group_size=None, virtual_ab=False):
+        self.super_size = super_size
+        self.partitions = partitions  # (name, image path or None)
+        self.group = group
+        self.slot_suffixes = list(slot_suffixes)
+        self.metadata_size = metadata_size
+        self.metadata_slots = metadata_slots
+        self.alignment = alignment
+        self.virtual_ab = virtual_ab
+        metadata_end = self.RESERVED_BYTES + 2 * self.GEOMETRY_SIZE + 2 * metadata_size * metadata_slots
+        self.first_usable = self.align(metadata_end)
+        self.group_size = group_size or (super_size - self.first_usable)
+
+    def align(self, value):
+        return (value + self.alignment - 1) // self.alignment * self.alignment
+
+    def geometry(self):
+        fields = [self.GEOMETRY_MAGIC, self.GEOMETRY.size, bytes(32),
+                  self.metadata_size, self.metadata_slots, self.BLOCK_SIZE]
+        fields[2] = hashlib.sha256(self.GEOMETRY.pack(*fields)).digest()
+        return self.GEOMETRY.pack(*fields).ljust(self.GEOMETRY_SIZE, b"\0")
+
+    def metadata(self, layout):
+        """Serialize the header and tables for one metadata slot"""
+        groups = [self.GROUP.pack(b"default", 0, 0)]
+        groups += [self.GROUP.pack(f"{self.group}{suffix}".encode(), 0, self.group_size) for suffix in self.slot_suffixes]
+        partitions = []
+        extents = []
+        for name, _, group_index, start, size in layout:
+            partitions.append(self.PARTITION.pack(name.encode(), self.ATTR_READONLY, len(extents),
+                                                  1 if size else 0, group_index))
+            if size:
+                extents.append(self.EXTENT.pack(size // self.SECTOR_SIZE, 0, start // self.SECTOR_SIZE, 0))
+        block_devices = [self.BLOCK_DEVICE.pack(self.first_usable // self.SECTOR_SIZE, self.alignment, 0,
+                                                self.super_size, b"super", 0)]
+
+        tables = b""
+        descriptors = []
+        for entries, struct_def in [(partitions, self.PARTITION), (extents, self.EXTENT),
+                                    (groups, self.GROUP), (block_devices, self.BLOCK_DEVICE)]:
+            descriptors.append(self.TABLE.pack(len(tables), len(entries), struct_def.size))
+            tables += b"".join(entries)
+
+        minor, header_size = (2, 256) if self.virtual_ab else (0, 128)
+        def header(checksum):
+            data = (struct.pack("<IHHI", self.HEADER_MAGIC, 10, minor, header_size) + checksum +
+                    struct.pack("<I", len(tables)) + hashlib.sha256(tables).digest() + b"".join(descriptors))
+            if self.virtual_ab:
+                data += struct.pack("<I", self.HEADER_FLAG_VIRTUAL_AB)
+            return data.ljust(header_size, b"\0")
+        blob = header(hashlib.sha256(header(bytes(32))).digest()) + tables
+        if len(blob) > self.metadata_size:
+            raise ValueError(f"metadata needs {len(blob)} bytes, more than the {self.metadata_size} available")
+        return blob.ljust(self.metadata_size, b"\0")
+
+    def build(self, metadata_path):
+        """Write the metadata region to metadata_path and return the whole super as a SparseImage"""
+        images = {name: SparseImage.load(path, self.BLOCK_SIZE) for name, path in self.partitions if path}
+        layout = []
+        position = self.first_usable
+        for slot_index, suffix in enumerate(self.slot_suffixes):
+            used = 0
+            for name, _ in self.partitions:
+                # Only the first slot gets data, the others are created empty like lpmake does
+                image = images.get(name) if slot_index == 0 else None
+                size = image.expanded_size if image else 0
+                if size:
+                    position = self.align(position)
+                    layout.append((f"{name}{suffix}", name, slot_index + 1, position, size))
+                    position += size
+                    used += size
+                else:
+                    layout.append((f"{name}{suffix}", name, slot_index + 1, 0, 0))
+            if used > self.group_size:
+                raise ValueError(f"{used} bytes of images exceed group {self.group}{suffix} ({self.group_size} bytes)")
+        if position > self.super_size:
+            raise ValueError(f"{position} bytes of images exceed the {self.super_size} byte super partition")
+
+        metadata = self.metadata(layout)
+        with open(metadata_path, "wb") as f:
+            f.write(bytes(self.RESERVED_BYTES))
+            f.write(self.geometry() * 2)
+            f.write(metadata * self.metadata_slots * 2)
+
+        result = SparseImage(self.BLOCK_SIZE, self.super_size // self.BLOCK_SIZE)
+        result.chunks.extend(SparseImage.from_raw(metadata_path, self.BLOCK_SIZE).chunks)
+        for _, name, _, start, size in layout:
+            if not size:
+                continue
+            base = start // self.BLOCK_SIZE
+            result.chunks.extend((base + chunk[0],) + chunk[1:] for chunk in images[name].chunks)
+        return result
+
+class FastbootError(Exception):
+    pass
+
+class FastbootRemoteError(FastbootError):
+    """The device answered FAIL, as opposed to the transport going away"""
+    pass
+
+class FastbootOutputParser:
+    """Turns fastboot's output, fed in arbitrary pieces, into send/write/okay progress events"""
+    TOKEN = re.compile(r"Sending(?: sparse)? '(?P<send>[^']+)'(?: (?P<piece>\d+)/(?P<pieces>\d+))? \((?P<kb>\d+) KB\)"
+                       r"|Writing '(?P<write>[^']+)'"
+                       r"|OKAY \[\s*(?P<okay>[\d.]+)s\]")
+
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self.line = ""
+        self.emitted = 0  # tokens of the current line already reported
+
+    def feed(self, text):
+        *complete, self.line = (self.line + text).split("\n")
+        for line in complete:
+            self.scan(line)
+            self.emitted = 0
+        self.scan(self.line)
+
+    def scan(self, line):
+        tokens = list(self.TOKEN.finditer(line))
+        for match in tokens[self.emitted:]:
+            if match.group("send"):
+                event = {"event": "send", "target": match.group("send"), "size": int(match.group("kb")) * 1024}
+                if match.group("piece"):
+                    event["piece"] = (int(match.group("piece")), int(match.group("pieces")))
+            elif match.group("write"):
+                event = {"event": "write", "target": match.group("write")}
+            else:
+                event = {"event": "okay", "seconds": float(match.group("okay"))}
+            self.on_event(event)
+        self.emitted = len(tokens)
+
+class TransferProgress:
+    """Current transfer and recent throughput, fed by progress events and read by the spinner"""
+    def __init__(self, on_complete=None):
+        self.lock = threading.RLock()
+        self.on_complete = on_complete
+        self.current = None
+        self.rate = None  # bytes/s of the last finished upload, for ETAs when fastboot gives no byte counts
+        self.transfers = []
+
+    def handle(self, event):
+        now = time.time()
+        with self.lock:
+            kind = event["event"]
+            if kind in ("send", "write"):
+                label = f"Sending '{event['target']}'" if kind == "send" else f"Writing '{event['target']}'"
+                if event.get("piece"):
+                    label += " %d/%d" % event["piece"]
+                self.current = {"label": label, "size": event.get("size", 0), "sent": None, "start": now}
+                return
+            current = self.current
+            if current is None:
+                return
+            if kind == "bytes":
+                current["sent"] = event["sent"]
+                return
+            # okay: fastboot's own timing when it printed one, ours otherwise
+            self.current = None
+            if not current["size"]:
+                return
+            seconds = event.get("seconds") or now - current["start"]
+            if seconds > 0:
+                self.rate = current["size"] / seconds
+            transfer = {"label": current["label"], "size": current["size"], "seconds": seconds}
+            self.transfers.append(transfer)
+        if self.on_complete:
+            self.on_complete(transfer)
+
+    def clear(self):
+        with self.lock:
+            self.current = None
+
+    def status(self):
+        with self.lock:
+            current = self.current
+            if current is None:
+                return None
+            elapsed = max(time.time() - current["start"], 1e-6)
+            if not current["size"]:
+                return f"{current['label']} {elapsed:.0f}s"
+            if current["sent"] is not None:
+                sent, rate = current["sent"], current["sent"] / elapsed
+            elif self.rate:
+                # The binary reports nothing until OKAY; extrapolate from the last upload
+                sent, rate = min(self.rate * elapsed, current["size"] * 0.99), self.rate
+            else:
+                return f"{current['label']} {FlashPlan.format_size(current['size'])} {elapsed:.0f}s"
+        eta = (current["size"] - sent) / rate if rate else 0
+        return (f"{current['label']} {sent * 100 // current['size']:.0f}% "
+                f"{rate / (1024 * 1024):.1f} MB/s ETA {int(eta) // 60}:{int(eta) % 60:02d}")
+
+class DeviceWatcher:
+    """Follows one device through reboots, reporting each state change as an event"""
+    BOOTLOADER = "bootloader"
+    FASTBOOTD = "fastbootd"
+    GONE = "gone"
+    REBOOT_TIMEOUT = 120
+    # Poll quickly right after a change, then back off while nothing happens
+    MIN_INTERVAL = 0.1
+    MAX_INTERVAL = 2.0
+
+    def __init__(self, flasher, on_event=None):
+        self.flasher = flasher
+        self.on_event = on_event or flasher.report_device_event
+        self.state = None
+
+    def probe(self):
+        native = self.flasher.native
+        if native:
+            try:
+                native.connect(timeout=0)
+            except FastbootError:
+                return self.GONE
+            try:
+                userspace = native.getvar("is-userspace", cached=False)
+            except FastbootRemoteError:
+                # Bootloaders that predate fastbootd do not know the variable
+                userspace = "no"
+            except FastbootError:
+                native.disconnect()
+                return self.GONE
+            return self.FASTBOOTD if userspace == "yes" else self.BOOTLOADER
+        fastboot = self.flasher.fastboot_path
+        serial = self.flasher.device_serial
+        try:
+            self.flasher.spawns += 1
+            result = subprocess.run([fastboot, "devices"], stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, text=True, timeout=10)
+            serials = [line.split()[0] for line in result.stdout.splitlines() if "fastboot" in line.lower()]
+            if serial not in serials if serial else not serials:
+                return self.GONE
+            cmd = [fastboot] + (["-s", serial] if serial else []) + ["getvar", "is-userspace"]
+            self.flasher.spawns += 1
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            return self.GONE
+        return self.FASTBOOTD if re.search(r"is-userspace:\s*yes", result.stdout) else self.BOOTLOADER
+
+    def poll(self):
+        return self.observe(self.probe())
+
+    def observe(self, state):
+        """Record a state, probed or learned elsewhere (getvar all), reporting it if it changed"""
+        if state != self.state:
+            event = {"serial": self.flasher.device_serial, "from": self.state, "to": state, "time": time.time()}
+            self.state = state
+            self.on_event(event)
+        return state
+
+    def wait_for(self, state, timeout=None):
+        """Poll until the device is in exactly this state; False once the timeout runs out"""
+        deadline = time.time() + (self.REBOOT_TIMEOUT if timeout is None else timeout)
+        interval = self.MIN_INTERVAL
+        while True:
+            previous = self.state
+            if self.poll() == state:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            interval = self.MIN_INTERVAL if self.state != previous else min(interval * 1.5, self.MAX_INTERVAL)
+            time.sleep(min(interval, remaining))
+
+class FastbootTcpTransport:
+    """fastboot over TCP: FB01 handshake, then every packet is prefixed by a 64-bit length"""
+    def __init__(self, host, port=5554, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+
+    def open(self):
+        import socket
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self.sock.sendall(b"FB01")
+            reply = self.recv_exact(4)
+        except OSError as e:
+            self.close()
+            raise FastbootError(f"Cannot connect to {self.host}:{self.port}: {str(e)}")
+        if not reply.startswith(b"FB"):
+            self.close()
+            raise FastbootError(f"Unexpected handshake from {self.host}:{self.port}: {reply!r}")
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def recv_exact(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise FastbootError("Connection closed by device")
+            data += chunk
+        return bytes(data)
+
+    def write(self, data):
+        try:
+            self.sock.sendall(struct.pack(">Q", len(data)) + bytes(data))
+        except OSError as e:
+            raise FastbootError(f"Write failed: {str(e)}")
+
+    def read(self):
+        try:
+            size = struct.unpack(">Q", self.recv_exact(8))[0]
+            return self.recv_exact(size)
+        except OSError as e:
+            raise FastbootError(f"Read failed: {str(e)}")
+
+class FastbootUsbTransport:
+    """fastboot over USB bulk endpoints, needs the optional pyusb package"""
+    def __init__(self, serial=None, timeout=30):
+        self.serial = serial
+        self.timeout = timeout
+        self.device = None
+        self.ep_in = None
+        self.ep_out = None
+
+    @staticmethod
+    def find_interfaces(serial=None):
+        try:
+            import usb.core
+        except ImportError:
+            raise FastbootError("pyusb is not installed")
+        found = []
+        try:
+            for dev in usb.core.find(find_all=True):
+                for cfg in dev:
+                    for intf in cfg:
+                        if (intf.bInterfaceClass, intf.bInterfaceSubClass, intf.bInterfaceProtocol) != (0xFF, 0x42, 0x03):
+                            continue
+                        try:
+                            dev_serial = dev.serial_number
+                        except (ValueError, usb.core.USBError):
+                            dev_serial = None
+                        if serial is None or dev_serial == serial:
+                            found.append((dev, intf, dev_serial))
+        except usb.core.NoBackendError:
+            raise FastbootError("No libusb backend available")
+        return found
+
+    def open(self):
+        matches = self.find_interfaces(self.serial)
+        import usb.util
+        if not matches:
+            raise FastbootError(f"USB device {self.serial} not found" if self.serial else "No fastboot USB device found")
+        self.device, intf, self.serial = matches[0]
+        for ep in intf:
+            if usb.util.endpoint_type(ep.bmAttributes) != usb.util.ENDPOINT_TYPE_BULK:
+                continue
+            if usb.util.endpoint_direction(ep.bEndpointAddress) == usb.util.ENDPOINT_IN:
+                self.ep_in = ep
+            else:
+                self.ep_out = ep
+        if not self.ep_in or not self.ep_out:
+            raise FastbootError("fastboot interface has no bulk endpoints")
+
+    def close(self):
+        if self.device:
+            try:
+                import usb.util
+                usb.util.dispose_resources(self.device)
+            except Exception:
+                pass
+        self.device = None
+
+    def write(self, data):
+        try:
+            self.ep_out.write(data, self.timeout * 1000)
+        except Exception as e:
+            raise FastbootError(f"Write failed: {str(e)}")
+
+    def read(self):
+        try:
+            return bytes(self.ep_in.read(512, self.timeout * 1000))
+        except Exception as e:
+            raise FastbootError(f"Read failed: {str(e)}")
+
+class SimulatedDevice:
+    """In-process fastboot device for calibration and benchmarks, selected with -s sim:[option=value,...]
+
+    bandwidth is in MB/s, latency (per command) and overhead (per USB/TCP write) in milliseconds,
+    reboot_delay in seconds; fail=<command prefix> makes the first matching command fail.
+    """
+    SLOTTED = {"boot", "vendor_boot", "init_boot", "dtbo", "recovery"}
+    devices = {}
+    lock = threading.Lock()
+
+    def __init__(self, serial, bandwidth=40.0, latency=2.0, overhead=0.0, max_download_size=256 * 1024 * 1024,
+                 product="sim", reboot_delay=0.0, fail=None):
+        self.serial = serial
+        self.reboot_delay = reboot_delay
+        self.fail = fail
+        self.available_at = 0
+        self.bandwidth = bandwidth * 1024 * 1024
+        self.latency = latency / 1000
+        self.overhead = overhead / 1000
+        self.vars = {"product": product, "max-download-size": f"{max_download_size:#x}", "current-slot": "a",
+                     "slot-count": "2", "is-userspace": "no", "partition-size:super": f"{8 * 1024 ** 3:#x}"}
+        self.pending = 0
+        self.downloaded = 0
+        # Sparse header of the last download, a flash is checked against the size it unpacks to
+        self.download_head = b""
+        self.flashed = {}
+        # Logical partitions and their sizes, as fastbootd keeps them in super's metadata
+        self.logical = {}
+        self.stats = {"commands": 0, "bytes": 0, "reboots": 0}
+
+    @classmethod
+    def create(cls, serial, **options):
+        """Register a fresh device under a serial, replacing whatever state an earlier run left"""
+        with cls.lock:
+            cls.devices[serial] = cls(serial, **options)
+            return cls.devices[serial]
+
+    @classmethod
+    def get(cls, serial):
+        """The device behind a sim: serial, created once so reconnects after a reboot see the same state"""
+        with cls.lock:
+            if serial not in cls.devices:
+                options = {}
+                for option in filter(None, serial[len("sim:"):].split(",")):
+                    key, sep, value = option.partition("=")
+                    if not sep:
+                        raise FastbootError(f"Bad simulated device option: {option}")
+                    options[key] = value if key in ("product", "fail") else float(value)
+                if "max_download_size" in options:
+                    options["max_download_size"] = int(options["max_download_size"])
+                try:
+                    cls.devices[serial] = cls(serial, **options)
+                except TypeError as e:
+                    raise FastbootError(f"Bad simulated device options: {str(e)}")
+            return cls.devices[serial]
+
+    def receive(self, data):
+        """Replies to one packet written by the host"""
+        if self.overhead:
+            time.sleep(self.overhead)
+        if self.pending:
+            time.sleep(len(data) / self.bandwidth)
+            if self.pending == self.downloaded:
+                self.download_head = bytes(data[:SparseImage.HEADER.size])
+            self.pending -= len(data)
+            self.stats["bytes"] += len(data)
+            if self.pending < 0:
+                self.pending = 0
+                return [b"FAILdata larger than announced"]
+            return [] if self.pending else [b"OKAY"]
+        time.sleep(self.latency)
+        self.stats["commands"] += 1
+        command = bytes(data).decode(errors="replace")
+        if self.fail and command.startswith(self.fail):
+            self.fail = None
+            return [b"FAILinjected failure"]
+        name, _, arg = command.partition(":")
+        if name == "getvar":
+            if arg == "all":
+                return [f"INFO{key}:{value}".encode() for key, value in self.vars.items()] + [b"OKAY"]
+            if arg.startswith("has-slot:"):
+                name = arg[len("has-slot:"):]
+                return [b"OKAYyes" if name in self.SLOTTED or f"{name}_a" in self.logical else b"OKAYno"]
+            if arg.startswith("is-logical:") and self.vars["is-userspace"] == "yes":
+                return [b"OKAYyes" if arg[len("is-logical:"):] in self.logical else b"OKAYno"]
+            if arg in self.vars:
+                return [f"OKAY{self.vars[arg]}".encode()]
+            return [b"FAILunknown variable"]
+        if name == "download":
+            size = int(arg, 16)
+            if size > int(self.vars["max-download-size"], 0):
+                return [b"FAILdata too large"]
+            self.pending = self.downloaded = size
+            return [f"DATA{size:08x}".encode()]
+        if name == "flash":
+            size = self.downloaded
+            if len(self.download_head) == SparseImage.HEADER.size:
+                header = SparseImage.HEADER.unpack(self.download_head)
+                if header[0] == SparseImage.MAGIC:
+                    size = header[5] * header[6]
+            if arg in self.logical and size > self.logical[arg]:
+                return [b"FAILPartition should be resized before flashing"]
+            self.flashed[arg] = self.downloaded
+            return [b"OKAY"]
+        if name == "set_active":
+            self.vars["current-slot"] = arg
+            return [b"OKAY"]
+        if name == "erase":
+            return [b"OKAY"]
+        if name in ("create-logical-partition", "delete-logical-partition", "resize-logical-partition"):
+            if self.vars["is-userspace"] != "yes":
+                return [b"FAILcommand only available in fastbootd"]
+            partition, _, size = arg.partition(":")
+            if name == "delete-logical-partition":
+                self.logical.pop(partition, None)
+            elif name == "create-logical-partition" or partition in self.logical:
+                self.logical[partition] = int(size)
+            else:
+                return [b"FAILCould not find partition"]
+            return [b"OKAY"]
+        if name in ("reboot", "reboot-bootloader", "reboot-fastboot", "reboot-recovery"):
+            self.vars["is-userspace"] = "yes" if name == "reboot-fastboot" else "no"
+            self.stats["reboots"] += 1
+            self.available_at = time.time() + self.reboot_delay
+            return [b"OKAY"]
+        return [b"FAILunknown command"]
+
+class SimulatedTransport:
+    """Transport to a SimulatedDevice, replies are queued as the device produces them"""
+    def __init__(self, device):
+        self.device = device
+        self.replies = deque()
+
+    def open(self):
+        if time.time() < self.device.available_at:
+            raise FastbootError("Simulated device is rebooting")
+
+    def close(self):
+        self.replies.clear()
+
+    def write(self, data):
+        self.replies.extend(self.device.receive(data))
+
+    def read(self):
+        if not self.replies:
+            raise FastbootError("Read failed: simulated device sent nothing")
+        return self.replies.popleft()
+
+class SimulatedTcpServer:
+    """fastboot TCP endpoint on 127.0.0.1 in front of a SimulatedDevice, so spawned processes can reach it too"""
+    def __init__(self, device):
+        import socket
+        self.device = device
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.serial = f"tcp:127.0.0.1:{self.server.getsockname()[1]}"
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        # The device side of the framing is the same as the host side
+        transport = FastbootTcpTransport("127.0.0.1")
+        transport.sock = conn
+        try:
+            # Refused like a device that has not come back from a reboot yet
+            if time.time() < self.device.available_at or transport.recv_exact(4) != b"FB01":
+                return
+            conn.sendall(b"FB01")
+            while True:
+                for reply in self.device.receive(transport.read()):
+                    transport.write(reply)
+        except (FastbootError, OSError):
+            pass
+        finally:
+            transport.close()
+
+    def close(self):
+        self.server.close()
+
+class FastbootProtocol:
+    """fastboot wire protocol on top of an open transport"""
+    def __init__(self, transport, on_info=None):
+        self.transport = transport
+        self.on_info = on_info
+
+    def send(self, command):
+        self.transport.write(command.encode())
+        return self.wait()
+
+    def wait(self):
+        while True:
+            reply = self.transport.read()
+            status, payload = reply[:4], reply[4:].decode(errors="replace")
+            if status == b"OKAY":
+                return payload
+            if status == b"FAIL":
+                raise FastbootRemoteError(payload or "FAILED (remote failure)")
+            if status == b"DATA":
+                return int(payload, 16)
+            if status in (b"INFO", b"TEXT"):
+                if self.on_info:
+                    self.on_info(payload)
+                continue
+            raise FastbootError(f"Unexpected reply: {reply!r}")
+
+    def getvar(self, name):
+        return self.send(f"getvar:{name}")
+
+    def download(self, size, chunks):
+        accepted = self.send(f"download:{size:08x}")
+        if accepted != size:
+            raise FastbootError(f"Device accepted {accepted} of {size} bytes")
+        sent = 0
+        for chunk in chunks:
+            self.transport.write(chunk)
+            sent += len(chunk)
+        if sent != size:
+            raise FastbootError(f"Sent {sent} bytes, expected {size}")
+        return self.wait()
+
+    def flash(self, partition):
+        return self.send(f"flash:{partition}")
+
+    def erase(self, partition):
+        return self.send(f"erase:{partition}")
+
+    def set_active(self, slot):
+        return self.send(f"set_active:{slot}")
+
+    def reboot(self, target=None):
+        return self.send(f"reboot-{target}" if target else "reboot")
+
+    def create_logical_partition(self, name, size):
+        return self.send(f"create-logical-partition:{name}:{size}")
+
+    def delete_logical_partition(self, name):
+        return self.send(f"delete-logical-partition:{name}")
+
+    def resize_logical_partition(self, name, size):
+        return self.send(f"resize-logical-partition:{name}:{size}")
+
+class NativeFastboot:
+    """Keeps one open transport per device and answers fastboot CLI argv without spawning processes"""
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, serial=None, connect_timeout=60):
+        self.serial = serial
+        self.connect_timeout = connect_timeout
+        self.transport = None
+        self.protocol = None
+        self.connected = False
+        self.info = []
+        self.vars = {}
+        # Logical partitions already sized for the image being flashed
+        self.resized = {}
+        self.on_progress = None
+        # Size of each transport write; None keeps the chunks the image source produces
+        self.chunk_size = None
+
+    def create_transport(self):
+        if self.serial and self.serial.startswith("sim:"):
+            return SimulatedTransport(SimulatedDevice.get(self.serial))
+        if self.serial and self.serial.startswith("tcp:"):
+            host, _, port = self.serial[4:].partition(":")
+            return FastbootTcpTransport(host, int(port or 5554))
+        return FastbootUsbTransport(self.serial)
+
+    def list_devices(self):
+        if self.serial and self.serial.startswith(("tcp:", "sim:")):
+            try:
+                self.connect(timeout=0)
+                return [self.serial]
+            except FastbootError:
+                return []
+        return [dev_serial for _, _, dev_serial in FastbootUsbTransport.find_interfaces() if dev_serial]
+
+    def connect(self, timeout=None):
+        if self.protocol:
+            return self.protocol
+        timeout = self.connect_timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        while True:
+            transport = self.create_transport()
+            try:
+                transport.open()
+                break
+            except FastbootError:
+                # The device re-enumerates after a reboot; keep trying until it is back
+                if not self.connected or time.time() >= deadline:
+                    raise
+                time.sleep(0.5)
+        self.transport = transport
+        self.protocol = FastbootProtocol(transport, on_info=self.info.append)
+        self.connected = True
+        return self.protocol
+
+    def disconnect(self):
+        if self.transport:
+            self.transport.close()
+        self.transport = None
+        self.protocol = None
+        self.vars.clear()
+        self.resized.clear()
+
+    def getvar(self, name, cached=True):
+        if cached and name in self.vars:
+            return self.vars[name]
+        value = self.connect().getvar(name)
+        self.vars[name] = value
+        return value
+
+    def resolve_partition(self, partition):
+        try:
+            has_slot = self.getvar(f"has-slot:{partition}")
+        except FastbootError:
+            return partition
+        if has_slot == "yes":
+            return f"{partition}_{self.getvar('current-slot')}"
+        return partition
+
+    def resize_logical(self, partition, image):
+        """What the binary does before a flash in fastbootd: size a logical partition to the unpacked image"""
+        try:
+            if self.getvar(f"is-logical:{partition}") != "yes":
+                return
+        except FastbootRemoteError:
+            # Bootloaders do not know the variable; nothing they flash is logical
+            return
+        if isinstance(image, SparseImage):
+            size = image.expanded_size
+        else:
+            size = SparseImage.unpacked_size(image) or image_size(image)
+        if self.resized.get(partition) != size:
+            self.connect().resize_logical_partition(partition, size)
+            self.resized[partition] = size
+
+    def forget_logical(self, partition):
+        self.vars.pop(f"is-logical:{partition}", None)
+        self.resized.pop(partition, None)
+
+    def read_image(self, img_file, flags):
+        size = os.path.getsize(img_file)
+        if not flags:
+            def chunks():
+                with open(img_file, "rb") as f:
+                    while True:
+                        chunk = f.read(self.chunk_size or self.CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        yield chunk
+            return size, FlashPipeline.read_ahead(chunks())
+        with open(img_file, "rb") as f:
+            data = bytearray(f.read())
+        # AVB vbmeta header: big-endian flags word at offset 120
+        if data[:4] == b"AVB0":
+            data[123] |= flags
+        return size, iter([bytes(data)])
+
+    def send_and_flash(self, partition, size, chunks):
+        protocol = self.connect()
+        if self.chunk_size:
+            chunks = rechunk(chunks, self.chunk_size)
+        if not self.on_progress:
+            protocol.download(size, chunks)
+            protocol.flash(partition)
+            return
+        def counted():
+            sent = 0
+            for chunk in chunks:
+                yield chunk
+                sent += len(chunk)
+                self.on_progress({"event": "bytes", "sent": sent})
+        self.on_progress({"event": "send", "target": partition, "size": size})
+        protocol.download(size, counted())
+        self.on_progress({"event": "okay"})
+        self.on_progress({"event": "write", "target": partition})
+        protocol.flash(partition)
+        self.on_progress({"event": "okay"})
+
+    def execute(self, args, stream=None):
+        """Translate a fastboot argv into protocol calls; returns None for unsupported commands"""
+        self.info.clear()
+        args = list(args)
+        avb_flags = 0
+        if "--disable-verity" in args:
+            args.remove("--disable-verity")
+            avb_flags |= 0x01
+        if "--disable-verification" in args:
+            args.remove("--disable-verification")
+            avb_flags |= 0x02
+        if "-S" in args[:-1]:
+            # Only images up to max-download-size are sent natively, so the sparse limit never applies here
+            index = args.index("-S")
+            del args[index:index + 2]
+        if not args:
+            return None
+
+        command = args[0]
+        if command == "getvar" and len(args) == 2:
+            output = f"{args[1]}: {self.getvar(args[1], cached=False)}"
+            if args[1] == "all":
+                # Answers later has-slot/current-slot lookups without another round trip
+                self.vars.update(parse_getvar_all("".join(f"(bootloader) {line}\n" for line in self.info)))
+        elif command.startswith("--set-active="):
+            slot = command.split("=", 1)[1]
+            self.connect().set_active(slot)
+            self.vars.pop("current-slot", None)
+            output = f"Setting current slot to '{slot}' OKAY"
+        elif command == "erase" and len(args) == 2:
+            partition = self.resolve_partition(args[1])
+            self.connect().erase(partition)
+            output = f"Erasing '{partition}' OKAY"
+        elif command == "flash" and len(args) == 3 and stream is not None:
+            partition = self.resolve_partition(args[1])
+            self.resize_logical(partition, stream)
+            self.send_and_flash(partition, stream.size(), FlashPipeline.read_ahead(stream.stream()))
+            output = f"Sending sparse '{partition}' ({stream.size() // 1024} KB) OKAY\nWriting '{partition}' OKAY"
+        elif command == "flash" and len(args) == 3:
+            img_file = args[2]
+            size, chunks = self.read_image(img_file, avb_flags)
+            max_download = int(self.getvar("max-download-size"), 0)
+            partition = self.resolve_partition(args[1])
+            if size <= max_download:
+                self.resize_logical(partition, img_file)
+                self.send_and_flash(partition, size, chunks)
+                output = f"Sending '{partition}' ({size // 1024} KB) OKAY\nWriting '{partition}' OKAY"
+            elif avb_flags:
+                return None
+            else:
+                # Like the binary: resend an oversized image as sparse pieces that each fit the download buffer
+                try:
+                    sparse_image = SparseImage.load(img_file)
+                    pieces = sparse_image.split(max_download)
+                except ValueError as e:
+                    raise FastbootError(str(e))
+                self.resize_logical(partition, sparse_image)
+                for piece in pieces:
+                    self.send_and_flash(partition, piece.size(), FlashPipeline.read_ahead(piece.stream()))
+                output = f"Sending sparse '{partition}' ({len(pieces)} pieces, {size // 1024} KB) OKAY\nWriting '{partition}' OKAY"
+        elif command == "reboot" and len(args) <= 2:
+            target = args[1] if len(args) == 2 else None
+            if target not in (None, "bootloader", "fastboot", "recovery"):
+                return None
+            self.connect().reboot(target)
+            self.disconnect()
+            output = "Rebooting" + (f" into {target}" if target else "")
+        elif command == "create-logical-partition" and len(args) == 3:
+            self.forget_logical(args[1])
+            self.connect().create_logical_partition(args[1], int(args[2]))
+            output = f"Creating '{args[1]}' OKAY"
+        elif command == "delete-logical-partition" and len(args) == 2:
+            self.forget_logical(args[1])
+            self.connect().delete_logical_partition(args[1])
+            output = f"Deleting '{args[1]}' OKAY"
+        elif command == "resize-logical-partition" and len(args) == 3:
+            self.forget_logical(args[1])
+            self.connect().resize_logical_partition(args[1], int(args[2]))
+            output = f"Resizing '{args[1]}' OKAY"
+        else:
+            return None
+        info = "".join(f"(bootloader) {line}\n" for line in self.info)
+        return subprocess.CompletedProcess(["fastboot"] + list(args), 0, stdout=info + output + "\n")
+
+def simulated_fastboot(argv, serial):
+    """Stand-in for the fastboot binary that the benchmark spawns, answering over a SimulatedTcpServer"""
+    args = list(argv)
+    if args[:1] == ["-s"] and len(args) > 1:
+        serial, args = args[1], args[2:]
+    if args == ["--version"]:
+        print("fastboot version simulated")
+        return 0
+    native = NativeFastboot(serial, connect_timeout=30)
+    try:
+        if args == ["devices"]:
+            for device in native.list_devices():
+                print(f"{device}\tfastboot")
+            return 0
+        result = native.execute(args)
+    except FastbootRemoteError as e:
+        print(f"FAILED (remote: '{str(e)}')", file=sys.stderr)
+        return 1
+    except FastbootError as e:
+        print(f"fastboot: error: {str(e)}", file=sys.stderr)
+        return 1
+    finally:
+        native.disconnect()
+    if result is None:
+        print(f"fastboot: usage: unknown command {' '.join(args)}", file=sys.stderr)
+        return 1
+    sys.stdout.write(result.stdout)
+    return 0
+
+def extract_operations(payload_path, out_path, block_size, operations):
+    """Process pool worker: decode payload operations into the pre-sized, memory-mapped output image"""
+    import mmap
+    written = 0
+    with open(payload_path, "rb") as src, open(out_path, "r+b") as dst:
+        with mmap.mmap(dst.fileno(), 0) as out:
+            for op_type, data_offset, data_length, extents in operations:
+                src.seek(data_offset)
+                data = PayloadOperation.decode(op_type, src.read(data_length))
+                pos = 0
+                for start, blocks in extents:
+                    begin = start * block_size
+                    chunk = data[pos:pos + min(blocks * block_size, len(out) - begin)]
+                    out[begin:begin + len(chunk)] = chunk
+                    pos += blocks * block_size
+                    written += len(chunk)
+    return written
+
+class PayloadExtractor:
+    """Extract the partitions one device profile needs from payload.bin on a process pool"""
+    BATCH_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, flasher, payload, partitions, output_dir, jobs=None):
+        self.flasher = flasher
+        self.payload = payload
+        self.partitions = partitions
+        self.output_dir = output_dir
+        self.jobs = jobs
+
+    def batches(self, image):
+        """Split a partition's operations into batches of about BATCH_SIZE output bytes"""
+        operations = {}
+        for start, blocks, op, _ in image.chunks:
+            if op is None:
+                # ZERO extents: the output file is created zero-filled
+                continue
+            if id(op) not in operations:
+                operations[id(op)] = (op.op_type, self.payload.data_offset + op.data_offset, op.data_length, [])
+            operations[id(op)][3].append((start, blocks))
+        batch = []
+        batch_size = 0
+        for operation in operations.values():
+            batch.append(operation)
+            batch_size += sum(blocks for _, blocks in operation[3]) * image.block_size
+            if batch_size >= self.BATCH_SIZE:
+                yield batch
+                batch = []
+                batch_size = 0
+        if batch:
+            yield batch
+
+    def run(self):
+        f = self.flasher
+        names = [name for name in self.partitions if self.payload.has(name)]
+        missing = [name for name in self.partitions if not self.payload.has(name)]
+        if missing:
+            print(f"{f.color_yellow}Not in payload: {', '.join(missing)}{f.color_reset}")
+        if not names:
+            print(f"{f.color_red}No partitions of this device found in the payload{f.color_reset}")
+            sys.exit(1)
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        start_time = time.time()
+        tasks = []
+        # Largest partitions first so the pool is never left waiting on one big image at the end
+        for name in sorted(names, key=lambda n: self.payload.image(n).size(), reverse=True):
+            image = self.payload.image(name)
+            out_path = os.path.join(self.output_dir, f"{name}.img")
+            with open(out_path, "wb") as out:
+                out.truncate(image.size())
+            for batch in self.batches(image):
+                tasks.append((name, out_path, image.block_size, batch))
+
+        remaining = {name: 0 for name in names}
+        for name, _, _, _ in tasks:
+            remaining[name] += 1
+        for name in names:
+            if not remaining[name]:
+                print(f"{f.color_green}Extracted {name}.img (no data){f.color_reset}")
+        total = 0
+        workers = self.jobs or os.cpu_count() or 1
+        print(f"{f.color_green}Extracting {len(names)} partitions with {workers} workers...{f.color_reset}")
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(extract_operations, self.payload.path, out_path, block_size, batch): name
+                       for name, out_path, block_size, batch in tasks}
+            for future in as_completed(futures):
+                name = futures[future]
+                total += future.result()
+                remaining[name] -= 1
+                if not remaining[name]:
+                    print(f"{f.color_green}Extracted {name}.img{f.color_reset}")
+        elapsed = time.time() - start_time
+        print(f"{f.color_green}Extracted {total // (1024 * 1024)} MB in {elapsed:.1f}s to {self.output_dir}{f.color_reset}")
+
+class FlashProfile:
+    """Declarative answers to every flash decision, so a station can flash without a human"""
+    FIELDS = {"device": str, "slot": str, "wipe": bool, "disable_avb": bool,
+              "allow_missing": (bool, dict), "reboot": bool}
+    SLOTS = ("both", "current")
+    CATEGORIES = ("boot", "logical", "firmware")
+
+    def __init__(self, device="auto", slot="both", wipe=False, disable_avb=False, allow_missing=True, reboot=True):
+        self.device = device
+        self.slot = slot
+        self.wipe = wipe
+        self.disable_avb = disable_avb
+        self.allow_missing = allow_missing
+        self.reboot = reboot
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("a profile is a JSON object")
+        unknown = sorted(set(data) - set(cls.FIELDS))
+        if unknown:
+            raise ValueError(f"unknown keys: {', '.join(unknown)}")
+        for key, kind in cls.FIELDS.items():
+            if key in data and not isinstance(data[key], kind):
+                raise ValueError(f"'{key}' has the wrong type")
+        if data.get("slot", "both") not in cls.SLOTS:
+            raise ValueError(f"'slot' must be one of: {', '.join(cls.SLOTS)}")
+        allow = data.get("allow_missing", True)
+        if isinstance(allow, dict):
+            unknown = sorted(set(allow) - set(cls.CATEGORIES))
+            if unknown or not all(isinstance(value, bool) for value in allow.values()):
+                raise ValueError(f"'allow_missing' maps {', '.join(cls.CATEGORIES)} to true or false")
+        return cls(**data)
+
+    def allows_missing(self, category):
+        if isinstance(self.allow_missing, dict):
+            return self.allow_missing.get(category, True)
+        return self.allow_missing
+
+    def answers(self):
+        """The prompt_yes_no keys this profile settles"""
+        return {
+            "bootloader_unlocked": True,
+            "fastboot_mode": True,
+            "usb_drivers": True,
+            "admin_restart": False,
+            "board_mismatch": False,
+            "slot_both": self.slot == "both",
+            "wipe": self.wipe,
+            "wipe_confirm": self.wipe,
+            "disable_avb": self.disable_avb,
+            "flash_boot": True,
+            "flash_logical": True,
+            "flash_firmware": True,
+            "abort_boot": False,
+            "reboot": self.reboot,
+        }
+
+class FlashFarm:
+    """Flash every attached fastboot device in parallel, one Flash session per serial"""
+    def __init__(self, template, jobs=None):
+        self.template = template
+        self.jobs = jobs
+        self.results = {}
+
+    def collect_answers(self):
+        t = self.template
+        if t.profile:
+            # The profile settles everything; with "auto" every session detects its own device
+            if t.profile.device != "auto":
+                t.set_current_device(t.find_device(t.profile.device), verify=False)
+            return
+        t.check_prerequisites()
+        t.select_device(verify=False)
+        t.collect_answers(unattended=True)
+        # A board mismatch fails that session instead of blocking the whole tray
+        t.answers["board_mismatch"] = False
+
+    def create_session(self, serial):
+        t = self.template
+        session = Flash(serial=serial, devices=t.devices, backend=t.backend)
+        session.fastboot_path = t.fastboot_path
+        session.adb_path = t.adb_path
+        session.spinner_enabled = False
+        session.answers = dict(t.answers)
+        session.profile = t.profile
+        session.headless = t.headless
+        session.delta = t.delta
+        session.force_flash = t.force_flash
+        session.sparse = t.sparse
+        session.build_super = t.build_super
+        if t.trace_file:
+            session.trace_file = session.report_file.replace("flash_report_", "flash_trace_", 1)
+        session.rom = t.rom
+        session.rom_path = t.rom_path
+        session.resume = t.resume
+        session.verifier = t.verifier
+        return session
+
+    def flash_device(self, serial):
+        start = time.time()
+        session = self.create_session(serial)
+        code = 0
+        try:
+            device = self.template.current_device or session.detect_device()
+            if not device:
+                print(f"{session.color_red}{session.tag}Cannot detect the device model{session.color_reset}")
+                sys.exit(Flash.EXIT_WRONG_DEVICE)
+            session.set_current_device(device)
+            session.flash_procedure()
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print(f"{session.color_red}{session.tag}Session failed: {str(e)}{session.color_reset}")
+            session.write_to_log(f"Session failed: {str(e)}")
+            code = Flash.EXIT_FAILED
+        return code, time.time() - start, session.log_file
+
+    def run(self):
+        t = self.template
+        serials = t.list_devices()
+        if not serials:
+            print(f"{t.color_red}No devices detected{t.color_reset}")
+            sys.exit(Flash.EXIT_NO_DEVICE)
+        print(f"\n{t.color_green}## FARM MODE: {len(serials)} DEVICE(S) ##{t.color_reset}")
+        for serial in serials:
+            print(f"{t.color_yellow} - {serial}{t.color_reset}")
+        self.collect_answers()
+
+        workers = min(self.jobs or len(serials), len(serials))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {serial: pool.submit(self.flash_device, serial) for serial in serials}
+            for serial, future in futures.items():
+                self.results[serial] = future.result()
+        self.print_summary()
+        worst = max(code for code, _, _ in self.results.values())
+        if worst:
+            sys.exit(worst)
+
+    def print_summary(self):
+        t = self.template
+        print(f"\n{t.color_green}## FARM SUMMARY ##{t.color_reset}")
+        for serial, (code, elapsed, log_file) in self.results.items():
+            color = t.color_green if code == 0 else t.color_red
+            status = "OK" if code == 0 else f"FAILED ({code})"
+            print(f"{color}{serial}: {status} in {elapsed:.1f}s - {log_file}{t.color_reset}")
+
+class FlashBenchmark:
+    """Full flashes of synthetic ROMs to simulated devices, one scenario per device profile"""
+    MB = 1024 * 1024
+    # Typical sizes of a stock build; scaled down so a run takes seconds, not minutes
+    SIZES = {"boot": 96 * MB, "vendor_boot": 96 * MB, "recovery": 100 * MB, "init_boot": 8 * MB, "dtbo": 24 * MB,
+             "modem": 200 * MB, "md1img": 120 * MB, "dsp": 64 * MB, "bluetooth": 8 * MB, "logo": 16 * MB,
+             "system": 1536 * MB, "system_ext": 600 * MB, "product": 2048 * MB, "vendor": 800 * MB,
+             "odm": 10 * MB, "vendor_dlkm": 60 * MB, "system_dlkm": 20 * MB, "odm_dlkm": 10 * MB}
+    DEFAULT_SIZE = 4 * MB
+    PAGE = 4096
+    # Share of a logical image that is data; the zeroed tail is what sparse conversion saves
+    DATA_RATIO = 0.8
+    METRICS = ("wall_s", "spawns", "bytes", "reboots", "commands")
+    # Wall time is noisy, the counters are exact
+    TOLERANCE = 0.10
+
+    def __init__(self, template, root, scale=0.01, options=None):
+        self.template = template
+        self.root = root
+        self.scale = scale
+        self.options = options or {}
+
+    def scenario(self, device, backend):
+        """Baseline key: results only compare between runs of the same device, backend, image sizes and link"""
+        options = ",".join(f"{key}={value}" for key, value in sorted(self.options.items()))
+        return f"{device['model']}|{backend}|scale={self.scale}|{options}"
+
+    @staticmethod
+    def backends(requested):
+        """auto runs both; the fastboot stand-in is a Python script, so a frozen build only has the native one"""
+        if requested == "auto":
+            return ["native"] if getattr(sys, "frozen", False) else ["native", "fastboot"]
+        return [requested]
+
+    def write_fastboot(self, serial):
+        """A fastboot executable that drives the simulated device through simulated_fastboot"""
+        bin_dir = os.path.join(self.root, "bin")
+        os.makedirs(bin_dir, exist_ok=True)
+        code = (f"import sys\nsys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})\n"
+                f"import flash\nsys.exit(flash.simulated_fastboot(sys.argv[1:], {serial!r}))\n")
+        if platform.system() == "Windows":
+            with open(os.path.join(bin_dir, "fastboot.py"), "w", encoding="utf-8") as f:
+                f.write(code)
+            path = os.path.join(bin_dir, "fastboot.cmd")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(f'@"{sys.executable}" "%~dp0fastboot.py" %*\r\n')
+            return path
+        path = os.path.join(bin_dir, "fastboot")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"#!{sys.executable}\n" + code)
+        os.chmod(path, 0o755)
+        return path
+
+    def build_rom(self, device):
+        """Header-valid images for every partition the device lists, generated once per device and scale"""
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', f"{device['model']}_{self.scale}")
+        rom = os.path.join(self.root, "roms", name)
+        done = os.path.join(rom, ".complete")
+        if os.path.exists(done):
+            return rom
+        os.makedirs(rom, exist_ok=True)
+        for category, names in device["partitions"].items():
+            for part in names:
+                path = os.path.join(rom, f"{part}.img")
+                size = max(int(self.SIZES.get(part, self.DEFAULT_SIZE) * self.scale) // self.PAGE, 4) * self.PAGE
+                if part.startswith("vbmeta") or part == "preloader_raw":
+                    self.write_vbmeta(path)
+                elif part in ("boot", "recovery", "init_boot"):
+                    self.write_boot(path, size)
+                elif part == "vendor_boot":
+                    self.write_vendor_boot(path, size)
+                elif part == "dtbo":
+                    self.write_dtbo(path, size)
+                else:
+                    self.write_raw(path, size, self.DATA_RATIO if category == "logical" else 1.0)
+        open(done, "w").close()
+        return rom
+
+    @classmethod
+    def write_raw(cls, path, size, data_ratio=1.0, head=b""):
+        data = int(size * data_ratio) // cls.PAGE * cls.PAGE
+        with open(path, "wb") as f:
+            f.write(head)
+            for offset in range(len(head), data, cls.MB):
+                f.write(os.urandom(min(cls.MB, data - offset)))
+            f.truncate(size)
+
+    @classmethod
+    def write_boot(cls, path, size):
+        """Boot image v4: header page, kernel, ramdisk"""
+        kernel = (size - cls.PAGE) // 2 // cls.PAGE * cls.PAGE
+        head = bytearray(cls.PAGE)
+        head[:8] = ImageHeader.BOOT_MAGIC
+        struct.pack_into("<IIII", head, 8, kernel, size - cls.PAGE - kernel, 0, 1584)
+        struct.pack_into("<I", head, 40, 4)
+        cls.write_raw(path, size, head=bytes(head))
+
+    @classmethod
+    def write_vendor_boot(cls, path, size):
+        """vendor_boot v4: header page, vendor ramdisk, one page of dtb"""
+        head = bytearray(cls.PAGE)
+        head[:8] = ImageHeader.VENDOR_BOOT_MAGIC
+        struct.pack_into("<II", head, 8, 4, cls.PAGE)
+        struct.pack_into("<I", head, 24, size - 2 * cls.PAGE)
+        struct.pack_into("<II", head, 2096, 2128, cls.PAGE - 16)
+        cls.write_raw(path, size, head=bytes(head))
+
+    @classmethod
+    def write_dtbo(cls, path, size):
+        cls.write_raw(path, size, head=struct.pack(">II", ImageHeader.DTBO_MAGIC, size))
+
+    @classmethod
+    def write_vbmeta(cls, path):
+        """Unsigned vbmeta without descriptors"""
+        head = bytearray(ImageHeader.AVB_HEADER_SIZE)
+        ImageHeader.AVB_HEADER.pack_into(head, 0, ImageHeader.AVB_MAGIC, 1, 0, 0, 0)
+        with open(path, "wb") as f:
+            f.write(head + bytes(8 * 1024 - len(head)))
+
+    def run(self, device, rom, backend="native"):
+        """One headless wipe-and-flash of every partition; counters come from the simulated device
+
+        The fastboot backend reaches the device over TCP through a spawned stand-in binary, so its
+        spawn count and per-process reconnects are measured like the real binary's.
+        """
+        board = device.get("board") or device.get("codename") or device["model"]
+        serial = "sim:bench"
+        sim = SimulatedDevice.create(serial, product=board, **self.options)
+        server = None
+        if backend == "fastboot":
+            server = SimulatedTcpServer(sim)
+            serial = server.serial
+            fastboot_path = self.write_fastboot(serial)
+        else:
+            fastboot_path = self.template.fastboot_path or "fastboot"
+        work = os.path.join(self.root, "run")
+        # Logs stay open in the shared writer, so only the per-run state is cleared
+        shutil.rmtree(os.path.join(work, "journals"), ignore_errors=True)
+        os.makedirs(work, exist_ok=True)
+        flasher = Flash(serial=serial, devices=self.template.devices, backend=backend)
+        flasher.fastboot_path = fastboot_path
+        flasher.spinner_enabled = False
+        flasher.state_dir = work
+        flasher.tuner = TransferTuner(os.path.join(work, "tuning.json"))
+        flasher.log_file = os.path.join(work, "flash_log.jsonl")
+        flasher.report_file = os.path.join(work, "flash_report.json")
+        flasher.rom = DirectorySource(rom)
+        flasher.rom_path = rom
+        flasher.apply_profile(FlashProfile(device=device["model"], wipe=True))
+        output = io.StringIO()
+        code = 0
+        start = time.perf_counter()
+        try:
+            with redirect_stdout(output):
+                flasher.device_checks()
+                flasher.flash_procedure()
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else Flash.EXIT_FAILED
+        finally:
+            if server:
+                server.close()
+        wall = time.perf_counter() - start
+        return {"wall_s": round(wall, 3), "spawns": flasher.spawns, "bytes": sim.stats["bytes"],
+                "reboots": sim.stats["reboots"], "commands": sim.stats["commands"], "exit_code": code,
+                "output": output.getvalue()}
+
+    @classmethod
+    def regressions(cls, result, baseline):
+        """Metrics that got worse than the baseline"""
+        worse = []
+        if result["exit_code"] != baseline.get("exit_code", 0):
+            worse.append(f"exit code {baseline.get('exit_code', 0)} -> {result['exit_code']}")
+        for metric in cls.METRICS:
+            if metric not in baseline:
+                continue
+            limit = baseline[metric] * (1 + cls.TOLERANCE) if metric == "wall_s" else baseline[metric]
+            if result[metric] > limit:
+                worse.append(f"{metric} {baseline[metric]} -> {result[metric]}")
+        return worse
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Universal Android ROM Flasher")
+    parser.add_argument("--farm", action="store_true",
+                        help="flash every attached fastboot device in parallel")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="maximum number of devices flashed at once in farm mode")
+    parser.add_argument("-s", "--serial", default=None,
+                        help="device serial to flash (tcp:host[:port] for fastboot over TCP)")
+    parser.add_argument("--delta", action="store_true",
+                        help="skip partitions whose image and slot match the last successful flash")
+    parser.add_argument("--force", action="store_true",
+                        help="with --delta, reflash everything and refresh the manifest")
+    parser.add_argument("--no-sparse", action="store_true",
+                        help="send logical images unchanged instead of as re-chunked sparse images")
+    parser.add_argument("--build-super", action="store_true",
+                        help="build super locally from the logical images and flash it from the bootloader")
+    parser.add_argument("--rom", default=None,
+                        help="flash from a ROM directory, ROM zip, payload.bin or store:<build> instead of loose *.img files")
+    parser.add_argument("--checksums", default=None,
+                        help="sha256 manifest to verify the images against (default: SHA256SUMS or similar next to them)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the flash plan with estimated bytes and time without touching the device")
+    parser.add_argument("--trace", action="store_true",
+                        help="also write a Chrome trace-event file (chrome://tracing, Perfetto) of the flash")
+    parser.add_argument("--tools-url", default=None,
+                        help="base URL (or local mirror) to download platform-tools-latest-<os> from")
+    parser.add_argument("--tools-sha256", default=None,
+                        help="expected sha256 of the platform-tools archive")
+    parser.add_argument("--backend", choices=["auto", "native", "fastboot"], default="auto",
+                        help="talk the fastboot protocol natively or spawn the fastboot binary")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the device's last unfinished flash from its journal instead of starting over")
+    parser.add_argument("--profile", default=None,
+                        help="run headless: take every answer from this JSON flash profile and never prompt")
+    subparsers = parser.add_subparsers(dest="command")
+    extract = subparsers.add_parser("extract", help="extract a device's partitions from payload.bin")
+    extract.add_argument("payload", help="payload.bin or an OTA zip containing it")
+    extract.add_argument("-o", "--output", default=".", help="directory to write the images to")
+    extract.add_argument("-d", "--device", default=None, help="device model, codename or board")
+    extract.add_argument("-j", "--workers", type=int, default=None,
+                         help="number of extraction processes (default: all cores)")
+    subparsers.add_parser("tune", help="calibrate upload sizes for the attached device and save them for its board")
+    store = subparsers.add_parser("store", help="keep ROM builds in a deduplicated local image store")
+    actions = store.add_subparsers(dest="action", required=True)
+    store_import = actions.add_parser("import", help="add a ROM directory, ROM zip or payload.bin as a build")
+    store_import.add_argument("source", help="ROM to import")
+    store_import.add_argument("--name", default=None, help="build name (default: the source's file name)")
+    actions.add_parser("list", help="list stored builds and the disk space they share")
+    store_path = actions.add_parser("path", help="print the directory of a build's images")
+    store_path.add_argument("name")
+    store_remove = actions.add_parser("remove", help="drop a build and the images no other build uses")
+    store_remove.add_argument("name")
+    store_remove.add_argument("--force", action="store_true", help="also when an unfinished flash uses it")
+    actions.add_parser("gc", help="delete images no build refers to")
+    bench = subparsers.add_parser("bench", help="measure how long parts of the flasher take")
+    bench.add_argument("target", choices=["startup", "flash"], help="what to benchmark")
+    bench.add_argument("-n", "--runs", type=int, default=None,
+                       help="repetitions per measurement (default: 5 for startup, 3 for flash)")
+    bench.add_argument("-d", "--device", default=None, help="flash: only this device model, codename or board")
+    bench.add_argument("--scale", type=float, default=0.01, help="flash: synthetic image size relative to a stock build")
+    bench.add_argument("--bandwidth", type=float, default=35.0, help="flash: simulated link speed in MB/s")
+    bench.add_argument("--latency", type=float, default=1.0, help="flash: simulated per-command latency in ms")
+    bench.add_argument("--reboot-delay", type=float, default=1.0, help="flash: simulated reboot time in seconds")
+    bench.add_argument("--fail", default=None, help="flash: make the first command starting with this prefix fail")
+    bench.add_argument("--save-baseline", action="store_true", help="flash: store these results as the baseline")
+    return parser.parse_args(argv)
+
+def run_extract(flasher, args):
+    import zipfile
+    try:
+        payload = RomSource.open(os.path.abspath(args.payload))
+    except (OSError, ValueError, zipfile.BadZipFile) as e:
+        print(f"{flasher.color_red}Cannot read payload {args.payload}: {str(e)}{flasher.color_reset}")
+        sys.exit(1)
+    if not isinstance(payload, PayloadSource):
+        print(f"{flasher.color_red}{args.payload} does not contain a payload.bin{flasher.color_reset}")
+        sys.exit(1)
+    if args.device:
+        device = flasher.find_device(args.device)
+        if not device:
+            print(f"{flasher.color_red}Unknown device: {args.device}{flasher.color_reset}")
+            sys.exit(1)
+        flasher.set_current_device(device, verify=False)
+    else:
+        flasher.select_device(verify=False)
+    partitions = []
+    for names in flasher.current_device["partitions"].values():
+        partitions += [name for name in names if name not in partitions]
+    PayloadExtractor(flasher, payload, partitions, args.output, jobs=args.workers).run()
+
+def run_store(flasher, args):
+    import zipfile
+    store = ImageStore(os.path.join(flasher.state_dir, "store"))
+    size = FlashPlan.format_size
+    try:
+        if args.action == "import":
+            name = args.name or os.path.splitext(os.path.basename(os.path.abspath(args.source)))[0]
+            source = RomSource.open(os.path.abspath(args.source))
+            start = time.time()
+            record, reused = store.import_build(name, source, os.path.abspath(args.source))
+            total = sum(entry["size"] for entry in record["images"].values())
+            print(f"{flasher.color_green}Imported {len(record['images'])} image(s) ({size(total)}) as '{name}' in "
+                  f"{time.time() - start:.1f}s, {size(reused)} already stored{flasher.color_reset}")
+            print(f"Flash it with --rom store:{name}")
+        elif args.action == "list":
+            for name in store.names():
+                record = store.load(name)
+                total = sum(entry["size"] for entry in record["images"].values())
+                print(f"{name:<32}{len(record['images']):>4} images{size(total):>12}  {record['imported'][:19]}  {record['source']}")
+            referenced, stored = store.usage()
+            print(f"{flasher.color_green}{size(referenced)} in {len(store.names())} build(s), "
+                  f"{size(stored)} on disk{flasher.color_reset}")
+        elif args.action in ("path", "remove") and args.name not in store.names():
+            print(f"{flasher.color_red}No build named '{args.name}' in the store{flasher.color_reset}")
+            sys.exit(1)
+        elif args.action == "path":
+            print(store.view_path(args.name))
+        elif args.action == "remove":
+            journals = os.path.join(flasher.state_dir, "journals")
+            for filename in os.listdir(journals) if os.path.isdir(journals) else []:
+                if not filename.endswith(".jsonl"):
+                    continue
+                journal = FlashJournal(os.path.join(journals, filename))
+                if journal.unfinished() and journal.data["rom"] == store.view_path(args.name) and not args.force:
+                    print(f"{flasher.color_red}An unfinished flash of {journal.data['serial']} uses '{args.name}', "
+                          f"--force removes it anyway{flasher.color_reset}")
+                    sys.exit(1)
+            store.remove(args.name)
+            files, freed = store.gc()
+            print(f"{flasher.color_green}Removed '{args.name}', freed {size(freed)} in {files} file(s){flasher.color_reset}")
+        elif args.action == "gc":
+            files, freed = store.gc()
+            print(f"{flasher.color_green}Freed {size(freed)} in {files} file(s){flasher.color_reset}")
+    except (OSError, ValueError, TimeoutError, zipfile.BadZipFile) as e:
+        print(f"{flasher.color_red}Store {args.action} failed: {str(e)}{flasher.color_reset}")
+        sys.exit(1)
+
+def bench_startup(flasher, runs):
+    """Time each startup stage: interpreter and import, device catalog, cold and cached tool probes"""
+    results = []
+    def measure(name, fn):
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+        results.append((name, sorted(samples)))
+
+    if not getattr(sys, "frozen", False):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        measure("interpreter only", lambda: subprocess.run([sys.executable, "-c", "pass"], check=True))
+        measure("interpreter + import flash", lambda: subprocess.run(
+            [sys.executable, "-c", "import sys; sys.path.insert(0, sys.argv[1]); import flash", script_dir], check=True))
+    catalog = DeviceCatalog(os.path.join(flasher.state_dir, "catalog"))
+    measure("device catalog (local copy)", lambda: catalog.read_cache() or catalog.read_bundled())
+    saved = flasher.tool_versions
+    def cold_probe():
+        flasher.tool_versions = ToolVersionCache()
+        flasher.check_system_tools()
+    measure("tool probes (cold)", cold_probe)
+    flasher.tool_versions = ToolVersionCache()
+    flasher.check_system_tools()
+    measure("tool probes (cached)", flasher.check_system_tools)
+    flasher.tool_versions = saved
+
+    print(f"\n{flasher.color_green}## STARTUP BENCHMARK ({runs} runs) ##{flasher.color_reset}")
+    print(f"{'stage':<30}{'min':>10}{'median':>10}{'max':>10}")
+    for name, samples in results:
+        print(f"{name:<30}{samples[0] * 1000:>8.1f}ms{samples[len(samples) // 2] * 1000:>8.1f}ms{samples[-1] * 1000:>8.1f}ms")
+
+def bench_flash(flasher, args):
+    """Flash every device profile end to end on a simulated link and compare against the saved baseline"""
+    devices = flasher.devices
+    if args.device:
+        device = flasher.find_device(args.device)
+        if not device:
+            print(f"{flasher.color_red}Unknown device: {args.device}{flasher.color_reset}")
+            sys.exit(Flash.EXIT_USAGE)
+        devices = [device]
+    runs = max(args.runs or 3, 1)
+    options = {"bandwidth": args.bandwidth, "latency": args.latency, "reboot_delay": args.reboot_delay}
+    if args.fail:
+        options["fail"] = args.fail
+    root = os.path.join(flasher.state_dir, "bench")
+    bench = FlashBenchmark(flasher, root, scale=args.scale, options=options)
+    baseline_file = os.path.join(root, "baseline.json")
+    try:
+        with open(baseline_file, encoding="utf-8") as f:
+            baselines = json.load(f)
+    except (OSError, ValueError):
+        baselines = {}
+
+    print(f"\n{flasher.color_green}## FLASH BENCHMARK ({runs} runs, scale {args.scale}, "
+          f"{args.bandwidth:g} MB/s, {args.latency:g} ms, reboot {args.reboot_delay:g}s) ##{flasher.color_reset}")
+    print(f"{'device':<24}{'backend':<10}{'wall':>9}{'sent':>10}{'spawns':>8}{'reboots':>9}{'cmds':>6}  result")
+    results = {}
+    regressed = False
+    for device in devices:
+        rom = bench.build_rom(device)
+        for backend in bench.backends(args.backend):
+            samples = [bench.run(device, rom, backend) for _ in range(runs)]
+            result = {metric: sorted(sample[metric] for sample in samples)[runs // 2] for metric in bench.METRICS}
+            result["exit_code"] = max(sample["exit_code"] for sample in samples)
+            key = bench.scenario(device, backend)
+            results[key] = result
+            status = "ok" if not result["exit_code"] else f"exit {result['exit_code']}"
+            color = flasher.color_green if not result["exit_code"] else flasher.color_red
+            worse = bench.regressions(result, baselines[key]) if key in baselines and not args.save_baseline else []
+            if worse:
+                regressed = True
+                color = flasher.color_red
+                status += f", REGRESSION: {'; '.join(worse)}"
+            elif key in baselines and not args.save_baseline:
+                status += f", {result['wall_s'] / baselines[key]['wall_s'] - 1:+.0%} wall vs baseline" if baselines[key]["wall_s"] else ""
+            print(f"{color}{device['model']:<24}{backend:<10}{result['wall_s']:>8.2f}s{result['bytes'] / (1024 * 1024):>7.1f} MB"
+                  f"{result['spawns']:>8}{result['reboots']:>9}{result['commands']:>6}  {status}{flasher.color_reset}")
+            if result["exit_code"]:
+                failed = next(sample for sample in samples if sample["exit_code"])
+                for line in failed["output"].strip().splitlines()[-3:]:
+                    print(f"    {line}")
+
+    if args.save_baseline:
+        baselines.update(results)
+        os.makedirs(root, exist_ok=True)
+        tmp_path = baseline_file + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, baseline_file)
+        print(f"{flasher.color_green}Baseline saved to {baseline_file}{flasher.color_reset}")
+    elif regressed:
+        print(f"{flasher.color_red}Slower or more work than the baseline{flasher.color_reset}")
+        sys.exit(Flash.EXIT_FAILED)
+
+def main(pause=True):
+    import colorama
+    # Windows consoles need the ANSI colors translated; deinit() hands the original streams back
+    colorama.init()
+    code = 0
+    # Until the command line is parsed only a console can answer; a bad one from a script never waits
+    wait = pause and sys.stdin is not None and sys.stdin.isatty()
+    try:
+        args = parse_args()
+        # --profile, --profile=p.json and abbreviations alike: a headless run never waits
+        wait = pause and not args.profile
+        profile = None
+        if args.profile:
+            try:
+                profile = FlashProfile.load(args.profile)
+            except (OSError, ValueError) as e:
+                print(f"{colorama.Fore.RED}Cannot read profile {args.profile}: {str(e)}{colorama.Style.RESET_ALL}")
+                sys.exit(Flash.EXIT_USAGE)
+        flasher = Flash(serial=args.serial, backend=args.backend)
+        if profile:
+            flasher.apply_profile(profile)
+        if args.command == "extract":
+            run_extract(flasher, args)
+            return
+        if args.command == "store":
+            run_store(flasher, args)
+            return
+        if args.command == "bench":
+            if args.target == "flash":
+                bench_flash(flasher, args)
+            else:
+                bench_startup(flasher, max(args.runs or 5, 1))
+            return
+        flasher.delta = args.delta
+        flasher.force_flash = args.force
+        flasher.sparse = not args.no_sparse
+        flasher.build_super = args.build_super
+        flasher.resume = args.resume
+        if args.tools_url:
+            flasher.platform_tools_url = flasher.get_platform_tools_url(args.tools_url)
+        flasher.tools_sha256 = args.tools_sha256
+        if args.trace:
+            flasher.trace_file = flasher.report_file.replace("flash_report_", "flash_trace_", 1)
+        if args.rom:
+            rom_path = os.path.abspath(args.rom)
+            if args.rom.startswith("store:"):
+                rom_path = ImageStore(os.path.join(flasher.state_dir, "store")).view_path(args.rom[len("store:"):])
+            import zipfile
+            try:
+                flasher.rom = RomSource.open(rom_path)
+                flasher.rom_path = rom_path
+            except (OSError, ValueError, zipfile.BadZipFile) as e:
+                print(f"{flasher.color_red}Cannot read ROM {args.rom}: {str(e)}{flasher.color_reset}")
+                sys.exit(Flash.EXIT_USAGE)
+        if args.command == "tune":
+            flasher.setup_environment()
+            flasher.device_checks()
+            flasher.tune_transfers()
+            return
+        if args.dry_run:
+            if profile and profile.device != "auto":
+                flasher.set_current_device(flasher.find_device(profile.device), verify=False)
+            else:
+                flasher.select_device(verify=False)
+            flasher.collect_answers()
+            flasher.preflight_check(probe=False)
+            flasher.display_plan(flasher.plan_flash(probe=False))
+            return
+        checksums = args.checksums or ImageVerifier.find(flasher.rom_path)
+        if checksums:
+            try:
+                expected = ImageVerifier.parse(checksums)
+            except (OSError, ValueError) as e:
+                print(f"{flasher.color_red}Cannot read checksums {checksums}: {str(e)}{flasher.color_reset}")
+                sys.exit(Flash.EXIT_USAGE)
+            # Hashing runs while the tools are checked and the device is found
+            flasher.verifier = ImageVerifier(flasher.rom, expected, checksums)
+            flasher.verifier.start()
+        flasher.setup_environment()
+        if args.farm:
+            FlashFarm(flasher, jobs=args.jobs).run()
+        elif flasher.headless:
+            flasher.run_headless()
+        else:
+            flasher.display_main_menu()
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else Flash.EXIT_FAILED)
+        print(f"\n{colorama.Fore.YELLOW}Process exited with code {code}{colorama.Style.RESET_ALL}")
+    except KeyboardInterrupt:
+        code = Flash.EXIT_INTERRUPTED
+        print(f"\n{colorama.Fore.RED}Operation cancelled by user{colorama.Style.RESET_ALL}")
+    except Exception as e:
+        code = Flash.EXIT_FAILED
+        print(f"\n{colorama.Fore.RED}Unexpected error: {str(e)}{colorama.Style.RESET_ALL}")
+    finally:
+        if wait:
+            try:
+                input("Press Enter to close the window...")
+            except EOFError:
+                pass
+        colorama.deinit()
+    return code
 
 
 if __name__ == "__main__":
+    if getattr(sys, "frozen", False):
+        # Lets the payload extractor's worker processes start from a frozen executable
+        import multiprocessing
+        multiprocessing.freeze_support()
     if "--nopause" not in sys.argv:
-        main()
+        sys.exit(main())
     else:
         sys.argv.remove("--nopause")
-        main()
+        sys.exit(main(pause=False))
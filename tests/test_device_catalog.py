@@ -0,0 +1,43 @@
+import json
+
+import flash
+
+
+def device(model, **extra):
+    return {"model": model, "partitions": {"boot": ["boot"]}, **extra}
+
+
+def test_fetched_copy_wins_and_the_bundled_one_fills_the_gaps():
+    fetched = {"devices": [device("Phone 2", codename="pong", partitions={"boot": ["boot", "dtbo"]}),
+                           device("Phone 3")]}
+    bundled = {"devices": [device("phone 2", super={"group": "qti_dynamic_partitions"}), device("Phone 1")]}
+    merged = flash.DeviceCatalog.merge(fetched, bundled)
+    by_model = {d["model"].lower(): d for d in merged["devices"]}
+    assert sorted(by_model) == ["phone 1", "phone 2", "phone 3"]
+    assert by_model["phone 2"]["super"] == {"group": "qti_dynamic_partitions"}
+    assert by_model["phone 2"]["codename"] == "pong"
+    # An upstream fix to a device the bundle also lists is not shadowed by the older bundled entry
+    assert by_model["phone 2"]["partitions"] == {"boot": ["boot", "dtbo"]}
+    assert by_model["phone 2"]["model"] == "Phone 2"
+
+
+def test_load_keeps_bundled_keys_after_a_revalidation(tmp_path, monkeypatch):
+    bundled_path = tmp_path / "bundled.json"
+    bundled_path.write_text(json.dumps({"devices": [device("Phone 2", super={"group": "main"})]}))
+    monkeypatch.setattr(flash.DeviceCatalog, "bundled_path", staticmethod(lambda: str(bundled_path)))
+    # Nothing listens there, the background revalidation fails like it does offline
+    catalog = flash.DeviceCatalog(str(tmp_path / "cache"), url="http://127.0.0.1:9/devices.json")
+    catalog.save({"etag": None, "last_modified": None, "catalog": {"devices": [device("Phone 2"), device("Phone 3")]}})
+    devices = catalog.load()
+    catalog.thread.join(timeout=15)
+    assert [d["model"] for d in devices] == ["Phone 2", "Phone 3"]
+    assert devices[0]["super"] == {"group": "main"}
+
+
+def test_first_run_uses_the_bundled_copy(tmp_path, monkeypatch):
+    bundled_path = tmp_path / "bundled.json"
+    bundled_path.write_text(json.dumps({"devices": [device("Phone 2")]}))
+    monkeypatch.setattr(flash.DeviceCatalog, "bundled_path", staticmethod(lambda: str(bundled_path)))
+    catalog = flash.DeviceCatalog(str(tmp_path / "cache"), url="http://127.0.0.1:9/devices.json")
+    assert [d["model"] for d in catalog.load()] == ["Phone 2"]
+    catalog.thread.join(timeout=15)
@@ -0,0 +1,41 @@
+import sys
+
+import pytest
+
+import flash
+
+
+@pytest.fixture
+def bench(tmp_path):
+    template = flash.Flash()
+    options = {"bandwidth": 2000, "latency": 0, "reboot_delay": 0}
+    return flash.FlashBenchmark(template, str(tmp_path / "bench"), scale=0.002, options=options)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="the stand-in binary is a shebang script")
+def test_both_backends_flash_the_same_bytes(bench):
+    device = next(d for d in bench.template.devices if d["model"] == "Nothing Phone 2")
+    rom = bench.build_rom(device)
+    native = bench.run(device, rom, "native")
+    binary = bench.run(device, rom, "fastboot")
+    assert native["exit_code"] == 0, native["output"]
+    assert binary["exit_code"] == 0, binary["output"]
+    assert native["spawns"] == 0
+    # Every fastboot call went through the stand-in executable and reached the device over TCP
+    assert binary["spawns"] > 0
+    assert binary["bytes"] == native["bytes"]
+    assert binary["reboots"] == native["reboots"]
+
+
+def test_stand_in_binary_reports_remote_failures(capsys):
+    device = flash.SimulatedDevice.create("sim:stand-in", latency=0, fail="erase")
+    server = flash.SimulatedTcpServer(device)
+    try:
+        assert flash.simulated_fastboot(["devices"], server.serial) == 0
+        assert f"{server.serial}\tfastboot" in capsys.readouterr().out
+        assert flash.simulated_fastboot(["-s", server.serial, "getvar", "product"], None) == 0
+        assert "product: sim" in capsys.readouterr().out
+        assert flash.simulated_fastboot(["erase", "userdata"], server.serial) == 1
+        assert "FAILED (remote: 'injected failure')" in capsys.readouterr().err
+    finally:
+        server.close()
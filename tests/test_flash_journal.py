@@ -0,0 +1,112 @@
+"""FlashJournal records, and headless flashes against a SimulatedDevice interrupted by an injected failure and resumed"""
+import json
+import os
+
+import pytest
+
+import flash
+
+
+@pytest.fixture
+def rom(tmp_path):
+    template = flash.Flash()
+    device = template.find_device("Nothing Phone 2")
+    bench = flash.FlashBenchmark(template, str(tmp_path / "bench"), scale=0.002)
+    return device, bench.build_rom(device)
+
+
+def run(monkeypatch, tmp_path, serial, rom_path, *extra):
+    profile = tmp_path / "profile.json"
+    profile.write_text(json.dumps({"device": "Nothing Phone 2", "slot": "current", "wipe": True}))
+    argv = ["flash.py", "--serial", serial, "--backend", "native", "--rom", rom_path, "--profile", str(profile)]
+    monkeypatch.setattr("sys.argv", argv + list(extra))
+    return flash.main(pause=False)
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    monkeypatch.setattr(flash.DeviceCatalog, "URL", "http://127.0.0.1:9/devices.json")
+    # The native backend needs no platform-tools
+    monkeypatch.setattr(flash.Flash, "setup_environment", lambda self: setattr(self, "fastboot_path", "fastboot"))
+
+
+def test_journal_replays_its_records(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = flash.FlashJournal(path)
+    journal.start("sim:a", "Nothing Phone 2", "rom.zip", {"wipe": True})
+    journal.record_flash("images", "boot_a", "boot", "d1", "a")
+    journal.record_flash("images", "system_a", "system", "d2", "a")
+    journal.forget_partitions({"system"})
+    journal.complete_step("images")
+    journal.close()
+
+    replayed = flash.FlashJournal(path)
+    assert replayed.unfinished()
+    assert replayed.data["answers"] == {"wipe": True}
+    assert list(replayed.data["flashed"]) == ["boot_a"]
+    assert replayed.flashed("boot_a", "a")["digest"] == "d1"
+    # A record for the other slot does not count
+    assert replayed.flashed("boot_a", "b") is None
+    assert "images" in replayed.data["steps"]
+    replayed.finish()
+    assert not flash.FlashJournal(path).unfinished()
+
+
+def test_torn_last_record_is_ignored_and_not_appended_to(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = flash.FlashJournal(str(path))
+    journal.start("sim:a", "Nothing Phone 2", "rom.zip", {})
+    journal.record_flash("images", "boot_a", "boot", "d1", "a")
+    journal.close()
+    # A pulled cable in the middle of the next record
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"record": "flash", "target": "vbmeta')
+
+    journal = flash.FlashJournal(str(path))
+    assert journal.torn
+    assert list(journal.data["flashed"]) == ["boot_a"]
+    journal.record_flash("images", "dtbo_a", "dtbo", "d3", "a")
+    journal.close()
+    assert list(flash.FlashJournal(str(path)).data["flashed"]) == ["boot_a", "dtbo_a"]
+
+
+def test_resume_continues_after_an_injected_failure(monkeypatch, tmp_path, rom, capsys):
+    device, rom_path = rom
+    board = device.get("board") or device.get("codename") or device["model"]
+    serial = f"sim:product={board},latency=0,bandwidth=2000,fail=flash:system"
+    flash.SimulatedDevice.devices.pop(serial, None)
+    sim = flash.SimulatedDevice.get(serial)
+
+    assert run(monkeypatch, tmp_path, serial, rom_path) == flash.Flash.EXIT_FAILED
+    assert "injected failure" in capsys.readouterr().out
+    first_bytes = sim.stats["bytes"]
+    journal = flash.FlashJournal(os.path.join(os.environ["HOME"], ".universal-flasher", "journals",
+                                              serial.replace(":", "_").replace("=", "_").replace(",", "_") + ".jsonl"))
+    assert journal.unfinished()
+    done = {entry["partition"] for entry in journal.data["flashed"].values()}
+    assert done and "system" not in done
+
+    sim.flashed.clear()
+    assert run(monkeypatch, tmp_path, serial, rom_path, "--resume") == 0
+    out = capsys.readouterr().out
+    assert "Resuming the flash started" in out
+    assert "Already done" in out
+    resumed_bytes = sim.stats["bytes"] - first_bytes
+    clean = flash.SimulatedDevice.create("sim:clean", product=board, latency=0, bandwidth=2000)
+    assert run(monkeypatch, tmp_path, "sim:clean", rom_path) == 0
+    # Only what the interruption left undone is sent again
+    assert 0 < resumed_bytes < clean.stats["bytes"]
+    flashed = {target[:-2] if target.endswith(("_a", "_b")) else target for target in sim.flashed}
+    assert "system" in flashed
+    assert not done & flashed
+    assert not flash.FlashJournal(journal.path).unfinished()
+
+
+def test_resume_without_an_unfinished_flash_is_refused(monkeypatch, tmp_path, rom, capsys):
+    device, rom_path = rom
+    board = device.get("board") or device.get("codename") or device["model"]
+    serial = f"sim:product={board},latency=0,bandwidth=2000"
+    flash.SimulatedDevice.devices.pop(serial, None)
+    assert run(monkeypatch, tmp_path, serial, rom_path) == 0
+    assert run(monkeypatch, tmp_path, serial, rom_path, "--resume") == flash.Flash.EXIT_USAGE
+    assert "No unfinished flash recorded" in capsys.readouterr().out
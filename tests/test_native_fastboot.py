@@ -0,0 +1,236 @@
+import os
+import socket
+import struct
+import subprocess
+import threading
+
+import pytest
+
+import flash
+
+
+class ScriptedTransport:
+    """Replays canned replies and records what the host wrote"""
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.written = []
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def read(self):
+        return self.replies.pop(0)
+
+
+def test_protocol_collects_info_and_returns_okay_payload():
+    info = []
+    transport = ScriptedTransport([b"INFOproduct:taro", b"TEXTslot a", b"OKAYdone"])
+    protocol = flash.FastbootProtocol(transport, on_info=info.append)
+    assert protocol.getvar("all") == "done"
+    assert transport.written == [b"getvar:all"]
+    assert info == ["product:taro", "slot a"]
+
+
+def test_protocol_fail_and_garbage_replies():
+    protocol = flash.FastbootProtocol(ScriptedTransport([b"FAILpartition does not exist"]))
+    with pytest.raises(flash.FastbootRemoteError, match="partition does not exist"):
+        protocol.flash("nope")
+    protocol = flash.FastbootProtocol(ScriptedTransport([b"WHAT"]))
+    with pytest.raises(flash.FastbootError):
+        protocol.getvar("product")
+
+
+def test_protocol_download_sends_the_announced_size():
+    transport = ScriptedTransport([b"DATA00000006", b"OKAY"])
+    flash.FastbootProtocol(transport).download(6, [b"abc", b"def"])
+    assert transport.written == [b"download:00000006", b"abc", b"def"]
+
+    protocol = flash.FastbootProtocol(ScriptedTransport([b"DATA00000004"]))
+    with pytest.raises(flash.FastbootError, match="accepted 4 of 6"):
+        protocol.download(6, [b"abcdef"])
+    protocol = flash.FastbootProtocol(ScriptedTransport([b"DATA00000006"]))
+    with pytest.raises(flash.FastbootError, match="Sent 3 bytes"):
+        protocol.download(6, [b"abc"])
+
+
+class FakeTcpDevice:
+    """fastboot TCP server (FB01 handshake, 8-byte big-endian frames) in front of a SimulatedDevice"""
+    def __init__(self, **options):
+        self.device = flash.SimulatedDevice("tcp-test", latency=0, bandwidth=10000, **options)
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def recv_exact(self, conn, size):
+        data = b""
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    assert self.recv_exact(conn, 4) == b"FB01"
+                    conn.sendall(b"FB01")
+                    while True:
+                        size, = struct.unpack(">Q", self.recv_exact(conn, 8))
+                        for reply in self.device.receive(self.recv_exact(conn, size)):
+                            conn.sendall(struct.pack(">Q", len(reply)) + reply)
+                except ConnectionError:
+                    continue
+
+    def close(self):
+        self.server.close()
+
+
+@pytest.fixture
+def tcp_device():
+    server = FakeTcpDevice(max_download_size=64 * 1024)
+    yield server
+    server.close()
+
+
+def test_tcp_getvar_and_flash(tcp_device, tmp_path):
+    native = flash.NativeFastboot(f"tcp:127.0.0.1:{tcp_device.port}")
+    result = native.execute(["getvar", "product"])
+    assert result.stdout.strip() == "product: sim"
+    image = tmp_path / "boot.img"
+    image.write_bytes(os.urandom(40 * 1024))
+    native.execute(["flash", "boot", str(image)])
+    # boot is slotted, so the current slot is resolved on the device side
+    assert tcp_device.device.flashed == {"boot_a": 40 * 1024}
+    native.execute(["reboot", "bootloader"])
+    assert tcp_device.device.stats["reboots"] == 1
+    assert native.execute(["getvar", "current-slot"]).stdout.strip() == "current-slot: a"
+
+
+def test_tcp_oversized_image_is_sent_as_sparse_pieces(tcp_device, tmp_path):
+    native = flash.NativeFastboot(f"tcp:127.0.0.1:{tcp_device.port}")
+    image = tmp_path / "modem.img"
+    image.write_bytes(os.urandom(200 * 1024))
+    native.execute(["flash", "modem", str(image)])
+    assert tcp_device.device.stats["bytes"] > 200 * 1024
+    assert "modem" in tcp_device.device.flashed
+    assert tcp_device.device.stats["commands"] >= 2 * 4
+
+
+@pytest.fixture
+def fastbootd(tmp_path):
+    """A simulated device in fastbootd whose logical partitions were recreated at 1 byte"""
+    serial = f"sim:fastbootd-{tmp_path.name}"
+    device = flash.SimulatedDevice.create(serial, latency=0, bandwidth=10000, max_download_size=64 * 1024)
+    device.vars["is-userspace"] = "yes"
+    native = flash.NativeFastboot(serial)
+    for partition in ("system_a", "system_b"):
+        native.execute(["create-logical-partition", partition, "1"])
+    return device, native
+
+
+def test_device_refuses_a_flash_larger_than_the_logical_partition(fastbootd):
+    device, native = fastbootd
+    protocol = native.connect()
+    protocol.download(8192, [bytes(8192)])
+    with pytest.raises(flash.FastbootRemoteError, match="resized"):
+        protocol.flash("system_a")
+
+
+def test_logical_partition_is_resized_to_the_image_before_flashing(fastbootd, tmp_path):
+    device, native = fastbootd
+    image = tmp_path / "system.img"
+    image.write_bytes(os.urandom(40 * 1024))
+    native.execute(["flash", "system", str(image)])
+    assert device.logical["system_a"] == 40 * 1024
+    assert device.flashed == {"system_a": 40 * 1024}
+    assert device.logical["system_b"] == 1
+
+
+def test_sparse_image_resizes_to_its_unpacked_size(fastbootd, tmp_path):
+    device, native = fastbootd
+    raw = tmp_path / "raw.img"
+    raw.write_bytes(os.urandom(8 * 1024) + bytes(1024 * 1024))
+    sparse = tmp_path / "system.img"
+    with open(sparse, "wb") as f:
+        flash.SparseImage.load(str(raw)).write_to(f)
+    native.execute(["flash", "system", str(sparse)])
+    assert device.logical["system_a"] == 1032 * 1024
+    # Pieces of an oversized raw image are sized once, to the whole image
+    big = tmp_path / "big.img"
+    big.write_bytes(os.urandom(200 * 1024))
+    native.execute(["flash", "system", str(big)])
+    assert device.logical["system_a"] == 200 * 1024
+
+
+def test_bootloader_partitions_are_not_resized(tcp_device, tmp_path):
+    native = flash.NativeFastboot(f"tcp:127.0.0.1:{tcp_device.port}")
+    image = tmp_path / "boot.img"
+    image.write_bytes(os.urandom(4096))
+    native.execute(["flash", "boot", str(image)])
+    assert tcp_device.device.logical == {}
+    assert "boot_a" in tcp_device.device.flashed
+
+
+def flasher_with(native, backend="auto"):
+    flasher = flash.Flash(devices=[{"model": "Test", "partitions": {}}], backend=backend)
+    flasher.fastboot_path = "fastboot"
+    flasher.native = native
+    return flasher
+
+
+class DecliningNative:
+    connected = True
+
+    def __init__(self):
+        self.events = []
+
+    def execute(self, args, stream=None):
+        self.events.append("execute")
+        return None
+
+    def disconnect(self):
+        self.events.append("disconnect")
+
+
+def test_declined_command_releases_the_device_before_the_binary_runs(monkeypatch):
+    native = DecliningNative()
+    flasher = flasher_with(native)
+
+    def binary(cmd):
+        native.events.append("binary")
+        return subprocess.CompletedProcess(cmd, 0, stdout="OKAY\n")
+    monkeypatch.setattr(flasher, "stream_command", binary)
+    flasher.run_command(["fastboot", "oem", "device-info"])
+    assert native.events == ["execute", "disconnect", "binary"]
+
+
+def test_auto_backend_without_transport_switches_to_the_binary(monkeypatch):
+    class Unreachable:
+        connected = False
+
+        def execute(self, args, stream=None):
+            raise flash.FastbootError("No fastboot USB device found")
+    flasher = flasher_with(Unreachable())
+    calls = []
+    monkeypatch.setattr(flasher, "stream_command",
+                        lambda cmd: calls.append(cmd) or subprocess.CompletedProcess(cmd, 0, stdout=""))
+    flasher.run_command(["fastboot", "getvar", "product"])
+    assert flasher.native is None
+    assert calls == [["fastboot", "getvar", "product"]]
+
+
+def test_native_backend_errors_are_not_hidden_by_the_binary():
+    class Broken:
+        connected = True
+
+        def execute(self, args, stream=None):
+            raise flash.FastbootRemoteError("remote: boom")
+    flasher = flasher_with(Broken(), backend="native")
+    with pytest.raises(subprocess.CalledProcessError):
+        flasher.run_command(["fastboot", "erase", "userdata"])
@@ -0,0 +1,160 @@
+"""payload.bin and ROM zip sources, fed payloads written with a minimal protobuf encoder (update_metadata.proto)"""
+import bz2
+import hashlib
+import lzma
+import os
+import struct
+import zipfile
+
+import pytest
+
+import flash
+from test_sparse_image import unsparse
+
+BLOCK = 4096
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        out.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(out)
+
+
+def field(number, value):
+    if isinstance(value, int):
+        return varint(number << 3) + varint(value)
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def message(*fields):
+    return b"".join(field(number, value) for number, value in fields)
+
+
+def operation(op_type, extents, data=b"", offset=0):
+    fields = [(1, op_type)]
+    if data:
+        fields += [(2, offset), (3, len(data))]
+    fields += [(6, message((1, start), (2, blocks))) for start, blocks in extents]
+    return message(*fields)
+
+
+def write_payload(path, partitions):
+    """partitions: name -> (image bytes, [(op_type, [(start, blocks)], data)])"""
+    blobs = b""
+    manifest = [(3, BLOCK)]
+    for name, (image, ops) in partitions.items():
+        fields = [(1, name.encode()),
+                  (7, message((1, len(image)), (2, hashlib.sha256(image).digest())))]
+        for op_type, extents, data in ops:
+            fields.append((8, operation(op_type, extents, data, len(blobs))))
+            blobs += data
+        manifest.append((13, message(*fields)))
+    manifest = message(*manifest)
+    # Fields this reader does not know (fixed64, fixed32) are skipped
+    manifest = varint(99 << 3 | 1) + bytes(8) + varint(98 << 3 | 5) + bytes(4) + manifest
+    header = struct.pack(">4sQQI", b"CrAU", 2, len(manifest), 0)
+    with open(path, "wb") as f:
+        f.write(header + manifest + blobs)
+
+
+@pytest.fixture
+def images():
+    boot = os.urandom(3 * BLOCK)
+    system = os.urandom(2 * BLOCK) + bytes(4 * BLOCK) + b"\x5a" * BLOCK + os.urandom(BLOCK - 512)
+    return {
+        "boot": (boot, [(flash.PayloadOperation.REPLACE, [(0, 3)], boot)]),
+        # Extents out of order, a ZERO run and a compressed tail shorter than a block
+        "system": (system, [
+            (flash.PayloadOperation.REPLACE_XZ, [(6, 2)], lzma.compress(system[6 * BLOCK:] + bytes(512))),
+            (flash.PayloadOperation.REPLACE_BZ, [(0, 2)], bz2.compress(system[:2 * BLOCK])),
+            (flash.PayloadOperation.ZERO, [(2, 4)], b""),
+        ]),
+    }
+
+
+def test_manifest_is_decoded(tmp_path, images):
+    path = str(tmp_path / "payload.bin")
+    write_payload(path, images)
+    source = flash.RomSource.open(path)
+    assert isinstance(source, flash.PayloadSource)
+    assert source.names() == ["boot", "system"]
+    for name, (image, _) in images.items():
+        assert source.size(name) == len(image)
+        assert source.digest(name) == hashlib.sha256(image).hexdigest()
+
+
+def test_operations_expand_to_the_image(tmp_path, images):
+    path = str(tmp_path / "payload.bin")
+    write_payload(path, images)
+    source = flash.PayloadSource(path)
+    for name, (image, _) in images.items():
+        assert b"".join(source.image(name).stream()) == image
+        with source.image(name).open() as f:
+            assert f.read() == image
+
+
+def test_zero_operations_overwrite_the_partition_when_sent_sparse(tmp_path):
+    data = os.urandom(BLOCK)
+    vendor = data + bytes(3 * BLOCK)
+    write_payload(str(tmp_path / "payload.bin"), {"vendor": (vendor, [
+        (flash.PayloadOperation.REPLACE, [(0, 1)], data),
+        (flash.PayloadOperation.ZERO, [(1, 2)], b""),
+        (flash.PayloadOperation.DISCARD, [(3, 1)], b""),
+    ])})
+    image = flash.PayloadSource(str(tmp_path / "payload.bin")).image("vendor")
+    assert b"".join(image.stream()) == vendor
+    sparse = flash.SparseImage.load(image)
+    assert [(start, kind, blocks) for start, kind, blocks, _, _ in sparse.chunks] == [
+        (0, flash.SparseImage.CHUNK_RAW, 1), (1, flash.SparseImage.CHUNK_FILL, 2)]
+    # Over a partition that still holds old data, ZERO blocks come out zeroed; DISCARD leaves them alone
+    stale = bytearray(b"\xa5" * len(vendor))
+    out = unsparse(b"".join(sparse.stream()), stale)
+    assert bytes(out[:3 * BLOCK]) == vendor[:3 * BLOCK]
+    assert bytes(out[3 * BLOCK:]) == b"\xa5" * BLOCK
+
+
+def test_payload_stored_in_a_rom_zip(tmp_path, images):
+    payload = str(tmp_path / "payload.bin")
+    write_payload(payload, images)
+    rom = str(tmp_path / "rom.zip")
+    with zipfile.ZipFile(rom, "w") as archive:
+        archive.writestr("META-INF/com/android/metadata", "ota-type=AB\n")
+        archive.write(payload, "payload.bin", compress_type=zipfile.ZIP_STORED)
+    source = flash.RomSource.open(rom)
+    assert isinstance(source, flash.PayloadSource)
+    assert b"".join(source.image("boot").stream()) == images["boot"][0]
+
+
+def test_compressed_payload_in_a_zip_is_refused(tmp_path, images):
+    payload = str(tmp_path / "payload.bin")
+    write_payload(payload, images)
+    rom = str(tmp_path / "rom.zip")
+    with zipfile.ZipFile(rom, "w") as archive:
+        archive.write(payload, "payload.bin", compress_type=zipfile.ZIP_DEFLATED)
+    with pytest.raises(ValueError, match="uncompressed"):
+        flash.RomSource.open(rom)
+
+
+def test_incremental_operations_are_refused(tmp_path):
+    path = str(tmp_path / "payload.bin")
+    source_copy = 4
+    write_payload(path, {"boot": (bytes(BLOCK), [(source_copy, [(0, 1)], b"")])})
+    with pytest.raises(ValueError, match="only full OTAs"):
+        flash.PayloadSource(path)
+
+
+def test_rom_zip_images_are_streamed_from_the_archive(tmp_path):
+    boot = os.urandom(2 * BLOCK)
+    rom = str(tmp_path / "rom.zip")
+    with zipfile.ZipFile(rom, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("images/boot.img", boot)
+        archive.writestr("images/readme.txt", "not an image")
+    source = flash.RomSource.open(rom)
+    assert isinstance(source, flash.ZipSource)
+    assert source.names() == ["boot"]
+    assert source.size("boot") == len(boot)
+    assert b"".join(source.image("boot").stream()) == boot
@@ -0,0 +1,116 @@
+"""SparseImage conversion and splitting, checked with an independent sparse format decoder (libsparse sparse_format.h)"""
+import os
+import struct
+
+import pytest
+
+import flash
+
+BLOCK = 4096
+
+
+def unsparse(data, out=None):
+    """Expand one sparse image; with out, only the blocks it carries are written over it"""
+    magic, major, _, file_hdr_sz, chunk_hdr_sz, block_size, total_blocks, total_chunks, _ = \
+        struct.unpack_from("<IHHHHIIII", data)
+    assert (magic, major, file_hdr_sz, chunk_hdr_sz) == (0xED26FF3A, 1, 28, 12)
+    if out is None:
+        out = bytearray(total_blocks * block_size)
+    assert len(out) == total_blocks * block_size
+    offset = file_hdr_sz
+    block = 0
+    for _ in range(total_chunks):
+        kind, _, blocks, total_sz = struct.unpack_from("<HHII", data, offset)
+        payload = data[offset + chunk_hdr_sz:offset + total_sz]
+        if kind == 0xCAC1:
+            assert len(payload) == blocks * block_size
+            out[block * block_size:(block + blocks) * block_size] = payload
+        elif kind == 0xCAC2:
+            assert len(payload) == 4
+            out[block * block_size:(block + blocks) * block_size] = payload * (blocks * block_size // 4)
+        else:
+            assert kind == 0xCAC3 and not payload
+        block += blocks
+        offset += total_sz
+    assert block == total_blocks
+    assert offset == len(data)
+    return out
+
+
+def serialize(image):
+    return b"".join(image.stream())
+
+
+@pytest.fixture
+def raw_image(tmp_path):
+    """Data, a zero hole, a fill pattern and more data, like a filesystem image with free space"""
+    data = (os.urandom(5 * BLOCK) + bytes(300 * BLOCK) + b"\x11\x22\x33\x44" * (8 * BLOCK // 4)
+            + os.urandom(3 * BLOCK) + bytes(40 * BLOCK))
+    path = tmp_path / "system.img"
+    path.write_bytes(data)
+    return str(path), data
+
+
+def test_raw_to_sparse_to_raw_round_trip(raw_image, tmp_path):
+    path, data = raw_image
+    image = flash.SparseImage.load(path)
+    kinds = {kind for _, kind, _, _, _ in image.chunks}
+    assert kinds == {flash.SparseImage.CHUNK_RAW, flash.SparseImage.CHUNK_FILL}
+    sparse = serialize(image)
+    assert len(sparse) == image.size()
+    # Holes cost a chunk header instead of their blocks
+    assert len(sparse) < 9 * BLOCK
+    assert bytes(unsparse(sparse)) == data
+
+    sparse_path = tmp_path / "system.sparse.img"
+    sparse_path.write_bytes(sparse)
+    assert flash.SparseImage.is_sparse(str(sparse_path))
+    reloaded = flash.SparseImage.load(str(sparse_path))
+    assert serialize(reloaded) == sparse
+    assert b"".join(reloaded.iter_raw()) == data
+
+
+def test_zero_blocks_overwrite_what_the_partition_held(raw_image):
+    path, data = raw_image
+    # A recreated logical partition still holds its extents' old contents
+    stale = bytearray(b"\xa5" * len(data))
+    assert bytes(unsparse(serialize(flash.SparseImage.load(path)), stale)) == data
+    out = bytearray(b"\xa5" * len(data))
+    for piece in flash.SparseImage.load(path).split(64 * 1024):
+        unsparse(serialize(piece), out)
+    assert bytes(out) == data
+
+
+def test_unaligned_tail_is_padded_to_a_block(tmp_path):
+    data = os.urandom(2 * BLOCK + 100)
+    path = tmp_path / "odd.img"
+    path.write_bytes(data)
+    image = flash.SparseImage.load(str(path))
+    assert image.total_blocks == 3
+    assert bytes(unsparse(serialize(image))) == data + bytes(BLOCK - 100)
+
+
+@pytest.mark.parametrize("max_size", [64 * 1024, 3 * BLOCK + 28 + 3 * 12, 20 * BLOCK])
+def test_split_pieces_fit_and_cover_every_block(raw_image, max_size):
+    path, data = raw_image
+    pieces = flash.SparseImage.load(path).split(max_size)
+    out = bytearray(len(data))
+    for piece in pieces:
+        sparse = serialize(piece)
+        assert len(sparse) == piece.size() <= max_size
+        unsparse(sparse, out)
+    assert bytes(out) == data
+
+
+def test_split_keeps_an_image_that_fits_whole(raw_image):
+    path, _ = raw_image
+    image = flash.SparseImage.load(path)
+    pieces = image.split(image.size())
+    assert len(pieces) == 1
+    assert serialize(pieces[0]) == serialize(image)
+
+
+def test_split_refuses_a_limit_below_one_block(raw_image):
+    path, _ = raw_image
+    with pytest.raises(ValueError, match="too small"):
+        flash.SparseImage.load(path).split(BLOCK)
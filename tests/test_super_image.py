@@ -0,0 +1,149 @@
+"""SuperImageBuilder output read back with an independent LP metadata parser (liblp metadata_format.h)"""
+import hashlib
+import json
+import os
+import struct
+
+import pytest
+
+import flash
+
+SECTOR = 512
+MiB = 1024 * 1024
+
+
+def parse_geometry(data):
+    magic, struct_size, checksum, max_size, slots, block_size = struct.unpack_from("<II32sIII", data)
+    assert magic == 0x616C4467
+    assert struct_size == 52
+    zeroed = data[:8] + bytes(32) + data[40:52]
+    assert hashlib.sha256(zeroed).digest() == checksum
+    return max_size, slots, block_size
+
+
+def parse_metadata(data):
+    magic, major, minor, header_size = struct.unpack_from("<IHHI", data)
+    assert magic == 0x414C5030
+    assert major == 10
+    checksum = data[12:44]
+    assert hashlib.sha256(data[:12] + bytes(32) + data[44:header_size]).digest() == checksum
+    tables_size, = struct.unpack_from("<I", data, 44)
+    tables = data[header_size:header_size + tables_size]
+    assert hashlib.sha256(tables).digest() == data[48:80]
+    descriptors = [struct.unpack_from("<III", data, 80 + 12 * i) for i in range(4)]
+    flags = struct.unpack_from("<I", data, 128)[0] if minor >= 2 else 0
+
+    def entries(index, fmt):
+        offset, count, entry_size = descriptors[index]
+        assert entry_size == struct.calcsize(fmt)
+        return [struct.unpack_from(fmt, tables, offset + i * entry_size) for i in range(count)]
+
+    name = lambda raw: raw.rstrip(b"\0").decode()
+    return {
+        "minor": minor,
+        "header_size": header_size,
+        "flags": flags,
+        "partitions": [(name(p[0]), p[1], p[2], p[3], p[4]) for p in entries(0, "<36sIIII")],
+        "extents": entries(1, "<QIQI"),
+        "groups": [(name(g[0]), g[1], g[2]) for g in entries(2, "<36sIQ")],
+        "block_devices": [(b[0], b[1], b[2], b[3], name(b[4]), b[5]) for b in entries(3, "<QIIQ36sI")],
+    }
+
+
+def build(tmp_path, virtual_ab, slots=3):
+    system = os.urandom(MiB + 4096)
+    vendor = os.urandom(300 * 1024) + bytes(200 * 1024)
+    (tmp_path / "system.img").write_bytes(system)
+    (tmp_path / "vendor.img").write_bytes(vendor)
+    builder = flash.SuperImageBuilder(
+        16 * MiB,
+        [("system", str(tmp_path / "system.img")), ("vendor", str(tmp_path / "vendor.img")), ("odm", None)],
+        group="qti_dynamic_partitions", metadata_slots=slots, virtual_ab=virtual_ab)
+    image = builder.build(str(tmp_path / "metadata.img"))
+    raw = b"".join(image.iter_raw())
+    assert len(raw) == 16 * MiB
+    return raw, {"system": system, "vendor": vendor}
+
+
+@pytest.mark.parametrize("virtual_ab", [True, False])
+def test_metadata_reads_back(tmp_path, virtual_ab):
+    raw, images = build(tmp_path, virtual_ab)
+    geometry = raw[4096:8192]
+    assert raw[8192:12288] == geometry
+    max_size, slots, block_size = parse_geometry(geometry)
+    assert (max_size, slots, block_size) == (65536, 3, 4096)
+
+    metadata_start = 4096 + 2 * 4096
+    copies = [raw[metadata_start + i * max_size:metadata_start + (i + 1) * max_size] for i in range(2 * slots)]
+    assert all(copy == copies[0] for copy in copies)
+    metadata = parse_metadata(copies[0])
+    assert (metadata["minor"], metadata["header_size"], metadata["flags"]) == \
+        ((2, 256, 1) if virtual_ab else (0, 128, 0))
+
+    assert [g[0] for g in metadata["groups"]] == ["default", "qti_dynamic_partitions_a", "qti_dynamic_partitions_b"]
+    first_sector, alignment, _, size, device, _ = metadata["block_devices"][0]
+    assert (device, size, alignment) == ("super", 16 * MiB, MiB)
+    assert first_sector * SECTOR >= metadata_start + 2 * slots * max_size
+
+    partitions = {p[0]: p for p in metadata["partitions"]}
+    assert sorted(partitions) == ["odm_a", "odm_b", "system_a", "system_b", "vendor_a", "vendor_b"]
+    for name, attributes, first_extent, extent_count, group in partitions.values():
+        assert attributes == 1
+        assert group == (1 if name.endswith("_a") else 2)
+        data = images.get(name[:-2]) if name.endswith("_a") else None
+        assert extent_count == (1 if data else 0)
+        if data:
+            sectors, target_type, target_data, source = metadata["extents"][first_extent]
+            assert (target_type, source) == (0, 0)
+            assert target_data >= first_sector
+            assert target_data * SECTOR % MiB == 0
+            start = target_data * SECTOR
+            assert sectors * SECTOR == len(data) + (-len(data) % 4096)
+            assert raw[start:start + len(data)] == data
+
+
+def test_images_larger_than_super_are_refused(tmp_path):
+    (tmp_path / "system.img").write_bytes(os.urandom(4096) * (5 * 256))
+    builder = flash.SuperImageBuilder(4 * MiB, [("system", str(tmp_path / "system.img"))], group="main",
+                                      metadata_slots=2)
+    with pytest.raises(ValueError):
+        builder.build(str(tmp_path / "metadata.img"))
+
+
+def test_bundled_devices_describe_their_super_layout():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "devices.json")
+    with open(path, encoding="utf-8") as f:
+        devices = json.load(f)["devices"]
+    for device in devices:
+        assert all(key in device.get("super", {}) for key in flash.Flash.SUPER_LAYOUT_KEYS), device["model"]
+
+
+def test_no_super_block_refuses_to_build(capsys):
+    device = {"model": "Test Phone", "board": "test", "partitions": {"logical": ["system"]}}
+    flasher = flash.Flash(devices=[device])
+    flasher.set_current_device(device, verify=False)
+    assert flasher.super_layout() is None
+    assert flasher.get_super_geometry() is None
+    assert "Not building super" in capsys.readouterr().out
+    device["super"] = {"group": "main", "metadata_slots": 3}
+    assert flasher.super_layout() is None
+    device["super"]["virtual_ab"] = True
+    assert flasher.super_layout() == device["super"]
+
+
+def test_super_images_come_from_the_rom_not_the_working_directory(tmp_path, monkeypatch):
+    rom = tmp_path / "rom"
+    rom.mkdir()
+    (rom / "super_empty.img").write_bytes(bytes(4096))
+    elsewhere = tmp_path / "elsewhere"
+    elsewhere.mkdir()
+    monkeypatch.chdir(elsewhere)
+    flasher = flash.Flash(devices=[{"model": "Test Phone", "partitions": {}}])
+    flasher.spinner_enabled = False
+    flasher.rom = flash.RomSource.open(str(rom))
+    flashed = []
+    monkeypatch.setattr(flasher, "resize_partitions", lambda: None)
+    monkeypatch.setattr(flasher, "flash_partitions", flashed.extend)
+    assert flasher.handle_super_partitions()
+    assert flashed == ["super_empty"]
+    assert os.getcwd() == str(elsewhere)
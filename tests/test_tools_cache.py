@@ -0,0 +1,140 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import flash
+
+
+def tools_zip(revision):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("platform-tools/fastboot", "#!/bin/sh\n")
+        archive.writestr("platform-tools/source.properties", f"Pkg.Revision={revision}\n")
+        # Incompressible padding so a partial download is a real prefix
+        archive.writestr("platform-tools/lib/padding", os.urandom(256 * 1024), compress_type=zipfile.ZIP_STORED)
+    return buffer.getvalue()
+
+
+class ToolsServer(BaseHTTPRequestHandler):
+    """Serves one archive with an ETag, honouring Range only while If-Range still matches"""
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        body, etag = server.body, server.etag
+        status, start = 200, 0
+        if "Range" in self.headers and self.headers.get("If-Range") == etag:
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            status = 206 if start < len(body) else 416
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        if status == 416:
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_header("Content-Length", str(len(body) - start))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ToolsServer)
+    httpd.body = tools_zip("35.0.2")
+    httpd.etag = '"v1"'
+    httpd.requests = []
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/platform-tools-latest-linux.zip"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def interrupted(cache, data, etag):
+    """Leave the state a download killed halfway through leaves behind"""
+    os.makedirs(cache.root, exist_ok=True)
+    part_path = os.path.join(cache.root, f"{cache.archive}.part")
+    with open(part_path, "wb") as f:
+        f.write(data)
+    if etag:
+        with open(f"{part_path}.json", "w") as f:
+            json.dump({"etag": etag, "last_modified": None}, f)
+
+
+def test_download_is_cached_per_version(server, tmp_path):
+    cache = flash.ToolsCache(str(tmp_path / "tools"), server.url)
+    tools_dir = cache.ensure()
+    assert os.path.exists(os.path.join(tools_dir, "fastboot"))
+    assert cache.current()[0] == "35.0.2"
+    assert cache.ensure() == tools_dir
+    assert len(server.requests) == 1
+
+
+def test_interrupted_download_resumes_with_if_range(server, tmp_path):
+    cache = flash.ToolsCache(str(tmp_path / "tools"), server.url)
+    half = len(server.body) // 2
+    interrupted(cache, server.body[:half], server.etag)
+    archive_path, digest = cache.download()
+    assert server.requests[-1]["Range"] == f"bytes={half}-"
+    assert server.requests[-1]["If-Range"] == server.etag
+    with open(archive_path, "rb") as f:
+        assert f.read() == server.body
+
+
+def test_changed_archive_restarts_the_download(server, tmp_path):
+    cache = flash.ToolsCache(str(tmp_path / "tools"), server.url)
+    interrupted(cache, server.body[:1000], server.etag)
+    server.body, server.etag = tools_zip("36.0.0"), '"v2"'
+    archive_path, _ = cache.download()
+    with open(archive_path, "rb") as f:
+        assert f.read() == server.body
+
+
+def test_partial_download_without_validator_is_not_resumed(server, tmp_path):
+    cache = flash.ToolsCache(str(tmp_path / "tools"), server.url)
+    interrupted(cache, b"left over from another archive", None)
+    archive_path, _ = cache.download()
+    assert "Range" not in server.requests[-1]
+    with open(archive_path, "rb") as f:
+        assert f.read() == server.body
+
+
+def test_checksum_mismatch_discards_the_download(server, tmp_path):
+    cache = flash.ToolsCache(str(tmp_path / "tools"), server.url, sha256="0" * 64)
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        cache.ensure()
+    assert cache.current() is None
+    assert not os.path.exists(os.path.join(cache.root, f"{cache.archive}.part"))
+
+
+def test_lock_of_an_exited_process_is_taken_over(tmp_path):
+    path = str(tmp_path / "tools.lock")
+    child = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    with open(path, "w") as f:
+        f.write(child.stdout.strip())
+    with flash.FileLock(path, timeout=1):
+        with open(path) as f:
+            assert f.read() == str(os.getpid())
+    assert not os.path.exists(path)
+
+
+def test_old_lock_of_a_live_process_is_kept(tmp_path):
+    path = str(tmp_path / "tools.lock")
+    with open(path, "w") as f:
+        f.write(str(os.getpid()))
+    os.utime(path, (0, 0))
+    with pytest.raises(TimeoutError):
+        with flash.FileLock(path, timeout=0.5, stale=1):
+            pass
+    assert os.path.exists(path)
@@ -0,0 +1,105 @@
+"""TransferTuner calibration against a SimulatedDevice, the cached profiles and how a flash applies them"""
+import os
+
+import pytest
+
+import flash
+
+MB = 1024 * 1024
+
+
+def simulated(serial, **options):
+    """A native-backend Flash on a fresh simulated device that records its commands and the size of every data write"""
+    options = dict({"product": "tune", "latency": 0, "bandwidth": 2000, "max_download_size": 8 * MB}, **options)
+    sim = flash.SimulatedDevice.create(serial, **options)
+    sim.commands, sim.writes = [], []
+    receive = sim.receive
+    def recording(data):
+        if sim.pending:
+            sim.writes.append(len(data))
+        else:
+            sim.commands.append(bytes(data).decode())
+        return receive(data)
+    sim.receive = recording
+    flasher = flash.Flash(serial=serial, backend="native")
+    flasher.fastboot_path = "fastboot"
+    flasher.spinner_enabled = False
+    return sim, flasher
+
+
+@pytest.fixture
+def tuning(tmp_path):
+    return str(tmp_path / "tuning.json")
+
+
+def test_calibration_picks_the_fastest_chunk_size(tuning, capsys):
+    # A fixed cost per USB write makes small chunks slow
+    sim, flasher = simulated("sim:calibrate", overhead=10)
+    flasher.tuner = flash.TransferTuner(tuning)
+    flasher.tune_transfers()
+    assert "Saved for tune" in capsys.readouterr().out
+    profile = flash.TransferTuner(tuning).lookup("tune", "native", 8 * MB)
+    assert [size for size, _ in profile["chunks"]] == flash.TransferTuner.CHUNK_SIZES
+    assert profile["chunk_size"] == 4 * MB
+    # Larger downloads kept getting faster, so the whole buffer is used
+    assert [size for size, _ in profile["downloads"]] == [MB, 4 * MB]
+    assert profile["sparse_limit"] == 8 * MB
+    # Throwaway uploads only, nothing was flashed
+    assert sim.stats["bytes"] > 0 and not sim.flashed
+
+
+def test_calibration_keeps_the_smaller_size_on_a_tie(tuning):
+    # Equal rates for every size: the smallest chunk wins, downloads stop at the first best one
+    def send(size, chunk_size):
+        return size / (100 * MB)
+    profile = flash.TransferTuner(tuning).calibrate(send, 64 * MB)
+    assert profile["chunk_size"] == flash.TransferTuner.CHUNK_SIZES[0]
+    assert profile["sparse_limit"] == flash.TransferTuner.DOWNLOAD_SIZES[0]
+    profile = flash.TransferTuner(tuning).calibrate(send, 64 * MB, chunked=False)
+    assert profile["chunk_size"] is None and not profile["chunks"]
+
+
+def test_lookup_is_per_board_backend_and_download_size(tuning):
+    tuner = flash.TransferTuner(tuning)
+    profile = {"max_download_size": 8 * MB, "chunk_size": 256 * 1024, "sparse_limit": 2 * MB}
+    tuner.save("tune", "native", profile)
+    cached = flash.TransferTuner(tuning)
+    assert cached.lookup("tune", "native", 8 * MB) == profile
+    assert cached.lookup("tune", "fastboot", 8 * MB) is None
+    assert cached.lookup("other", "native", 8 * MB) is None
+    # A bootloader that changed its download buffer needs calibrating again
+    assert cached.lookup("tune", "native", 16 * MB) is None
+
+
+def test_tuned_settings_shape_the_transfer(tuning, tmp_path):
+    flash.TransferTuner(tuning).save("tune", "native", {"max_download_size": 8 * MB, "chunk_size": 256 * 1024,
+                                                        "sparse_limit": 2 * MB})
+    sim, flasher = simulated("sim:apply")
+    flasher.tuner = flash.TransferTuner(tuning)
+    flasher.apply_tuning()
+    assert flasher.native.chunk_size == 256 * 1024
+    assert flasher.sparse_limit == 2 * MB
+    assert flasher.transfer_limit() == 2 * MB
+
+    image = tmp_path / "vendor.img"
+    image.write_bytes(os.urandom(5 * MB))
+    pieces = flasher.prepare_image(str(image))
+    assert len(pieces) == 3
+    del sim.commands[:], sim.writes[:]
+    flasher.flash_sparse("vendor", str(image), pieces)
+    downloads = [int(command.split(":")[1], 16) for command in sim.commands if command.startswith("download:")]
+    assert downloads == [piece.size() for piece in pieces]
+    assert max(downloads) <= 2 * MB
+    assert max(sim.writes) == 256 * 1024
+    assert sum(sim.writes) == sum(downloads)
+
+
+def test_profile_for_another_download_size_is_not_applied(tuning):
+    flash.TransferTuner(tuning).save("tune", "native", {"max_download_size": 16 * MB, "chunk_size": 64 * 1024,
+                                                        "sparse_limit": 2 * MB})
+    _, flasher = simulated("sim:stale")
+    flasher.tuner = flash.TransferTuner(tuning)
+    flasher.apply_tuning()
+    assert flasher.native.chunk_size is None
+    assert flasher.sparse_limit is None
+    assert flasher.transfer_limit() == 8 * MB